@@ -1,12 +1,19 @@
 #include <Firmata.h>
 #include <Wire.h>
 
+// Sysex commands 0x00-0x4F read the ChipCap2 sensor at that I2C address.
+// CC2_BATCH_READ reads all the addresses listed in the request at once and replies
+// [n, (address, 4 data bytes) * n]
+#define CC2_BATCH_READ 0x50
+#define CC2_MAX_BATCH 12      // Maximum number of sensors per batch read
+#define CC2_WAKE_DELAY_MS 50  // Time for a measurement after waking up the sensors [ms]
+
 void setup() {
   Firmata.setFirmwareVersion(FIRMATA_FIRMWARE_MAJOR_VERSION, FIRMATA_FIRMWARE_MINOR_VERSION);
   Firmata.begin(57600);
 
   // Attach SysEx callback handler
-  for (uint8_t i = 0; i < 0x50; i++)
+  for (uint8_t i = 0; i <= CC2_BATCH_READ; i++)
     Firmata.attach(i, sysexCallback);
 
   Wire.begin();
@@ -20,6 +27,11 @@ void loop() {
 }
 
 void sysexCallback(byte command, byte argc, byte* argv) {
+  if (command == CC2_BATCH_READ) {
+    batchReadCC2(argc, argv);
+    return;
+  }
+
   uint8_t* sensorData = readCC2(command);  // Read from ChipCap2 sensor
   byte dataBytes[5];
   dataBytes[0] = command;
@@ -63,21 +75,20 @@ void sysexCallback(byte command, byte argc, byte* argv) {
 }
 
 
-uint8_t* readCC2(uint8_t cc_i2c_addr) {
-  digitalWrite(LED_BUILTIN, HIGH);
-  //Wake up the sensor from sleep mode
+//Wake up the sensor from sleep mode, it starts a measurement
+void wakeCC2(uint8_t cc_i2c_addr) {
   Wire.beginTransmission(cc_i2c_addr);
-  byte success = Wire.endTransmission(true);
-  delay(50);
-
-  //Read the data from the sensor:
-  //  Data bytes AAHHHHHH HHHHHHHH TTTTTTTT TTTTTTXX
-  //  A: status bits (00 for normal reading)
-  //  H: Humidity Bits
-  //  T: Temperature Bits
-  //  X: Ignore
-  uint8_t* rht = new uint8_t[4];
+  Wire.endTransmission(true);
+}
 
+//Read the data of the last measurement of the sensor into rht (4 bytes):
+//  Data bytes AAHHHHHH HHHHHHHH TTTTTTTT TTTTTTXX
+//  A: status bits (00 for normal reading)
+//  H: Humidity Bits
+//  T: Temperature Bits
+//  X: Ignore
+//A missing sensor reads as 0xFF bytes
+void readCC2Data(uint8_t cc_i2c_addr, uint8_t* rht) {
   Wire.beginTransmission(cc_i2c_addr);
   Wire.requestFrom(cc_i2c_addr, 4, true);
   rht[0] = Wire.read();
@@ -85,8 +96,38 @@ uint8_t* readCC2(uint8_t cc_i2c_addr) {
   rht[2] = Wire.read();
   rht[3] = Wire.read();
   Wire.endTransmission();
+}
+
+uint8_t* readCC2(uint8_t cc_i2c_addr) {
+  digitalWrite(LED_BUILTIN, HIGH);
+  wakeCC2(cc_i2c_addr);
+  delay(CC2_WAKE_DELAY_MS);
+
+  uint8_t* rht = new uint8_t[4];
+  readCC2Data(cc_i2c_addr, rht);
 
   digitalWrite(LED_BUILTIN, LOW);
 
   return rht;
 }
+
+//Read several sensors in one exchange: all of them measure at the same time, so the
+//wake-up delay is paid once instead of once per sensor
+void batchReadCC2(byte argc, byte* argv) {
+  uint8_t n = min(argc, CC2_MAX_BATCH);
+  byte dataBytes[1 + 5 * CC2_MAX_BATCH];
+
+  digitalWrite(LED_BUILTIN, HIGH);
+  for (uint8_t i = 0; i < n; i++)
+    wakeCC2(argv[i]);
+  delay(CC2_WAKE_DELAY_MS);
+
+  dataBytes[0] = n;
+  for (uint8_t i = 0; i < n; i++) {
+    dataBytes[1 + 5 * i] = argv[i];
+    readCC2Data(argv[i], &dataBytes[2 + 5 * i]);
+  }
+  digitalWrite(LED_BUILTIN, LOW);
+
+  Firmata.sendSysex(CC2_BATCH_READ, 1 + 5 * n, dataBytes);
+}
@@ -0,0 +1,332 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import Hardware
+import Simulation
+from Clock import CLOCK
+from HumiditySensorInterface import HumiditySensorInterface
+from Recorder import Recorder
+from RunCatalog import RunCatalog
+from Metrics import REGISTRY
+
+CONTROL_LOOP_SECONDS = REGISTRY.histogram('lac_control_loop_seconds', 'Duration of a tick of the control loop.', ['chamber'])
+
+# Types of the devices of a chamber config
+DEVICE_TYPES = {
+    'MFC': Hardware.MFC,
+    'HumiditySensor': Hardware.HumiditySensor,
+    'PressureSensor': Hardware.PressureSensor,
+    'DummyDAQ': Hardware.DummyDAQ,
+}
+
+# Devices used by the control loop, overridden by the 'control' section of a chamber config
+DEFAULT_CONTROL = {
+    'humidity_sensor': 'SHT1',      # Humidity fed back to the control loop
+    'dry_mfc': 'MFC1',              # MFC of the dry line
+    'humid_mfc': 'MFC2',            # MFC of the humidified line
+}
+
+
+# Define a class for a humidity chamber (cell) and everything that drives it: its devices, control
+# mode and parameters, setpoint and PID, hardware group and recorder.  Chambers are independent, so
+# several cells can be driven from one process; they only share the scheduler and event loop, and
+# the Arduino boards their sensors are attached to.
+#
+# Every device is acquired by its own scheduler job and the control loop by another, so adding
+# devices or chambers adds jobs instead of lengthening a loop period.  Devices only wait for each
+# other when they share a port (see assign_buses), or a board, which batches their reads (see
+# HumiditySensorInterface).
+class Chamber:
+    def __init__(self, chamber_id, config, defaults=None, boards=None, simulate=False):
+        """
+        Parameters:
+        chamber_id (str): Id of the chamber, used in the routes, job names and metrics.
+        config (dict): The chamber config, see chambers.json.
+        defaults (dict, optional): Default settings, overridden by the settings of the config. Default is None.
+        boards (dict, optional): Arduino boards (HumiditySensorInterface) keyed by port, shared between chambers. Default is None.
+        simulate (bool, optional): Use simulated hardware (Simulation.py) instead of the ports of the config. Default is False.
+        """
+        self.id = chamber_id
+        self.settings = {**(defaults or {}),
+                         **{key: value for key, value in config.items() if key not in ['devices', 'control']}}
+        self.loop_freq_hz = self.settings.get('loop_freq_hz', 1)
+        self.save_dir = os.path.join(os.getcwd(), self.settings.get('save_dir', os.path.join('data', chamber_id)))
+        self.control = {**DEFAULT_CONTROL, **config.get('control', {})}
+        self.control_data = {'mode': 'MAN', 'params': {self.control['dry_mfc']: 0, self.control['humid_mfc']: 0}}
+        self.simulate = simulate
+
+        # Each chamber writes its save files from its own recorder thread
+        self.recorder = Recorder(flush_interval_s=self.settings.get('recorder_flush_interval_s', 1),
+                                 flush_size=self.settings.get('recorder_flush_size', 1000))
+        self.runs = RunCatalog(self.save_dir)   # Recordings of the chamber
+        self.run_directory = None               # Directory of the current recording, None if not recording
+
+        self.boards = boards if boards is not None else {}
+        self.board_ports = []   # Ports of the boards of this chamber's sensors
+        self.sensor_boards = {} # Port of the board of each humidity sensor
+        self.ports = {}         # Port (or sensor address) of each device to connect
+        self.config_ports = {}  # Port of the config of each device with a port of its own, see assign_buses
+        self.schedule = {}      # Acquisition rate and priority of the devices that don't use the defaults
+        self.daq_instances = {}
+        for daq_key, device in config.get('devices', {}).items():
+            self.daq_instances[daq_key] = self._create_device(daq_key, device)
+        self.daq_instances['humidity_setpoint'] = Hardware.HumiditySetpoint(self.settings.get('pid_gains', [0.05, 0.002, 0]),
+                                                                            1/self.loop_freq_hz)
+        for daq in self.daq_instances.values():
+            daq.recorder = self.recorder
+
+        self.hg = Hardware.HardwareGroup(self.daq_instances, 10, concurrent=True,
+                                         device_timeout_s=self.settings.get('device_timeout_s', 2), name=chamber_id)
+
+        # Components fetched by the control loop, instead of their own job, while it is enabled.
+        # The humidity sensor keeps its own job: the control loop reads its latest sample
+        self.control_loop_daqs = ['humidity_setpoint']
+
+        # Number of acquisition periods after which the latest sample of a device is stale
+        self.max_age_periods = self.settings.get('max_age_periods', 2)
+
+        # Progress of connect(): state ('pending', 'connecting', 'connected', 'failed' or 'timeout')
+        # and connection time [s] of each board and device
+        self.connect_timeout_s = self.settings.get('connect_timeout_s', 10)
+        self.connection_status = {port: {'state': 'pending', 'elapsed_s': None} for port in self.board_ports}
+        self.connection_status.update({daq_key: {'state': 'pending', 'elapsed_s': None} for daq_key in self.ports})
+        self.connect_time_s = None     # Time taken by connect() [s], None until it is done
+
+    def _create_device(self, daq_key, device):
+        device_type = device.get('type')
+        if device_type not in DEVICE_TYPES:
+            raise ValueError(f"Chamber {self.id}: unknown type {device_type} of device {daq_key}")
+        if 'rate_hz' in device or 'priority' in device:
+            self.schedule[daq_key] = {key: device[key] for key in ['rate_hz', 'priority'] if key in device}
+
+        if 'port' in device:
+            self.config_ports[daq_key] = device['port']
+        if device_type == 'MFC':
+            self.ports[daq_key] = self._simulated_port('mfc/' + self._plant_line(daq_key)) if self.simulate else device['port']
+            # The state returned by a set of the control loop replaces the get of the next acquisition
+            return Hardware.MFC(deadband=self.settings.get('mfc_deadband_sccm', 0.05),
+                                merge_window_s=1/self.schedule.get(daq_key, {}).get('rate_hz', self.loop_freq_hz))
+        if device_type == 'HumiditySensor':
+            board_port = self._simulated_port('firmata') if self.simulate else device['board']
+            if board_port not in self.boards:
+                self.boards[board_port] = HumiditySensorInterface()
+            if board_port not in self.board_ports:
+                self.board_ports.append(board_port)
+            self.sensor_boards[daq_key] = board_port
+            self.ports[daq_key] = int(str(device['address']), 0)
+            return Hardware.HumiditySensor(self.boards[board_port])
+        if device_type == 'PressureSensor':
+            self.ports[daq_key] = self._simulated_port('px409') if self.simulate else device['port']
+            return Hardware.PressureSensor()
+        # Dummy devices are not connected
+        return Hardware.DummyDAQ(device.get('freq', 1))
+
+    def _plant_line(self, daq_key):
+        if daq_key == self.control['dry_mfc']:
+            return 'dry'
+        if daq_key == self.control['humid_mfc']:
+            return 'humid'
+        return daq_key
+
+    def _simulated_port(self, device):
+        # One simulated plant per chamber
+        return f"{Simulation.SIM_PREFIX}{device}@{self.id}"
+
+    async def _connect_step(self, key, connect, *args):
+        # Runs one connection with a timeout, recording its progress in connection_status
+        status = self.connection_status[key]
+        status['state'] = 'connecting'
+        t0 = time.perf_counter()
+        try:
+            await asyncio.wait_for(connect(*args), self.connect_timeout_s)
+            status['state'] = 'connected'
+        except asyncio.TimeoutError:
+            status['state'] = 'timeout'
+            logging.error(f"[{self.id}] Connection to {key} timed out after {self.connect_timeout_s}s")
+        except Exception as e:
+            status['state'] = 'failed'
+            logging.error(f"[{self.id}] Could not connect to {key}, CHANGE PORT\n{'':<20}Error: {e}")
+        status['elapsed_s'] = time.perf_counter() - t0
+
+    async def _connect_board(self, board_port):
+        logging.info(f"[{self.id}] Starting connection to ARDUINO on port {board_port}")
+        await self.boards[board_port].connect_board_async(board_port)
+        logging.info(f"[{self.id}] HSI connected on port {board_port}")
+
+    async def _connect_device(self, daq_key, board_tasks):
+        # Sensors wait for their board, the other devices connect right away
+        if daq_key in self.sensor_boards:
+            await board_tasks[self.sensor_boards[daq_key]]
+        logging.info(f"[{self.id}] Starting connection to {daq_key} on port {self.ports[daq_key]}")
+        await self._connect_step(daq_key, self.daq_instances[daq_key].connect, self.ports[daq_key])
+        # Some devices report a failed connection without raising
+        if self.connection_status[daq_key]['state'] == 'connected' and not self.daq_instances[daq_key].is_connected:
+            self.connection_status[daq_key]['state'] = 'failed'
+
+    async def connect(self):
+        """
+        Connects the boards and devices of the chamber, all at once, each within connect_timeout_s.
+        Then sets the MFCs to 0 flow.  Must run in the hardware loop; the progress is in connection_status.
+
+        Returns:
+            list: The keys of the devices that could not be connected.
+        """
+        t0 = time.perf_counter()
+        board_tasks = {board_port: asyncio.ensure_future(self._connect_step(board_port, self._connect_board, board_port))
+                       for board_port in self.board_ports}
+        await asyncio.gather(*board_tasks.values(), *[self._connect_device(daq_key, board_tasks) for daq_key in self.ports])
+        self.connect_time_s = time.perf_counter() - t0
+
+        dry_mfc, humid_mfc = self.daq_instances.get(self.control['dry_mfc']), self.daq_instances.get(self.control['humid_mfc'])
+        if dry_mfc is not None and dry_mfc.is_connected and humid_mfc is not None and humid_mfc.is_connected:
+            # If connected, set MFCs to 0 flow
+            logging.info(f"[{self.id}] MFCs connected")
+            self.control_data = {'mode': 'MAN', 'params': {self.control['dry_mfc']: 0, self.control['humid_mfc']: 0}}
+            self.hg.add_flask_command(dry_mfc.set_flow_rate, {'flow_rate': 0, 'force': True})
+            self.hg.add_flask_command(humid_mfc.set_flow_rate, {'flow_rate': 0, 'force': True})
+
+        logging.info(f"[{self.id}] Connections done in {self.connect_time_s:.2f}s")
+        return [daq_key for daq_key in self.ports if not self.daq_instances[daq_key].is_connected]
+
+    @property
+    def setpoint(self):
+        return self.daq_instances['humidity_setpoint']
+
+    def control_params_with_preview(self):
+        """
+        Gets the control parameters to send to the client.  In ARB mode, the profile is sampled
+        for plotting (time_s and values); the samples are not kept by the server.
+        """
+        profile = self.setpoint.profile
+        if self.control_data['mode'] != 'ARB' or profile is None:
+            return self.control_data['params']
+
+        time_s, values = profile.sample()
+        return {**self.control_data['params'], 'time_s': time_s, 'values': values}
+
+    def status(self):
+        return {'control_mode': self.control_data['mode'], 'control': self.control, 'save_dir': self.save_dir,
+                'devices': {daq_key: {'type': type(daq).__name__, 'connected': daq.is_connected, 'port': daq.port}
+                            for daq_key, daq in self.daq_instances.items()}}
+
+    def max_age_s(self, daq_key):
+        # Age after which the latest sample of a device is stale [s], from its acquisition rate
+        return self.max_age_periods / self.schedule.get(daq_key, {}).get('rate_hz', self.loop_freq_hz)
+
+    def live_status(self):
+        """
+        Gets the connection and latest sample of every device from the samples already tracked
+        (DAQ.get_latest), without any hardware I/O, e.g. for the diagram of the UI.
+
+        Returns:
+            dict: {'time': UNIX timestamp [s], 'control_mode': str, 'recording': bool,
+                   'devices': {daq_key: {'connected', 'port', 'time', 'age_s', 'values', 'valid'}}}.
+        """
+        return {'time': CLOCK.now(), 'control_mode': self.control_data['mode'], 'recording': self.run_directory is not None,
+                'devices': {daq_key: {'connected': daq.is_connected, 'port': daq.port, **daq.get_latest(self.max_age_s(daq_key))}
+                            for daq_key, daq in self.daq_instances.items()}}
+
+    ######################
+    ### Hardware run loop
+    ######################
+
+    def make_acquisition_job(self, daq_key):
+        async def acquisition_job():
+            # The control loop devices are fetched in the control loop, if it is running
+            if daq_key in self.control_loop_daqs and self.setpoint.is_enabled:
+                return
+            await self.hg.fetch_device(daq_key)
+        return acquisition_job
+
+    async def control_loop(self):
+        if not self.setpoint.is_enabled:
+            return
+        with CONTROL_LOOP_SECONDS.time(self.id):
+            await self.control_tick()
+
+    async def control_tick(self):
+        # Get the setpoint of the control scheme
+        setpoint = await self.hg.fetch_device('humidity_setpoint')
+        if setpoint == False:
+            return
+        self.setpoint.pid.setpoint = setpoint['values']['humidity_setpoint']
+
+        # Compute new output from the PID according to the system's current value, the latest sample
+        # of the sensor's own job, or a new fetch if it is stale
+        sensor_key = self.control['humidity_sensor']
+        current_humidity = self.daq_instances[sensor_key].get_latest(self.max_age_s(sensor_key))
+        if not current_humidity['valid']:
+            current_humidity = await self.hg.fetch_device(sensor_key)
+        if current_humidity == False:
+            logging.error(f"[{self.id}] {sensor_key} DISCONNECTED, CANNOT RUN CONTROL LOOP")
+            return
+        else:
+            current_humidity = current_humidity['values']['humidity']
+
+        # Get the controller output to send to the plant (MFCs)
+        # This value defines the ratio of the MFC flow rates
+        # control = self.setpoint.pid(current_humidity)
+        control = self.setpoint.pid.setpoint / 100
+
+        logging.info(f"[{self.id}] Set: {self.setpoint.pid.setpoint:.3f}, Current: {current_humidity:.3f}, Control: {control:.3f}")
+
+        # Set the MFCs
+        total_flow = self.control_data['params']['flowRate']
+        await self.hg.set_flow_rates({self.control['dry_mfc']: total_flow*(1-control),
+                                      self.control['humid_mfc']: total_flow*control})
+
+    def add_jobs(self, scheduler):
+        """
+        Adds the control loop and the acquisition of every device to a scheduler, named <chamber id>/<job>.
+        The control loop runs at the loop frequency, ahead of the acquisition jobs due at the same time.
+        """
+        scheduler.add_job(f"{self.id}/control_loop", self.control_loop, self.loop_freq_hz, priority=1)
+        for daq_key in self.daq_instances.keys():
+            schedule = self.schedule.get(daq_key, {})
+            scheduler.add_job(f"{self.id}/{daq_key}", self.make_acquisition_job(daq_key),
+                              schedule.get('rate_hz', self.loop_freq_hz), schedule.get('priority', 2))
+
+
+def load_chambers(config_path, defaults=None, simulate=False):
+    """
+    Loads the chambers of a config file, see chambers.json.
+
+    Parameters:
+    config_path (str): Path of the config file.
+    defaults (dict, optional): Default settings of the chambers. Default is None.
+    simulate (bool, optional): Use simulated hardware for all chambers. Default is False.
+
+    Returns:
+        dict: The chambers, keyed by chamber id, in the order of the config file.
+    """
+    with open(config_path) as f:
+        config = json.load(f)
+    if len(config.get('chambers', {})) == 0:
+        raise ValueError(f"{config_path}: no chambers defined")
+
+    boards = {}     # Arduino boards, shared by the chambers with sensors on the same board
+    chambers = {chamber_id: Chamber(chamber_id, chamber_config, defaults, boards, simulate)
+                for chamber_id, chamber_config in config['chambers'].items()}
+    assign_buses(chambers.values())
+    return chambers
+
+
+def assign_buses(chambers):
+    """
+    Puts the devices given the same port in the config, e.g. Alicat units on a multi-drop line, on a
+    shared bus, so they are fetched and set one at a time (see HardwareGroup.fetch_device).  Devices
+    with a port of their own are not locked.  The humidity sensors of a board are not concerned, their
+    reads are coordinated by HumiditySensorInterface.
+
+    Parameters:
+    chambers (iterable): The chambers, devices of different chambers may share a port.
+    """
+    daqs_by_port = {}
+    for chamber in chambers:
+        for daq_key, port in chamber.config_ports.items():
+            daqs_by_port.setdefault(port, []).append(chamber.daq_instances[daq_key])
+    for port, daqs in daqs_by_port.items():
+        for daq in daqs:
+            daq.bus = port if len(daqs) > 1 else None
@@ -0,0 +1,95 @@
+import time
+import numpy as np
+from datetime import datetime, timezone
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"    # Format of the datetimes of the save files, in local time
+
+
+# Define a class for the clock of the samples.  Timestamps are UNIX times [s] as floats, taken from
+# the monotonic clock and anchored once to the wall clock: the wall time of the anchor plus the
+# monotonic time since it.  They never go backwards when the system clock is adjusted, and the
+# samples of all the devices share the same clock, so their times can be compared exactly.
+# Strings are only made from them when exporting or displaying, see format_timestamps.
+class Clock:
+    def __init__(self):
+        self.set_anchor()
+
+    def set_anchor(self):
+        # Read the two clocks as close together as possible
+        self.monotonic_anchor_s = time.monotonic()
+        self.wall_anchor_s = time.time()
+
+    def now(self):
+        """
+        Returns:
+            float: The current timestamp [s].
+        """
+        return self.wall_anchor_s + (time.monotonic() - self.monotonic_anchor_s)
+
+    def anchor(self):
+        """
+        Returns:
+            dict: The anchor of the clock and how far the wall clock has drifted from the clock since [s],
+                  e.g. to record with a run.
+        """
+        return {'wall_s': self.wall_anchor_s, 'monotonic_s': self.monotonic_anchor_s,
+                'drift_s': time.time() - self.now()}
+
+
+CLOCK = Clock()     # Clock of all the samples of the process
+
+
+def _utc_offsets_s(timestamps):
+    # UTC offset of the local time zone at each timestamp [s].  Time zones change their offset on
+    # quarter hours, so it is computed once per quarter hour spanned by the timestamps
+    quarters, inverse = np.unique(np.floor(timestamps / 900), return_inverse=True)
+    return np.array([_local_offset_s(quarter*900) for quarter in quarters.tolist()])[inverse]
+
+
+def _local_offset_s(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).astimezone().utcoffset().total_seconds()
+
+
+def format_timestamps(timestamps):
+    """
+    Formats timestamps as local datetimes (DATETIME_FORMAT), all at once.
+
+    Parameters:
+    timestamps (numpy.ndarray): Timestamps [s].
+
+    Returns:
+        numpy.ndarray: The datetime strings.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    if len(timestamps) == 0:
+        return np.empty(0, dtype=str)
+    local_us = np.round((timestamps + _utc_offsets_s(timestamps)) * 1e6).astype('datetime64[us]')
+    return np.char.replace(np.datetime_as_string(local_us, unit='us'), 'T', ' ')
+
+
+def format_timestamp(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime(DATETIME_FORMAT)
+
+
+def parse_datetimes(datetimes):
+    """
+    Parses local datetimes (DATETIME_FORMAT) to timestamps, all at once.
+
+    Parameters:
+    datetimes (list): The datetime strings.
+
+    Returns:
+        numpy.ndarray: The timestamps [s].
+    """
+    if len(datetimes) == 0:
+        return np.empty(0)
+    naive_s = np.array([dt.replace(' ', 'T') for dt in datetimes], dtype='datetime64[us]').astype(np.float64) / 1e6
+    utc_offset_s = _local_timestamp(datetimes[0]) - naive_s[0]
+    if _local_timestamp(datetimes[-1]) - naive_s[-1] != utc_offset_s:
+        # The datetimes span a daylight saving time change
+        return np.array([_local_timestamp(dt) for dt in datetimes])
+    return naive_s + utc_offset_s
+
+
+def _local_timestamp(dt):
+    return datetime.strptime(dt, DATETIME_FORMAT).timestamp()
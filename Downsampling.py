@@ -0,0 +1,86 @@
+import numpy as np
+
+
+def lttb_indices(x, ys, n_out):
+    """
+    Selects the samples to keep to downsample series with Largest-Triangle-Three-Buckets.
+    The first and last samples are kept; the others are split into n_out - 2 buckets and, in each
+    bucket, the sample forming the largest triangle with the sample kept in the previous bucket
+    and the mean of the next bucket is kept.  This preserves the peaks and the shape of the series,
+    unlike keeping every n-th sample.
+
+    The buckets are walked in order, since each choice depends on the previous one, but every bucket
+    is computed for all the series at once.  Empty (NaN) values are never preferred.
+
+    Parameters:
+    x (numpy.ndarray): Sample times, increasing, shape (n,).
+    ys (numpy.ndarray): Values of one or more series sharing the times, shape (n,) or (n_series, n).
+    n_out (int): Number of samples to keep per series, at least 3.
+
+    Returns:
+        numpy.ndarray: Indices of the samples kept for each series, shape (n_series, n_out),
+                       or all the indices if there are n_out samples or fewer.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    ys = np.atleast_2d(np.asarray(ys, dtype=np.float64))
+    n = len(x)
+    n_series = ys.shape[0]
+    if n_out >= n or n_out < 3:
+        return np.tile(np.arange(n), (n_series, 1))
+
+    # Bucket i covers the samples [edges[i], edges[i+1]), the first and last samples have their own buckets
+    edges = np.concatenate(([0], np.floor(np.linspace(1, n - 1, n_out - 1)).astype(np.int64), [n]))
+
+    # Mean of each bucket, ignoring the empty values
+    finite = np.isfinite(ys)
+    sums = np.add.reduceat(np.where(finite, ys, 0), edges[:-1], axis=1)
+    counts = np.add.reduceat(finite, edges[:-1], axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_y = sums / counts
+    mean_x = np.add.reduceat(x, edges[:-1]) / np.diff(edges)
+
+    rows = np.arange(n_series)
+    indices = np.empty((n_series, n_out), dtype=np.int64)
+    indices[:, 0] = 0
+    indices[:, -1] = n - 1
+    for i in range(1, n_out - 1):
+        start, stop = edges[i], edges[i+1]
+        a = indices[:, i-1]
+        x_a, y_a = x[a], ys[rows, a]
+        x_c, y_c = mean_x[i+1], mean_y[:, i+1]
+
+        # Twice the area of the triangle (a, j, c) for every sample j of the bucket, of every series
+        areas = np.abs((x_a - x_c)[:, None] * (ys[:, start:stop] - y_a[:, None])
+                       - (x_a[:, None] - x[None, start:stop]) * (y_c - y_a)[:, None])
+        areas[~np.isfinite(areas)] = -1
+        indices[:, i] = start + np.argmax(areas, axis=1)
+    return indices
+
+
+def downsample(timestamps, columns, n_out):
+    """
+    Downsamples the columns of a DAQ (see RingBuffer.read) to at most n_out samples with LTTB.
+    The budget is split between the numeric columns: each keeps n_out // (number of numeric columns)
+    samples, and the samples kept for any of them are kept for all, so the columns still share one
+    time axis and there are never more than n_out samples.  If the budget is too small for LTTB
+    (fewer than 3 samples per column), evenly spaced samples are kept instead.
+
+    Parameters:
+    timestamps (numpy.ndarray): Sample times.
+    columns (dict): Value columns, keyed by value key.
+    n_out (int): Maximum number of samples to keep.
+
+    Returns:
+        tuple: (timestamps, columns) of the samples kept.
+    """
+    if n_out is None or len(timestamps) <= n_out:
+        return timestamps, columns
+
+    numeric = [column for column in columns.values() if column.dtype == np.float64]
+    per_column = n_out // len(numeric) if len(numeric) > 0 else 0
+    if per_column < 3:
+        # Nothing to preserve the shape of, or too few samples to, keep evenly spaced samples
+        keep = np.unique(np.linspace(0, len(timestamps) - 1, max(n_out, 1)).astype(np.int64))
+    else:
+        keep = np.unique(lttb_indices(timestamps, np.stack(numeric), per_column))
+    return timestamps[keep], {key: column[keep] for key, column in columns.items()}
@@ -1,39 +1,66 @@
 import random
 import time
-from datetime import datetime
 import asyncio
-import queue
 import math
 import logging
-from alicat import FlowController
+import functools
+import contextlib
+import bisect
+import threading
 from HumiditySensorInterface import HumiditySensorInterface
 import sys
 import numpy as np
-import sympy as sp
-import simple_pid
 import serial
 from PX409 import PX409
+from RingBuffer import RingBuffer
+from Clock import CLOCK, format_timestamp
+from Downsampling import downsample
+from Recorder import Recorder, CSVSink, BinarySink
+from Metrics import REGISTRY
+import Simulation
+
+# Metrics of the hardware hot paths, exposed on /metrics
+TRACK_DATA_SECONDS = REGISTRY.histogram('lac_track_data_seconds', 'Duration of DAQ._track_data.', ['daq_type'])
+DEVICE_FETCH_SECONDS = REGISTRY.histogram('lac_device_fetch_seconds', 'Duration of the fetch_data of each device.', ['device'])
+DEVICE_ERRORS = REGISTRY.counter('lac_device_errors_total', 'Failed fetches of each device, by reason.', ['device', 'reason'])
+DEVICE_DISCONNECTS = REGISTRY.counter('lac_device_disconnects_total', 'Devices found disconnected by a fetch.', ['device'])
+COMMANDS_SECONDS = REGISTRY.histogram('lac_flask_commands_seconds', 'Duration of HardwareGroup.run_flask_commands.')
+COMMANDS_TOTAL = REGISTRY.counter('lac_flask_commands_total', 'Flask commands, by outcome (run, collapsed, refused, failed).', ['outcome'])
 
 
 # Define a class to represent a generic Data Aquisition component.  
 # This class handles the data acquisition and storage for the component. 
-# Only the most recent 10 000 data points are stored in the data queue, 
-# the rest will be written to a file, if selected.
+# Only the most recent data points (window_size, 10 000 by default) are stored in the
+# data buffer, the rest will be written to a file, if selected.
 class DAQ:
     start_time = -1
+    bus = None      # Port shared with other devices, which are then fetched and set one at a time; None if not shared
+    window_size = 10000     # Default number of samples kept in the data buffer
+    recorder = None         # Recorder writing the save files, created on first use. Can be set per DAQ, e.g. per chamber
 
-    def __init__(self):
+    # Version of the data of all DAQs, increased whenever any DAQ tracks data. Readers
+    # such as the live data stream wait on the condition for it to change
+    data_version = 0
+    data_condition = threading.Condition()
+
+    def __init__(self, window_size=None):
         # If the start time has not been set, set it for all components
         if DAQ.start_time == -1:
-            DAQ.start_time = time.time()
+            DAQ.start_time = time.monotonic()
 
-        self.data_queue = queue.Queue(10000)
+        # Columnar sliding window of the most recent samples
+        self.data_buffer = RingBuffer(window_size or DAQ.window_size)
+        self.pop_cursor = 0     # Cursor of the first sample not yet returned by pop_data_queue
         self.save_file = None
         self.port = None
         self.is_connected = False
 
+        # Latest sample tracked, (timestamp, values), replaced as a whole by _track_data so readers
+        # always see a consistent sample without locking.  None until the first sample
+        self.latest = None
+
     def reset_start_time(self):
-        DAQ.start_time = time.time()
+        DAQ.start_time = time.monotonic()
 
     async def fetch_data(self):
         """
@@ -52,62 +79,177 @@ class DAQ:
         
     def _track_data(self, data):
         """
-        Track and save data to a queue and optionally to a file.
-        If it is full, the oldest data will be removed
+        Track and save data to the data buffer and optionally to a file.
+        If it is full, the oldest data will be overwritten
 
         Args:
             data (dict): A dictionary containing the data to be tracked. It should have the following keys:
-                - datetime: The datetime of the data.
+                - time (optional): The timestamp of the data from CLOCK [s], now if missing.
                 - values: A dictionary containing the values to be tracked.
 
         Returns:
             None
         """
-        if self.data_queue.qsize() >= self.data_queue.maxsize:
-            self.data_queue.get_nowait()
-        self.data_queue.put_nowait(data)
-
-        # Save the data to a file if selected
-        if self.save_file is not None:
-            # Check if the file is empty, if so, write the header
-            if self.save_file.tell() == 0:
-                header_line = 'datetime,' + ','.join(data['values'].keys())
-                self.save_file.write(header_line + '\n')
-            # Write the data to the file
-            data_line = f"{data['datetime']}," + ','.join([str(v) for v in data['values'].values()])
-            self.save_file.write(data_line + '\n')
+        with TRACK_DATA_SECONDS.time(type(self).__name__):
+            timestamp = data.get('time') or CLOCK.now()
+            self.data_buffer.append(timestamp, data['values'])
+            self.latest = (timestamp, dict(data['values']))
+
+            # Hand the data to the recorder to be saved to a file if selected
+            if self.save_file is not None:
+                self.recorder.submit(self.save_file, timestamp, data['values'])
+
+            # Wake up the readers waiting for new data
+            with DAQ.data_condition:
+                DAQ.data_version += 1
+                DAQ.data_condition.notify_all()
+
+    def get_latest(self, max_age_s=None):
+        """
+        Gets the latest sample tracked, without any hardware I/O or reading the data buffer.
+
+        Parameters:
+        max_age_s (float, optional): Age over which the sample is no longer valid [s]. Default is None, any age.
+
+        Returns:
+            dict: {'time': UNIX timestamp [s], 'age_s': age of the sample [s], 'values': dict, 'valid': bool}.
+                  The sample is valid if the DAQ is connected and it is not older than max_age_s.
+                  time and age_s are None and values is empty if no sample was tracked yet.
+        """
+        latest = self.latest
+        if latest is None:
+            return {'time': None, 'age_s': None, 'values': {}, 'valid': False}
+
+        timestamp, values = latest
+        age_s = CLOCK.now() - timestamp
+        return {'time': timestamp, 'age_s': age_s, 'values': dict(values),
+                'valid': self.is_connected and (max_age_s is None or age_s <= max_age_s)}
+
+    @staticmethod
+    def wait_for_data(version, timeout):
+        """
+        Waits until any DAQ tracks data after a given data version.
+
+        Parameters:
+        version (int): The last data version seen by the reader.
+        timeout (float): Maximum time to wait [s].
+
+        Returns:
+            int: The current data version, equal to version if the wait timed out.
+        """
+        with DAQ.data_condition:
+            DAQ.data_condition.wait_for(lambda: DAQ.data_version != version, timeout)
+            return DAQ.data_version
     
-    # Function to set the save file location
-    def set_save_file(self, file_path):
+    # Function to set the save file location, file_format is 'csv' or 'binary'
+    def set_save_file(self, file_path, file_format='csv'):
         if not self.is_connected:
             return
-        self.save_file = open(file_path, 'w')
-        logging.info(f"Opened save file at {file_path}")
+        if self.recorder is None:
+            DAQ.recorder = Recorder()
+
+        # Write the header right away if the value keys are known from the data buffer
+        if file_format == 'binary':
+            # Only numeric columns are recorded in binary files
+            columns = [key for key, column in self.data_buffer.columns.items() if column.dtype == np.float64]
+            self.save_file = self.recorder.open(BinarySink(file_path, columns=columns))
+        else:
+            self.save_file = self.recorder.open(CSVSink(file_path, columns=list(self.data_buffer.columns)))
 
     # Function to close the save file
     def close_save_file(self):
         if self.save_file is None:
             return
         
-        self.save_file.close()
-        logging.info(f"Closed save file at {self.save_file.name}")
-        self.save_file = None
+        save_file, self.save_file = self.save_file, None
+        self.recorder.close(save_file)
         
-    # Function to get all the data from the data queue
+    def read_data(self, cursor=None, since=None, until=None, points=None):
+        """
+        Reads the samples newer than a cursor or a timestamp, without removing them,
+        so any number of readers can follow the same DAQ.
+
+        Parameters:
+        cursor (int, optional): Cursor returned by the previous read. Default is None.
+        since (float, optional): Only return samples taken after this UNIX timestamp [s]. Default is None.
+        If neither is given, all the samples in the data buffer are returned.
+        until (float, optional): Only return samples taken up to this UNIX timestamp [s]. Default is None.
+        points (int, optional): Downsample to at most this many samples with LTTB, see Downsampling.py. Default is None.
+
+        Returns:
+            tuple: (data, cursor), the samples in the format of pop_data_queue and the cursor to pass to the next read.
+        """
+        timestamps, columns, next_cursor = self._read(cursor, since, until, points)
+        return self._to_records(timestamps, columns), next_cursor
+
+    def read_columns(self, cursor=None, since=None, until=None, points=None):
+        """
+        Reads the samples newer than a cursor or a timestamp in columnar form, without removing them.
+        Same as read_data, but the key names are not repeated for every sample.
+
+        Parameters:
+        cursor (int, optional): Cursor returned by the previous read. Default is None.
+        since (float, optional): Only return samples taken after this UNIX timestamp [s]. Default is None.
+        until (float, optional): Only return samples taken up to this UNIX timestamp [s]. Default is None.
+        points (int, optional): Downsample to at most this many samples with LTTB, see Downsampling.py. Default is None.
+
+        Returns:
+            dict: {'time': array of UNIX timestamps [s], 'values': one array per value key, 'cursor': cursor for the next read}.
+                  The arrays are copies, encoded directly by Serialization.  Values missing from a sample are NaN
+                  (None in non-numeric columns), encoded as null.
+        """
+        timestamps, columns, next_cursor = self._read(cursor, since, until, points)
+        return {'time': timestamps, 'values': columns, 'cursor': next_cursor}
+
+    def _read(self, cursor, since, until, points):
+        # Copies of the samples to return, downsampled if asked, and the cursor for the next read
+        stop = None if until is None else self.data_buffer.cursor_at(until)
+        timestamps, columns, _, next_cursor = self.data_buffer.read(self._start_cursor(cursor, since), stop, copy=True)
+        timestamps, columns = downsample(timestamps, columns, points)
+        return timestamps, columns, next_cursor
+
+    def _start_cursor(self, cursor, since):
+        # Cursor of the first sample to read, from a cursor or a timestamp
+        if cursor is not None:
+            return cursor
+        if since is not None:
+            return self.data_buffer.cursor_at(since)
+        return 0
+
+    # Function to get all the data that has not been popped yet from the data buffer
     def pop_data_queue(self):
-        data = []
-        # Retrieve all data from the queue without removing it
-        while self.data_queue.qsize() > 0:
-            data.append(self.data_queue.get_nowait())
+        timestamps, columns, _, self.pop_cursor = self.data_buffer.read(self.pop_cursor, copy=True)
+        return self._to_records(timestamps, columns)
 
+    @staticmethod
+    def _to_records(timestamps, columns):
+        """
+        Converts columns from the data buffer to a list of samples, in the format the data was tracked:
+        {'time': UNIX timestamp [s], 'values': dict}.  Empty values are left out.
+        """
+        columns = {key: column.tolist() for key, column in columns.items()}
+        data = []
+        for i, timestamp in enumerate(timestamps.tolist()):
+            values = {key: column[i] for key, column in columns.items()
+                      if column[i] is not None and column[i] == column[i]}   # NaN != NaN
+            data.append({'time': timestamp, 'values': values})
         return data
     
 class MFC (DAQ):
-    def __init__(self):
+    def __init__(self, deadband=0.05, merge_window_s=0.5):
         super().__init__()
         self.port = ""
 
         self.is_connected = False
+
+        # Command layer settings
+        self.deadband = deadband                # Flow rate changes smaller than this are not written [sccm]
+        self.merge_window_s = merge_window_s    # Age under which the state returned by a set replaces a get [s], e.g. the period of the acquisition job
+        self.flow_setpoint = None               # Last flow rate written to the MFC
+        self.merged_data = None                 # Data returned by the last set, not yet used by fetch_data
+        self.merged_time = 0
+        self.set_done = None                    # Event of the set in flight, if any; fetch_data waits for it
+        self.reads = {'get': 0, 'merged': 0}    # Number of reads sent to the MFC and replaced by the state of a set
         
     # Attempts a connection to the MFC
     async def connect(self, port):
@@ -118,8 +260,13 @@ class MFC (DAQ):
             bool: True if the connection is successful, False otherwise.
         """
         self.port = port
+        self.flow_setpoint = None
         try:
-            self.fc = FlowController(address=self.port)
+            if Simulation.is_simulated(self.port):
+                self.fc = Simulation.SIMULATOR.flow_controller(self.port)
+            else:
+                from alicat import FlowController   # Imported on first use, to start faster
+                self.fc = FlowController(address=self.port)
             message = "Connected to MFC on port " + self.port
             self.is_connected = True
             logging.info(f"Connected to MFC on port {self.port} \n{'':20} {self.fc}")
@@ -136,6 +283,8 @@ class MFC (DAQ):
         Fetches data from the connected MFC. 
         fc.get() takes ~200ms to complete, with SD of 5ms. This is the 
         bottleneck in this function and takes the most time; the rest of the function is negligible.
+        If a set_flow_rate returned the state of the MFC within merge_window_s, or one is in
+        flight, that state is used instead and no request is sent.
 
         Returns:
             bool: True if data is fetched successfully, False otherwise.
@@ -143,18 +292,34 @@ class MFC (DAQ):
         if not self.is_connected:
             return False
 
+        # Wait for the set in flight, its reply is the state of the MFC
+        set_done = self.set_done
+        if set_done is not None and not set_done.is_set():
+            await set_done.wait()
+
+        # Use the state returned by the last set, it is already tracked
+        if self.merged_data is not None and time.monotonic() - self.merged_time < self.merge_window_s:
+            data, self.merged_data = self.merged_data, None
+            self.reads['merged'] += 1
+            return data
+
         try:
+            self.reads['get'] += 1
             fc_result = await self.fc.get()
         except Exception as e:
             logging.error("MFC, fetch_data", e)
             self.is_connected = False
             return False
-        dt = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")  # Get current datetime
+
+        return self._track_state(fc_result)
+
+    def _track_state(self, fc_result):
+        timestamp = CLOCK.now()
 
         # Remove the 'control_point' and 'gas' keys from the result
         fc_result.pop('control_point', None)
         fc_result.pop('gas', None)
-        data = {'datetime': dt, 'values': fc_result}
+        data = {'time': timestamp, 'values': fc_result}
 
         # Put the data into the data queue for a sliding window
         self._track_data(data)
@@ -162,39 +327,97 @@ class MFC (DAQ):
         return data
 
     # Set the flow rate of the MFC
-    async def set_flow_rate(self, flow_rate):
+    async def set_flow_rate(self, flow_rate, force=False):
         """
         Sets the flow rate of the hardware. fc.set_flow_rate() takes ~200ms to complete, with SD of 3ms.
+        Changes smaller than the deadband are not written, unless forced.  When the MFC controls
+        the flow, the state it returns with the setpoint is tracked, replacing the next get.
 
         Parameters:
         - flow_rate: The desired flow rate to be set.
+        - force: Write the flow rate even if it is within the deadband of the last one.
 
         Returns:
-        - True if the flow rate is successfully set, False otherwise.
+        - True if the flow rate is successfully set (or within the deadband), False otherwise.
         """
         if not self.is_connected:
             return False
+        if not force and self.flow_setpoint is not None and abs(flow_rate - self.flow_setpoint) < self.deadband:
+            return True
+
+        set_done = self.set_done = asyncio.Event()
         try:
-            await self.fc.set_flow_rate(flow_rate)
-        except Exception as e:
-            logging.error("MFC, set_flow_rate", e)
+            if self.fc.control_point in ['mass flow', 'vol flow']:
+                try:
+                    state = await self._set_flow_rate_and_get(flow_rate)
+                except (ValueError, KeyError, AttributeError) as e:
+                    # The reply is not a data frame in the expected format, e.g. a totalizer frame or
+                    # before the keys are known: set and get separately
+                    logging.warning(f"MFC, set_flow_rate: setting and getting separately, port {self.port}\n{'':<20}Error: {e!r}")
+                    await self.fc.set_flow_rate(flow_rate)
+                    state = await self.fc.get()
+                self.merged_data = self._track_state(state)
+                self.merged_time = time.monotonic()
+            else:
+                await self.fc.set_flow_rate(flow_rate)
+        except (OSError, asyncio.TimeoutError) as e:
+            # The MFC does not answer (serial errors are OSErrors)
+            logging.error(f"MFC, set_flow_rate\n{'':<20}Error: {e!r}")
             self.is_connected = False
             return False
+        except Exception as e:
+            # The MFC answered, but not as expected: it is still connected
+            logging.error(f"MFC, set_flow_rate, port {self.port}\n{'':<20}Error: {e!r}")
+            return False
+        finally:
+            set_done.set()
+        self.flow_setpoint = flow_rate
         logging.info(f"Set MFC flow rate to {flow_rate:.2f}, port {self.port}")
         return True
 
+    async def _set_flow_rate_and_get(self, flow_rate):
+        """
+        Writes the setpoint and returns the state of the MFC.  The Alicat answers a setpoint
+        command with the same data frame as a poll, so the state comes with the write.
+
+        Returns:
+            dict: The state of the MFC, in the format of fc.get().
+
+        Raises:
+            OSError: If the MFC does not answer or does not take the setpoint.
+            ValueError, KeyError, AttributeError: If the reply or the driver is not in the expected
+                format; the setpoint may have been written, see set_flow_rate.
+        """
+        line = await self.fc._write_and_read(f'{self.fc.unit}S{flow_rate:.2f}')
+        if not line:
+            raise OSError("Could not set setpoint.")
+
+        # Parse the data frame like FlowMeter.get()
+        unit, values = line.split()[0], line.split()[1:]
+        while values[-1].upper() in ['MOV', 'VOV', 'POV', 'TOV', 'LCK']:
+            del values[-1]
+        if unit != self.fc.unit or len(values) != len(self.fc.keys):
+            raise ValueError(f"Unexpected MFC response: {line}")
+        state = {}
+        for key, value in zip(self.fc.keys, values):
+            try:
+                state[key] = float(value)
+            except ValueError:
+                state[key] = value
+
+        if abs(state['setpoint'] - flow_rate) > 0.01:
+            raise OSError("Could not set setpoint.")
+        return state
+
 class HumiditySensor(DAQ):
-    HSI = None
-    
     def __init__(self, HSI):
         super().__init__()
         self.port = None
 
         self.is_connected = False
 
-        #Save the interface with humidity sensors
-        if HumiditySensor.HSI is None:
-            HumiditySensor.HSI = HSI
+        #Save the interface with humidity sensors, i.e. the Arduino board the sensor is attached to
+        self.HSI = HSI
         
     # Attempts a connection to the Sensor
     async def connect(self, port):
@@ -210,8 +433,8 @@ class HumiditySensor(DAQ):
         # Try to connect to the sensor
         try:
             logging.info("Attempting connection to SENSOR")
-            HumiditySensor.HSI.add_sensor_addr([self.port])
-            HumiditySensor.HSI.get_data(self.port) #This is to check if the sensor is connected, throws TimeoutError if not
+            self.HSI.add_sensor_addr([self.port])
+            await self.HSI.get_data_batched(self.port) #This is to check if the sensor is connected, throws an Exception if not
             message = f"Connected to Sensor with address {hex(self.port)}"
             self.is_connected = True
         except Exception as e:
@@ -235,15 +458,14 @@ class HumiditySensor(DAQ):
             return False
 
         try:
-            result = HumiditySensor.HSI.get_data(self.port)
+            # Read with the other sensors of the board polled at the same time, in one exchange
+            result = await self.HSI.get_data_batched(self.port)
         except Exception as e:
             logging.error("HumiditySensor, fetch_data", e)
             if str(e).find("not connected") > 0:
                 self.is_connected = False
             return False
-        dt = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")  # Get current datetime
-
-        data = {'datetime': dt, 'values': result}
+        data = {'time': CLOCK.now(), 'values': result}
 
         # Put the data into the data queue for a sliding window
         self._track_data(data)
@@ -258,9 +480,9 @@ class PressureSensor(DAQ):
         self.px = PX409()
 
     # Attempts a connection to the Sensor
-    def connect(self, port):
+    async def connect(self, port):
         """
-        Attempts a connection to the flow controller.
+        Attempts a connection to the pressure sensor.
 
         Returns:
             bool: True if the connection is successful, False otherwise.
@@ -270,7 +492,7 @@ class PressureSensor(DAQ):
         # Try to connect to the sensor
         try:
             logging.info("Attempting connection to PRESSURE SENSOR.")
-            self.px.connect(self.port)
+            await self.px.connect_async(self.port)
             message = f"Connected to Sensor on port {self.port}"
             self.is_connected = True
         except serial.serialutil.SerialException:
@@ -292,14 +514,16 @@ class PressureSensor(DAQ):
             return False
 
         try:
-            result = self.px.get_pressure()
+            result = await self.px.get_pressure_async()
+        except asyncio.TimeoutError:
+            # A missed response, the other requests are not affected
+            logging.error(f"PressureSensor, fetch_data: no response within {self.px.request_timeout_s}s")
+            return False
         except Exception as e:
-            logging.error("PressureSensor, fetch_data", e)
+            logging.error(f"PressureSensor, fetch_data\n{'':<20}Error: {e}")
             self.is_connected = False
             return False
-        dt = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")  # Get current datetime
-
-        data = {'datetime': dt, 'values': {'pressure': result}}
+        data = {'time': CLOCK.now(), 'values': {'pressure': result}}
 
         # Put the data into the data queue for a sliding window
         self._track_data(data)
@@ -321,9 +545,8 @@ class DummyDAQ(DAQ):
         """
         await asyncio.sleep(random.uniform(0.01, 0.05))
 
-        timestamp = time.time() - DAQ.start_time
-        dt = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
-        data = {'datetime': dt, 
+        timestamp = time.monotonic() - DAQ.start_time
+        data = {'time': CLOCK.now(),
             'values': {'y1': 20*math.sin(2*math.pi*self.freq * timestamp) + 20, 'y2': 20*math.cos(2*math.pi*self.freq * timestamp) +20}}
         
         # Put the data into the data queue for a sliding window
@@ -344,76 +567,346 @@ class DummyDAQ(DAQ):
         
         return [self.is_connected, "Connected to DUMMYDAQ"]
 
+# Define a class to pass commands from the Flask threads to the hardware loop.
+# Commands are collapsed per device and action: a new command replaces the queued command with
+# the same key, so only the latest value runs (e.g. dragging a slider).  The channel holds at
+# most max_size commands; when it is full, new commands are refused.  Adding a command wakes the
+# hardware loop with call_soon_threadsafe, as asyncio objects can only be used from their loop.
+class CommandChannel:
+    def __init__(self, max_size=100):
+        self.max_size = max_size
+        self.commands = {}          # Queued (func, params), keyed by command key, oldest first
+        self.lock = threading.Lock()
+        self.collapsed = 0          # Number of commands replaced by a newer one
+        self.refused = 0            # Number of commands refused because the channel was full
+
+        # Set by bind, from the hardware loop
+        self.loop = None
+        self.wakeup = None
+
+    @staticmethod
+    def command_key(func):
+        # Commands on the same object (device) with the same function (action) collapse
+        return (id(getattr(func, '__self__', None)), func.__name__)
+
+    def bind(self, loop):
+        """
+        Binds the channel to the event loop that runs the commands. Must be called from that loop.
+        """
+        # The event is created before the loop is published, put only uses it once the loop is set
+        self.wakeup = asyncio.Event()
+        self.loop = loop
+        if not self.empty():
+            self.wakeup.set()
+
+    def put(self, func, params, key=None):
+        """
+        Queues a command, from any thread.
+
+        Parameters:
+        func (function): The function to run, a coroutine function or a normal function.
+        params (dict): Keyword arguments of the function.
+        key (hashable, optional): Commands with the same key collapse. Default is None, from the device and function.
+
+        Returns:
+            bool: True if the command was queued, False if the channel is full.
+        """
+        key = self.command_key(func) if key is None else key
+        with self.lock:
+            if key in self.commands:
+                del self.commands[key]
+                self.collapsed += 1
+                COMMANDS_TOTAL.inc('collapsed')
+            elif len(self.commands) >= self.max_size:
+                self.refused += 1
+                COMMANDS_TOTAL.inc('refused')
+                return False
+            self.commands[key] = (func, params)
+
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+        return True
+
+    def take_all(self):
+        """
+        Removes and returns all the queued commands, oldest first.
+        """
+        with self.lock:
+            commands = list(self.commands.values())
+            self.commands.clear()
+        return commands
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def qsize(self):
+        with self.lock:
+            return len(self.commands)
+
+    async def wait(self):
+        # Wait until a command is queued
+        await self.wakeup.wait()
+        self.wakeup.clear()
+
 class HardwareGroup:
-    def __init__(self, daq_instances, max_list_length):
+    # One lock per shared bus, keyed by port.  Shared by the groups of all the chambers, which run
+    # in the same event loop, since devices of several chambers may share a port
+    bus_locks = {}
+
+    def __init__(self, daq_instances, max_list_length, concurrent=True, device_timeout_s=2, max_commands=100, name=''):
+        self.name = name            # Prefix of the device labels of the metrics, e.g. the chamber
         self.daq_instances = daq_instances
         self.daq_lists = {}
         self.max_list_length = max_list_length
 
-        self.flask_command_queue = asyncio.Queue()
+        # Concurrent acquisition settings
+        self.concurrent = concurrent                # Fetch all DAQs at once instead of one after another
+        self.device_timeout_s = device_timeout_s    # Maximum time a single DAQ may take to fetch its data
 
-    def add_flask_command(self, func, params):
-        self.flask_command_queue.put_nowait( (func, params) )
+        self.flask_command_queue = CommandChannel(max_commands)
+
+    def add_flask_command(self, func, params, key=None):
+        """
+        Queues a command for the hardware loop, from any thread.  Replaces the queued command
+        of the same device and action.
+
+        Returns:
+            bool: True if the command was queued, False if the command queue is full.
+        """
+        return self.flask_command_queue.put(func, params, key)
 
     # Worker function to run commands in the queue
     async def _worker(self, func, kwargs):
         if asyncio.iscoroutinefunction(func):
-            await func(**kwargs)
+            # Commands on a device wait for the other devices on its bus
+            async with self._bus_lock(getattr(func, '__self__', None)):
+                await func(**kwargs)
         else:
             loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, func, kwargs)
+            await loop.run_in_executor(None, functools.partial(func, **kwargs))
 
     async def run_flask_commands(self):
         # Run all commands in the queue in parallel by assigning workers
-        tasks = []
-        for _ in range(self.flask_command_queue.qsize()):
-            func, params = await self.flask_command_queue.get()
-            tasks.append( self._worker(func, params) )
-            logging.info(f"Working: {func.__name__} with params {params}")
-            self.flask_command_queue.task_done()
-        # Await all tasks to complete
-        await asyncio.gather(*tasks)
+        with COMMANDS_SECONDS.time():
+            tasks = []
+            commands = self.flask_command_queue.take_all()
+            for func, params in commands:
+                tasks.append( self._worker(func, params) )
+                logging.info(f"Working: {func.__name__} with params {params}")
+            COMMANDS_TOTAL.inc('run', amount=len(tasks))
+            # Await all tasks to complete, a failing command does not stop the others
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            for (func, params), result in zip(commands, results):
+                if isinstance(result, Exception):
+                    COMMANDS_TOTAL.inc('failed')
+                    logging.error(f"Command {func.__name__} with params {params} failed\n{'':<20}Error: {result!r}")
+
+    async def command_worker(self):
+        """
+        Runs the Flask commands as soon as they are queued, until cancelled.
+        Must run in the hardware loop.
+        """
+        self.flask_command_queue.bind(asyncio.get_running_loop())
+        while True:
+            await self.flask_command_queue.wait()
+            await self.run_flask_commands()
+
+    async def set_flow_rates(self, flow_rates, force=False):
+        """
+        Sets the flow rate of many MFCs at once.
+
+        Parameters:
+        flow_rates (dict): The flow rate to set, keyed by MFC key.
+        force (bool, optional): Write the flow rates even if within the deadband of the MFCs. Default is False.
+
+        Returns:
+            dict: The result of set_flow_rate of each MFC, keyed by MFC key.
+        """
+        daq_keys = list(flow_rates.keys())
+        results = await asyncio.gather(*[self._set_flow_rate(self.daq_instances[key], flow_rates[key], force)
+                                         for key in daq_keys])
+        return dict(zip(daq_keys, results))
+
+    async def _set_flow_rate(self, mfc, flow_rate, force):
+        async with self._bus_lock(mfc):
+            return await mfc.set_flow_rate(flow_rate, force=force)
+
+    def _bus_lock(self, daq):
+        """
+        Gets the lock of the bus a DAQ shares with other devices.  The locks are created lazily,
+        so that they belong to the event loop that runs the hardware loop.
+
+        Returns:
+            asyncio.Lock: The lock of the bus, or a context doing nothing if the DAQ does not share its port.
+        """
+        if getattr(daq, 'bus', None) is None:
+            return contextlib.nullcontext()
+        if daq.bus not in HardwareGroup.bus_locks:
+            HardwareGroup.bus_locks[daq.bus] = asyncio.Lock()
+        return HardwareGroup.bus_locks[daq.bus]
+
+    async def fetch_device(self, daq_key):
+        """
+        Fetches data from a single DAQ instance.  Errors and timeouts are contained
+        here, so one misbehaving device does not affect the others.
+
+        Parameters:
+        daq_key (str): The key of the DAQ in daq_instances.
+
+        Returns:
+            The data returned by the DAQ's fetch_data, False if it failed or timed out.
+        """
+        daq = self.daq_instances[daq_key]
+        was_connected = daq.is_connected
+        label = f"{self.name}/{daq_key}" if self.name else daq_key
+        result = False
+        try:
+            with DEVICE_FETCH_SECONDS.time(label):
+                # Wait for the other devices on the bus, if the DAQ shares its port, then fetch
+                async with self._bus_lock(daq):
+                    result = await asyncio.wait_for(daq.fetch_data(), self.device_timeout_s)
+            if result is False and was_connected:
+                DEVICE_ERRORS.inc(label, 'failed')
+        except asyncio.TimeoutError:
+            DEVICE_ERRORS.inc(label, 'timeout')
+            logging.error(f"{label}: fetch_data timed out after {self.device_timeout_s}s")
+        except Exception as e:
+            DEVICE_ERRORS.inc(label, 'exception')
+            logging.error(f"{label}: fetch_data failed\n{'':<20}Error: {e}")
+
+        if was_connected and not daq.is_connected:
+            DEVICE_DISCONNECTS.inc(label)
+        return result
 
     async def fetch_data(self, exclude=None):
         """
         Fetches data from all DAQ instances and pushes it to a list.
+        In concurrent mode all DAQs are fetched at once, so a tick takes about as long as
+        the slowest DAQ.  DAQs sharing a bus are still fetched one at a time, and the humidity sensors
+        of a board are read together by HumiditySensorInterface.
+
+        Parameters:
+        exclude (list, optional): Keys of the DAQs to skip. Default is None.
 
         Returns:
-            None
+            dict: The data returned by each fetched DAQ (False if it failed), keyed by DAQ key.
+        """
+        daq_keys = [key for key in self.daq_instances.keys() if exclude is None or key not in exclude]
+
+        if self.concurrent:
+            results = await asyncio.gather(*[self.fetch_device(key) for key in daq_keys])
+        else:
+            results = [await self.fetch_device(key) for key in daq_keys]
+
+        return dict(zip(daq_keys, results))
+
+EXPRESSION_CACHE_SIZE = 256     # Number of compiled setpoint expressions kept in memory
+
+@functools.lru_cache(maxsize=EXPRESSION_CACHE_SIZE)
+def compile_expression(expr):
+    """
+    Compiles a setpoint expression of time t to a NumPy function.  Compiled expressions are
+    kept in a bounded LRU cache keyed by the expression string, so the same profile is only
+    compiled once.
+
+    Parameters:
+    expr (str): The expression, as a function of t.
+
+    Returns:
+        function: The compiled expression, taking a scalar or an array of t.
+    """
+    import sympy as sp     # Imported on first use, it is the slowest import of the app
+    t = sp.symbols('t')
+    return sp.lambdify(t, sp.sympify(expr), modules='numpy')
+
+# Define a class for an arbitrary setpoint profile.
+# The profile is a sequence of segments, each an expression of the time since the start of the
+# segment [min] that lasts a given duration [min].  Only the compiled expressions and the start
+# time of each segment are kept; the setpoint is evaluated exactly at the query time, finding the
+# segment with a binary search.  Before the start and after the end, the profile holds its first
+# and last value.
+class SetpointProfile:
+    def __init__(self, expression_duration_pairs):
+        self.segments = [(expr, float(duration)) for expr, duration in expression_duration_pairs]
+        if len(self.segments) == 0:
+            raise ValueError("Setpoint profile has no segments.")
+
+        self.functions = [compile_expression(expr) for expr, _ in self.segments]
+
+        # Start time of each segment since the start of the profile [s]
+        self.start_times_s = []
+        self.duration_s = 0
+        for _, duration in self.segments:
+            self.start_times_s.append(self.duration_s)
+            self.duration_s += duration*60
+
+    def __call__(self, time_s):
         """
-        for daq_key in self.daq_instances.keys():
-            if exclude is not None and daq_key in exclude:
-                continue
-            current_data = await self.daq_instances[daq_key].fetch_data()
+        Evaluate the profile at a given time.
+
+        Parameters:
+        time_s (float): The time since the start of the profile [s].
+
+        Returns:
+        float: The setpoint value at the given time, constrained from 0 to 100.
+        """
+        time_s = min(max(time_s, 0), self.duration_s)
+        index = max(bisect.bisect_right(self.start_times_s, time_s) - 1, 0)
+        value = self.functions[index]((time_s - self.start_times_s[index]) / 60)
+        return float(np.clip(value, 0, 100))
+
+    def sample(self):
+        """
+        Samples the profile for previewing, at 60 points per minute.
+
+        Returns:
+        tuple: The time values [min] and the corresponding setpoint values, see HumiditySetpoint.parse_timeseries.
+        """
+        return HumiditySetpoint.parse_timeseries(self.segments)
 
 class HumiditySetpoint(DAQ):
     def __init__(self, PID_gains, sample_time):
         super().__init__()
         self.is_connected = False
         self.setpoint_func = None
+        self.profile = None
         self.time_points = None
         self.setpoints = None
 
-        self.pid = simple_pid.PID(*PID_gains, setpoint=0)
-        self.pid.output_limits = (0,1)    # Output value will be between 0 and 10
-        self.pid.sample_time = sample_time  # PID update interval in seconds
+        self.PID_gains = PID_gains
+        self.sample_time = sample_time
+        self._pid = None
+
+    @property
+    def pid(self):
+        # The PID is created, and simple_pid imported, on first use
+        if self._pid is None:
+            import simple_pid
+            self._pid = simple_pid.PID(*self.PID_gains, setpoint=0)
+            self._pid.output_limits = (0,1)    # Output value will be between 0 and 10
+            self._pid.sample_time = self.sample_time  # PID update interval in seconds
+        return self._pid
 
     def set_setpoint(self, setpoint, time_min=None):
         """
         Set the setpoint function based on the given setpoint values and optional time intervals.
 
         Parameters:
-        setpoint (int, float, list): Setpoint value(s).
+        setpoint (int, float, list, SetpointProfile): Setpoint value(s), or a profile to evaluate.
         time (list, optional): Corresponding time points for the setpoints. Default is None.
         """
+        self.profile = None
         if isinstance(setpoint, (int, float)) and time_min is None:
             self.setpoint_func = lambda t: setpoint
+        elif isinstance(setpoint, SetpointProfile) and time_min is None:
+            self.profile = setpoint
+            self.setpoint_func = setpoint
         elif isinstance(setpoint, list) and isinstance(time_min, list):
-            self.setpoints = setpoint
-            self.time_points = [t*60 for t in time_min]      # Convert minutes to seconds
+            self.setpoints = np.asarray(setpoint, dtype=np.float64)
+            self.time_points = np.asarray(time_min, dtype=np.float64) * 60      # Convert minutes to seconds
             self.setpoint_func = self._piecewise_setpoint
         else:
-            raise ValueError("Invalid input: setpoint must be a single number or a list/array with corresponding time list/array.")
+            raise ValueError("Invalid input: setpoint must be a single number, a SetpointProfile or a list/array with corresponding time list/array.")
 
     def get_setpoint(self, time_s):
         """
@@ -444,7 +937,7 @@ class HumiditySetpoint(DAQ):
         index = np.searchsorted(self.time_points, time_s, side='right') - 1
         if index < 0:
             index = 0
-        return self.setpoints[index]
+        return float(self.setpoints[index])
 
     async def fetch_data(self):
         # Don't output data if not connected. In this case, it means that the setpoint functionality
@@ -452,14 +945,13 @@ class HumiditySetpoint(DAQ):
         if not self.is_connected:
             return False
 
-        timestamp = time.time() - DAQ.start_time
-        dt = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")  # Get current datetime
+        timestamp = time.monotonic() - self.start_time
         try:
             setpoint = self.get_setpoint(timestamp)
         except ValueError as e:
             return False
         
-        data = {'timestamp': timestamp, 'datetime': dt, 'values': {'humidity_setpoint': setpoint}}
+        data = {'timestamp': timestamp, 'time': CLOCK.now(), 'values': {'humidity_setpoint': setpoint}}
 
         self._track_data(data)
         return data
@@ -469,9 +961,9 @@ class HumiditySetpoint(DAQ):
         Use the connection to start the setpoint function
         '''
         self.is_connected = True
-        DAQ.start_time = time.time()
+        self.start_time = time.monotonic()    # Each setpoint runs on its own clock, e.g. one per chamber
         return [self.is_connected, 
-                f"Setpoint definition started at {datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')}"]
+                f"Setpoint definition started at {format_timestamp(CLOCK.now())}"]
     
     def disable(self):
         '''
@@ -501,40 +993,33 @@ class HumiditySetpoint(DAQ):
         expression_duration_pairs (list): A list of tuples where each tuple (expr, dur) contains an expression (string) and its duration (float).
 
         Returns:
-        tuple: A tuple containing two numpy arrays - the time values and the corresponding values generated from the expressions.
+        tuple: A tuple containing two NumPy arrays - the time values [min] and the corresponding values generated from the expressions.
         """
-
-        t = sp.symbols('t')
         values = []
         time_min = []
 
         current_time = 0
         for expr, duration in expression_duration_pairs:
-            # Skip empty expressions
-            # if len(expr) == 0 or duration == :
-            #     continue
-
-            # Parse the expression
-            parsed_expr = sp.sympify(expr)
-            # Create a numpy function from the sympy expression
-            func = sp.lambdify(t, parsed_expr, modules='numpy')
+            # Get the numpy function of the expression, compiled once per expression
+            func = compile_expression(expr)
 
-            # Generate the times for this duration
+            # Generate the times for this duration, evaluate the whole segment at once.
+            # Constant expressions return a scalar, so broadcast it to the segment
             segment_time = np.linspace(0, duration, num=int(duration*60))
-            segment_values = [func(x) for x in segment_time]
+            segment_values = np.broadcast_to(func(segment_time), segment_time.shape)
 
             # Append the values and times
-            values.extend(segment_values)
-            time_min.extend(segment_time + current_time)
+            values.append(segment_values)
+            time_min.append(segment_time + current_time)
             
             # Update current time for the next segment
             current_time += duration
 
+        if len(values) == 0:
+            return np.empty(0), np.empty(0)
+
         # Constrain the values from 0 to 100
-        values = np.clip(values, 0, 100)
+        values = np.clip(np.concatenate(values).astype(np.float64), 0, 100)
+        time_min = np.concatenate(time_min)
 
-        # Convert the values to normal floats
-        time_min = [float(t) for t in time_min]
-        values = [float(v) for v in values]
         return time_min, values
-
@@ -1,28 +1,68 @@
-import pyfirmata
 import time
-import struct
-import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation
-import numpy as np
 import asyncio
+import collections
+import threading
+import logging
+import Simulation
+
+CC2_BATCH_READ = 0x50   # Sysex command of LAC_firmata.ino reading several sensors in one exchange
+CC2_MAX_BATCH = 12      # Maximum number of sensors per batch read, as in LAC_firmata.ino
+CC2_BATCH_PROBES = 3    # Batch reads in a row without response before reading the sensors one at a time
+CC2_BATCH_RETRY_S = 60  # Time after which batch reads are tried again on a board without them [s]
 
 class HumiditySensorInterface:
-    def __init__(self, timeout_tries=5):
+    def __init__(self, timeout_tries=5, timeout_s=0.5):
         #Initialize local variables
         self.response = None
         self.max_retries = timeout_tries
+        self.timeout_s = timeout_s      # Timeout of get_data_async [s]
         self.is_board_connected = False
+        self.connect_future = None      # Connection of connect_board_async, shared by concurrent calls
+
+        # Futures of get_data_async waiting for a response, keyed by sensor address.
+        # _sysex_callback runs in the Firmata iterator thread, so access is locked
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+
+        # Futures of get_many waiting for a batch response, with the addresses they asked for
+        self.batch_pending = collections.deque()
+        # Batches of get_data_batched collecting the reads of this loop iteration, keyed by event
+        # loop: the hardware loop and the Flask loop each have their own
+        self.next_batches = {}
+        self.batch_supported = None     # Unknown until the first batch read, False if the firmware has no CC2_BATCH_READ
+        self.batch_failures = 0         # Batch reads in a row without response while batch_supported is not True
+        self.batch_retry_at = 0         # Time of the next batch read try when batch_supported is False [monotonic s]
 
     # Initialize the Firmata interface
     def connect_board(self, port):
-        # Create a new board instance
+        # A simulated board answers from its own timer threads, it needs no iterator
+        if Simulation.is_simulated(port):
+            self.board = Simulation.SIMULATOR.firmata_board(port)
+            self.board.add_cmd_handler(CC2_BATCH_READ, self._batch_callback)
+            self.is_board_connected = True
+            return
+
+        # Create a new board instance. pyfirmata is imported on first use, to start faster
+        import pyfirmata
         self.board = pyfirmata.Arduino(port)
+        self.board.add_cmd_handler(CC2_BATCH_READ, self._batch_callback)
         
         # Start iterator thread so that serial buffer doesn't overflow
         self.it = pyfirmata.util.Iterator(self.board)
         self.it.start()
         self.is_board_connected = True
 
+    async def connect_board_async(self, port):
+        """
+        Connects the board without blocking the event loop.  The board may be shared by the
+        sensors of several chambers: concurrent calls wait for the same connection.
+        """
+        if self.is_board_connected:
+            return
+        if self.connect_future is None:
+            self.connect_future = asyncio.get_running_loop().run_in_executor(None, self.connect_board, port)
+        await asyncio.shield(self.connect_future)
+
     def add_sensor_addr(self, sensor_addr):
         if not self.is_board_connected:
             raise Exception("HSI: Board not connected")
@@ -32,6 +72,10 @@ class HumiditySensorInterface:
             self.board.add_cmd_handler(addr, self._sysex_callback)
 
     def get_data(self, sensor_addr):
+        """
+        Blocking read of a sensor.  Do not call this from the hardware loop, use
+        get_data_async instead.
+        """
         # print(f"Getting data from sensor {hex(sensor_addr)}")
         self.board.send_sysex(sensor_addr, [])
         #Wait to get the response 5 times, with a 0.05s delay, then throw an error
@@ -43,33 +87,197 @@ class HumiditySensorInterface:
         if self.response is None:
             raise Exception("No response received from the sensor.")
 
-        # If we get here, we have a response.  The first byte is the sensor address
+        response = self.response
+        self.response = None        #Reset the response variable
+        return self._decode_response(sensor_addr, response)
+
+    async def get_data_async(self, sensor_addr):
+        """
+        Reads a sensor without blocking the event loop.  The request waits on a future
+        that _sysex_callback resolves with the response carrying the same sensor address,
+        so several sensors can be read at once without taking each other's response.
+
+        Parameters:
+        sensor_addr (int): I2C address of the sensor.
+
+        Returns:
+            dict: The sensor address, humidity and temperature.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.pending_lock:
+            self.pending.setdefault(sensor_addr, collections.deque()).append(future)
+
+        try:
+            self.board.send_sysex(sensor_addr, [])
+            response = await asyncio.wait_for(future, self.timeout_s)
+        except asyncio.TimeoutError:
+            raise Exception(f"No response received from the sensor {hex(sensor_addr)}.")
+        finally:
+            # Stop waiting for a response if the request failed or timed out
+            with self.pending_lock:
+                if future in self.pending.get(sensor_addr, ()):
+                    self.pending[sensor_addr].remove(future)
+
+        return self._decode_response(sensor_addr, response)
+
+    async def get_many(self, sensor_addrs):
+        """
+        Reads several sensors in one exchange with the board: the sensors measure at the same
+        time and the board waits once, so reading N sensors takes about as long as reading one.
+        More than CC2_MAX_BATCH sensors are read in several exchanges.
+
+        Parameters:
+        sensor_addrs (list): I2C addresses of the sensors.
+
+        Returns:
+            dict: The reading of each sensor (see get_data_async), or the Exception raised reading
+            it, keyed by sensor address.
+        """
+        sensor_addrs = list(dict.fromkeys(sensor_addrs))
+        readings = {}
+        for i in range(0, len(sensor_addrs), CC2_MAX_BATCH):
+            readings.update(await self._get_batch(sensor_addrs[i:i + CC2_MAX_BATCH]))
+        return readings
+
+    async def _get_batch(self, sensor_addrs):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        entry = (tuple(sensor_addrs), future)
+        with self.pending_lock:
+            self.batch_pending.append(entry)
+
+        try:
+            self.board.send_sysex(CC2_BATCH_READ, sensor_addrs)
+            response = await asyncio.wait_for(future, self.timeout_s)
+        except asyncio.TimeoutError:
+            raise Exception(f"No response received from the sensors {[hex(addr) for addr in sensor_addrs]}.")
+        finally:
+            with self.pending_lock:
+                if entry in self.batch_pending:
+                    self.batch_pending.remove(entry)
+
+        # The response is [n, (address, 4 data bytes) * n]
+        readings = {}
+        for i in range(1, 1 + 5*response[0], 5):
+            sensor_addr = response[i]
+            try:
+                readings[sensor_addr] = self._decode_response(sensor_addr, response[i:i + 5])
+            except Exception as e:
+                readings[sensor_addr] = e
+        for sensor_addr in sensor_addrs:
+            if sensor_addr not in readings:
+                readings[sensor_addr] = Exception(f"Sensor {hex(sensor_addr)}: missing from the batch response")
+        return readings
+
+    async def get_data_batched(self, sensor_addr):
+        """
+        Reads a sensor like get_data_async, but the reads started in the same loop iteration
+        are grouped into one get_many, so the sensors of the board polled at the same time
+        share one exchange.  Falls back to get_data_async if the firmware has no batch read,
+        and tries batch reads again every CC2_BATCH_RETRY_S.
+
+        Parameters:
+        sensor_addr (int): I2C address of the sensor.
+
+        Returns:
+            dict: The sensor address, humidity and temperature.
+        """
+        if self.batch_supported is False and time.monotonic() < self.batch_retry_at:
+            return await self.get_data_async(sensor_addr)
+
+        loop = asyncio.get_running_loop()
+        batch = self.next_batches.get(loop)
+        if batch is None:
+            batch = self.next_batches[loop] = {'addrs': [], 'task': None}
+            batch['task'] = loop.create_task(self._run_batch(batch))
+        batch['addrs'].append(sensor_addr)
+
+        reading = (await asyncio.shield(batch['task']))[sensor_addr]
+        if isinstance(reading, Exception):
+            raise reading
+        return reading
+
+    async def _run_batch(self, batch):
+        # Let the other reads of this loop iteration join the batch
+        await asyncio.sleep(0)
+        self.next_batches.pop(asyncio.get_running_loop(), None)
+
+        try:
+            readings = await self.get_many(batch['addrs'])
+        except Exception as e:
+            if self.batch_supported is True:
+                raise
+            # No answer to the batch read yet, this read may have been lost or the firmware may
+            # be older.  Read the sensors one at a time, and stop trying batch reads after
+            # CC2_BATCH_PROBES tries in a row without response
+            self.batch_failures += 1
+            if self.batch_failures >= CC2_BATCH_PROBES:
+                if self.batch_supported is None:
+                    logging.warning(f"HSI: no response to the batch reads, reading the sensors one at a time\n{'':<20}Error: {e}")
+                self.batch_supported = False
+                self.batch_retry_at = time.monotonic() + CC2_BATCH_RETRY_S
+            results = await asyncio.gather(*[self.get_data_async(addr) for addr in batch['addrs']], return_exceptions=True)
+            return dict(zip(batch['addrs'], results))
+
+        self.batch_supported = True
+        self.batch_failures = 0
+        return readings
+
+    def _decode_response(self, sensor_addr, response):
+        # The first byte is the sensor address
         #Check if the data bytes are all 1, if so, the sensor is not connected
-        if all([b == 0xFF for b in self.response[1:]]):
-            self.response = None
+        if all([b == 0xFF for b in response[1:]]):
             raise Exception(f"Sensor {hex(sensor_addr)}: not connected")
 
         #Convert the bytes to humidity and temperature
-        ret = {'sensor_addr': f"{hex(self.response[0])}",
-                'humidity': ((self.response[1]&0x3F)<<8 | self.response[2]) / 2**14 *100, 
-               'temperature': (self.response[3]<<6 | self.response[4]>>2) / 2**14 *165 - 40}
+        return {'sensor_addr': f"{hex(response[0])}",
+                'humidity': ((response[1]&0x3F)<<8 | response[2]) / 2**14 *100, 
+                'temperature': (response[3]<<6 | response[4]>>2) / 2**14 *165 - 40}
 
-        self.response = None        #Reset the response variable
-        return ret
+    @staticmethod
+    def _resolve_future(future, response):
+        # Runs in the event loop of the future, the request may have timed out in the meantime
+        if not future.done():
+            future.set_result(response)
+
+    @staticmethod
+    def _combine_bytes(data):
+        # Combine pairs of 7-bit values, LSB 7 bits first, then MSB 7 bits to get the 8 bit values
+        return [data[i] | (data[i+1] << 7) for i in range(0, len(data) - 1, 2)]
 
     # Function to handle received SysEx messages
     def _sysex_callback(self, *data):
-        received_bytes = []
-        # Combine pairs of 7-bit values, LSB 7 bits first, then MSB 7 bits to get the 8 bit values
-        for i in range(0, len(data), 2):
-            # Combine LSB (data[i]) and MSB (data[i+1]) into a 8-bit value
-            combined_value = data[i] | (data[i+1] << 7)
-            received_bytes.append(combined_value)
+        received_bytes = self._combine_bytes(data)
 
         # print("\tReceived SysEx message:", [d for d in data])
         # print(f"\tConverted data: {[bin(d) for d in received_bytes]} = {[hex(d) for d in received_bytes]}")
-        
+
+        # Hand the response to the oldest request waiting on this sensor address.
+        # If there is none, it is a response for the blocking get_data
+        with self.pending_lock:
+            waiting = self.pending.get(received_bytes[0]) if len(received_bytes) > 0 else None
+            future = waiting.popleft() if waiting else None
+        if future is not None:
+            future.get_loop().call_soon_threadsafe(self._resolve_future, future, received_bytes)
+            return
+
         self.response = received_bytes
+
+    # Function to handle the responses to CC2_BATCH_READ
+    def _batch_callback(self, *data):
+        received_bytes = self._combine_bytes(data)
+        if len(received_bytes) == 0:
+            return
+        sensor_addrs = tuple(received_bytes[i] for i in range(1, 1 + 5*received_bytes[0], 5))
+
+        # Hand the response to the oldest batch waiting on the same sensors
+        with self.pending_lock:
+            entry = next((entry for entry in self.batch_pending if entry[0] == sensor_addrs), None)
+            if entry is not None:
+                self.batch_pending.remove(entry)
+        if entry is not None:
+            entry[1].get_loop().call_soon_threadsafe(self._resolve_future, entry[1], received_bytes)
     
     # Function to handle received SysEx messages (Test function)
     def _sysex_callback_test(self, *data):
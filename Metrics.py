@@ -0,0 +1,155 @@
+import bisect
+import time
+import threading
+
+# Default histogram buckets for latencies [s], from 0.1 ms to 10 s
+LATENCY_BUCKETS_S = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(label_names, label_values, extra=''):
+    labels = [f'{name}="{value}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+# Define a base class for a metric with optional labels.
+# Label values are passed positionally, in the order of label_names, and each combination of
+# label values has its own series.  Updates are a dict lookup and a few integer operations,
+# so metrics can be updated in the hardware loop on every sample.
+class Metric:
+    type_name = ''
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.series = {}        # Series, keyed by tuple of label values
+        self.lock = threading.Lock()
+
+        # A metric without labels has a single series, reported from the start
+        if not self.label_names:
+            self._get_series(())
+
+    def _get_series(self, label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            with self.lock:
+                series = self.series.setdefault(label_values, self._new_series())
+        return series
+
+    def _new_series(self):
+        return [0]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type_name}"]
+        # New series may be added by the hardware loop while rendering, iterate over a copy
+        with self.lock:
+            items = list(self.series.items())
+        for label_values, series in sorted(items):
+            lines.extend(self._render_series(label_values, series))
+        return lines
+
+    def _render_series(self, label_values, series):
+        return [f"{self.name}{_format_labels(self.label_names, label_values)} {series[0]}"]
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        self._get_series(label_values)[0] += amount
+
+    def value(self, *label_values):
+        return self._get_series(label_values)[0]
+
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def set(self, value, *label_values):
+        self._get_series(label_values)[0] = value
+
+
+# Define a class for a timer measuring the duration of a block into a histogram
+class Timer:
+    __slots__ = ('histogram', 'label_values', 't0')
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.t0, *self.label_values)
+        return False
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS_S):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help_text, label_names)
+
+    def _new_series(self):
+        # Count of each bucket (non-cumulative, the last one is +Inf), sum and count
+        return [[0]*(len(self.buckets) + 1), 0.0, 0]
+
+    def observe(self, value, *label_values):
+        series = self._get_series(label_values)
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def time(self, *label_values):
+        """
+        Measures the duration of a with block [s].
+        """
+        return Timer(self, label_values)
+
+    def _render_series(self, label_values, series):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), series[0]):
+            cumulative += count
+            labels = _format_labels(self.label_names, label_values, f'le="{bound}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.label_names, label_values)
+        lines.append(f"{self.name}_sum{labels} {series[1]}")
+        lines.append(f"{self.name}_count{labels} {series[2]}")
+        return lines
+
+
+# Define a class to hold the metrics and render them in the Prometheus text exposition format
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric_class, name, *args, **kwargs):
+        # Return the existing metric if it was already registered, e.g. by another module
+        if name not in self.metrics:
+            self.metrics[name] = metric_class(name, *args, **kwargs)
+        return self.metrics[name]
+
+    def counter(self, name, help_text, label_names=()):
+        return self._register(Counter, name, help_text, label_names)
+
+    def gauge(self, name, help_text, label_names=()):
+        return self._register(Gauge, name, help_text, label_names)
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS_S):
+        return self._register(Histogram, name, help_text, label_names, buckets)
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of the application
+REGISTRY = MetricsRegistry()
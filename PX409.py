@@ -1,15 +1,57 @@
 import serial
 import time
+import asyncio
+import collections
+import queue
+import threading
+import Simulation
 
 class PX409:
-    def __init__(self, timeout_s=1):
+    def __init__(self, timeout_s=1, request_timeout_s=0.5):
         self.baudrate = 115200
         self.timeout_s = timeout_s
+        self.request_timeout_s = request_timeout_s  # Timeout of get_pressure_async [s]
+
+        # Requests of get_pressure_async waiting for a response, as (future, deadline), in the
+        # order the commands were sent.  The reader thread resolves them in the same order
+        self.pending = collections.deque()
+        self.pending_lock = threading.Lock()
+        self.reader_thread = None
+        self.writer_thread = None
+        self.write_queue = queue.Queue()    # Commands of get_pressure_async, sent in order by the writer thread
+        self.is_reading = False
+        self.connection = None
+        # After a request timed out, its response may still come and can't be told apart from the
+        # responses of the next requests: they wait until then, and the responses until then are
+        # discarded [monotonic s]
+        self.resync_until = 0
 
     def connect(self, port):
+        # Stop the reader and close the port of a previous connection first
+        if self.connection is not None:
+            self.close()
         self.port = port
+        if Simulation.is_simulated(port):
+            self.connection = Simulation.SIMULATOR.serial(port, self.baudrate, timeout=self.timeout_s)
+            return
         self.connection = serial.Serial(port, self.baudrate, bytesize=8, parity='N', stopbits=1, timeout=self.timeout_s)
 
+    async def connect_async(self, port):
+        """
+        Connects to the transducer without blocking the event loop and starts the reader and
+        writer threads used by get_pressure_async.
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self.connect, port)
+        self.is_reading = True
+        self.resync_until = 0
+        self.write_queue = queue.Queue()
+        self.reader_thread = threading.Thread(target=self._read_loop, args=(self.connection,),
+                                              name=f"PX409 {port}", daemon=True)
+        self.writer_thread = threading.Thread(target=self._write_loop, args=(self.connection, self.write_queue),
+                                              name=f"PX409 {port} writer", daemon=True)
+        self.reader_thread.start()
+        self.writer_thread.start()
+
     def send_command(self, command):
         command_bytes = f'{command}\r'.encode('ascii')
 
@@ -31,16 +73,140 @@ class PX409:
     def get_pressure(self):
         """
         Sends a command to retrieve the pressure reading from the device.
+        Blocking, do not mix with get_pressure_async.
 
         Returns:
             float: The pressure reading in psig.
         """
         self.send_command('P')
-        response = self.read_response().strip().split(' ')
+        return self._parse_pressure(self.read_response())
+
+    async def get_pressure_async(self):
+        """
+        Sends a command to retrieve the pressure reading from the device, and waits for the
+        response without blocking the event loop.  Requests can be pipelined: each one queues
+        its command right away and gets the response matching its position.  The commands are
+        written by the writer thread, so a stalled port does not stall the event loop.
+
+        Returns:
+            float: The pressure reading in psig.
+        """
+        # Wait for the late response of a request that timed out, if any, to be discarded
+        delay_s = self.resync_until - time.monotonic()
+        if delay_s > 0:
+            await asyncio.sleep(delay_s)
+
+        future = asyncio.get_running_loop().create_future()
+        with self.pending_lock:
+            if not self.is_reading:
+                raise serial.SerialException("PX409: reader not running")
+            # Queue the command under the lock, so the pending order matches the command order
+            self.pending.append((future, time.monotonic() + self.request_timeout_s))
+            self.write_queue.put('P')
+
+        try:
+            response = await asyncio.wait_for(future, self.request_timeout_s)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # The response is late or lost, the responses of the other waiting requests can't be matched
+            with self.pending_lock:
+                stale = self._resync() if any(f is future for f, _ in self.pending) else []
+            self._fail_requests(stale, asyncio.TimeoutError())
+            raise
+        return self._parse_pressure(response)
+
+    def _parse_pressure(self, response):
+        response = response.strip().split(' ')
         # Remove all ">" character from the response
         response = [r.replace('>', '') for r in response]
 
         return float(response[0])
 
+    @staticmethod
+    def _resolve_future(future, response=None, exception=None):
+        # Runs in the event loop of the future, the request may have timed out in the meantime
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(response)
+
+    @classmethod
+    def _fail_requests(cls, pending, exception):
+        for future, _ in pending:
+            future.get_loop().call_soon_threadsafe(cls._resolve_future, future, None, exception)
+
+    def _resync(self):
+        """
+        Drops the waiting requests after one of them timed out, and discards the responses coming
+        within request_timeout_s, the late response among them.  Call with pending_lock held.
+
+        Returns:
+            collections.deque: The dropped requests, to fail outside the lock.
+        """
+        self.resync_until = time.monotonic() + self.request_timeout_s
+        pending, self.pending = self.pending, collections.deque()
+        return pending
+
+    def _connection_failed(self, connection, e):
+        # The port failed or was closed, fail all the waiting requests
+        with self.pending_lock:
+            if self.connection is not connection:
+                return
+            self.is_reading = False
+            pending, self.pending = self.pending, collections.deque()
+        self._fail_requests(pending, serial.SerialException(f"PX409: {e}"))
+
+    def _write_loop(self, connection, commands):
+        # Writer thread: send the commands of get_pressure_async in order, until the connection
+        # is closed or replaced
+        while True:
+            command = commands.get()
+            if command is None or not self.is_reading or self.connection is not connection:
+                return
+            try:
+                connection.write(f'{command}\r'.encode('ascii'))
+                connection.flush()
+            except Exception as e:
+                self._connection_failed(connection, e)
+                return
+
+    def _read_loop(self, connection):
+        # Reader thread: hand each response line to the oldest waiting request, until the
+        # connection is closed or replaced
+        while self.is_reading and self.connection is connection:
+            try:
+                line = connection.readline().decode('ascii')
+            except Exception as e:
+                self._connection_failed(connection, e)
+                return
+
+            with self.pending_lock:
+                now = time.monotonic()
+                if len(self.pending) > 0 and (self.pending[0][0].done() or self.pending[0][1] < now):
+                    # The oldest request timed out or was cancelled: this line may be its late
+                    # response, so it is discarded with the waiting requests
+                    stale = self._resync()
+                elif not line or len(self.pending) == 0 or now < self.resync_until:
+                    continue
+                else:
+                    future, _ = self.pending.popleft()
+                    stale = None
+            if stale is not None:
+                self._fail_requests(stale, asyncio.TimeoutError())
+            else:
+                future.get_loop().call_soon_threadsafe(self._resolve_future, future, line)
+
     def close(self):
-        self.connection.close()
\ No newline at end of file
+        with self.pending_lock:
+            self.is_reading = False
+            pending, self.pending = self.pending, collections.deque()
+        self._fail_requests(pending, serial.SerialException("PX409: port closed"))
+        self.write_queue.put(None)      # Wake up the writer thread
+        if self.connection is not None:
+            self.connection.close()
+        for thread in [self.reader_thread, self.writer_thread]:
+            if thread is not None and thread is not threading.current_thread():
+                thread.join(self.timeout_s)
+        self.reader_thread = None
+        self.writer_thread = None
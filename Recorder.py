@@ -0,0 +1,308 @@
+import queue
+import threading
+import time
+import logging
+import json
+import struct
+import numbers
+import os
+import numpy as np
+from Clock import format_timestamps
+from Metrics import REGISTRY
+
+BINARY_MAGIC = b'LACREC1\n'    # First bytes of a binary recording
+INDEX_STRIDE = 1000            # Minimum number of rows between two entries of the time index of a save file
+INDEX_DTYPE = np.dtype([('time', '<f8'), ('offset', '<i8')])    # Entry of the time index
+
+# Metrics of the recorder, exposed on /metrics
+RECORDER_DROPPED = REGISTRY.counter('lac_recorder_dropped_total', 'Samples dropped from the save files because the recorder queue was full.')
+RECORDER_WRITE_SECONDS = REGISTRY.histogram('lac_recorder_write_seconds', 'Duration of writing one batch to the save files.')
+
+
+def index_path(file_path):
+    # The time index of a save file is written next to it
+    return file_path + '.idx'
+
+
+# Define a class for the sparse time index of a save file, written next to it (see index_path).
+# Each entry is the UNIX timestamp of a row [s] and the byte offset of the row in the save file,
+# as INDEX_DTYPE.  An entry is added at the start of a batch once INDEX_STRIDE rows were written
+# since the last one, so a reader can seek to the block holding a time without parsing the file.
+class TimeIndex:
+    def __init__(self, file_path, stride=INDEX_STRIDE):
+        self.file = open(index_path(file_path), 'wb')
+        self.stride = stride
+        self.rows_since_entry = None    # None until the first entry
+
+    def add(self, timestamp, offset, n_rows):
+        """
+        Records a batch of rows written to the save file.
+
+        Parameters:
+        timestamp (float): Timestamp of the first row of the batch [s].
+        offset (int): Byte offset of the first row of the batch in the save file.
+        n_rows (int): Number of rows of the batch.
+        """
+        if self.rows_since_entry is None or self.rows_since_entry >= self.stride:
+            self.file.write(np.array([(timestamp, offset)], dtype=INDEX_DTYPE).tobytes())
+            self.rows_since_entry = 0
+        self.rows_since_entry += n_rows
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# Define a class for a CSV save file written by the Recorder.
+# The first column is the datetime of the sample, followed by one column per value key.
+class CSVSink:
+    def __init__(self, file_path, columns=None):
+        self.name = file_path
+        self.file = open(file_path, 'w')
+        self.index = TimeIndex(file_path)
+        self.columns = None
+
+        # Write the header once at open if the value keys are already known,
+        # otherwise it is written with the first batch
+        if columns:
+            self._write_header(columns)
+
+    def _write_header(self, columns):
+        self.columns = list(columns)
+        self.file.write('datetime,' + ','.join(self.columns) + '\n')
+
+    def write(self, samples):
+        """
+        Writes a batch of samples to the file.
+
+        Parameters:
+        samples (list): A list of (timestamp, values) tuples, timestamp being a UNIX timestamp [s].
+        """
+        if self.columns is None:
+            self._write_header(samples[0][1].keys())
+        self.index.add(samples[0][0], self.file.tell(), len(samples))
+
+        # The datetimes of the batch are formatted at once
+        datetimes = format_timestamps([timestamp for timestamp, _ in samples]).tolist()
+        lines = []
+        for dt, (_, values) in zip(datetimes, samples):
+            lines.append(f"{dt}," + ','.join([str(values.get(key, '')) for key in self.columns]))
+        self.file.write('\n'.join(lines) + '\n')
+
+    def flush(self):
+        self.file.flush()
+        self.index.flush()
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+
+# Define a class for a binary save file written by the Recorder.
+# The file starts with BINARY_MAGIC, a little-endian uint32 with the length of the schema header
+# and the schema header itself (JSON, padded to a multiple of 8 bytes).  The rest of the file is
+# rows of little-endian float64 values, one per column, appended in chunks as batches are
+# written.  The first column is the UNIX timestamp of the sample [s].  Only numeric values are
+# recorded, so the file can be memory-mapped as one array by read_binary.
+class BinarySink:
+    def __init__(self, file_path, columns=None):
+        self.name = file_path
+        self.file = open(file_path, 'wb')
+        self.index = TimeIndex(file_path)
+        self.columns = None
+
+        # Write the schema header once at open if the value keys are already known,
+        # otherwise it is written with the first batch
+        if columns:
+            self._write_header(columns)
+
+    def _write_header(self, columns):
+        self.columns = list(columns)
+        header = json.dumps({'version': 1, 'dtype': '<f8', 'columns': ['time'] + self.columns}).encode('utf-8')
+        # Pad the header so the rows start on an 8 byte boundary
+        header += b' ' * (-(len(BINARY_MAGIC) + 4 + len(header)) % 8)
+        self.file.write(BINARY_MAGIC + struct.pack('<I', len(header)) + header)
+
+    def write(self, samples):
+        """
+        Writes a batch of samples to the file as one chunk of rows.
+
+        Parameters:
+        samples (list): A list of (timestamp, values) tuples, timestamp being a UNIX timestamp [s].
+        """
+        if self.columns is None:
+            self._write_header([key for key, value in samples[0][1].items()
+                                if isinstance(value, numbers.Real) and not isinstance(value, bool)])
+
+        rows = np.empty((len(samples), len(self.columns) + 1), dtype='<f8')
+        for i, (timestamp, values) in enumerate(samples):
+            rows[i, 0] = timestamp
+            for j, key in enumerate(self.columns):
+                rows[i, j + 1] = values.get(key, np.nan)
+        self.index.add(samples[0][0], self.file.tell(), len(samples))
+        self.file.write(rows.tobytes())
+
+    def flush(self):
+        self.file.flush()
+        self.index.flush()
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+
+def read_binary(file_path):
+    """
+    Memory-maps a binary recording written by BinarySink.  Nothing is parsed or copied: the
+    arrays returned are views into the file.  A partially written last row is ignored.
+
+    Parameters:
+    file_path (str): Path of the binary recording.
+
+    Returns:
+        dict: One NumPy array per column, keyed by column name. 'time' holds the UNIX timestamps [s].
+    """
+    with open(file_path, 'rb') as f:
+        if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError(f"{file_path} is not a binary recording")
+        header_length = struct.unpack('<I', f.read(4))[0]
+        header = json.loads(f.read(header_length))
+
+    columns = header['columns']
+    offset = len(BINARY_MAGIC) + 4 + header_length
+    row_size = len(columns) * np.dtype(header['dtype']).itemsize
+    n_rows = (os.path.getsize(file_path) - offset) // row_size
+    if n_rows == 0:
+        return {column: np.empty(0, dtype=header['dtype']) for column in columns}
+
+    data = np.memmap(file_path, dtype=header['dtype'], mode='r', offset=offset, shape=(n_rows, len(columns)))
+    return {column: data[:, i] for i, column in enumerate(columns)}
+
+
+def export_csv(binary_path, csv_path, chunk_size=10*INDEX_STRIDE):
+    """
+    Exports a binary recording to a CSV file in the same format as CSVSink.
+
+    Parameters:
+    binary_path (str): Path of the binary recording.
+    csv_path (str): Path of the CSV file to write.
+    chunk_size (int, optional): Number of rows converted at a time, also the most rows per block of the time index. Default is 10000.
+    """
+    data = read_binary(binary_path)
+    time_s = data.pop('time')
+    sink = CSVSink(csv_path, columns=list(data.keys()))
+    for start in range(0, len(time_s), chunk_size):
+        stop = start + chunk_size
+        chunk = {key: column[start:stop].tolist() for key, column in data.items()}
+        sink.write([(timestamp, {key: column[i] for key, column in chunk.items()})
+                    for i, timestamp in enumerate(time_s[start:stop].tolist())])
+    sink.close()
+
+
+# Define a class to write the samples of the DAQs to their save files in a background thread.
+# Samples are handed over through a queue and written in batches, so the hardware loop never
+# waits on the disk.  Batches are written when flush_size samples are waiting or every
+# flush_interval_s seconds, whichever comes first.
+class Recorder:
+    def __init__(self, flush_interval_s=1.0, flush_size=1000, max_queue_size=100000):
+        self.flush_interval_s = flush_interval_s
+        self.flush_size = flush_size
+
+        self.queue = queue.Queue(max_queue_size)
+        self.dropped = 0        # Number of samples dropped because the queue was full
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, name='Recorder', daemon=True)
+        self.thread.start()
+
+    def open(self, sink):
+        """
+        Starts recording to a sink, e.g. a CSVSink.
+
+        Returns:
+            The sink, to pass to submit and close.
+        """
+        self.start()
+        logging.info(f"Opened save file at {sink.name}")
+        return sink
+
+    def submit(self, sink, timestamp, values):
+        """
+        Queues a sample to be written to a sink.  Never blocks; if the writer thread
+        has fallen too far behind, the sample is dropped from the file.
+        """
+        try:
+            self.queue.put_nowait((sink, timestamp, values))
+        except queue.Full:
+            self.dropped += 1
+            RECORDER_DROPPED.inc()
+            if self.dropped % 1000 == 1:
+                logging.warning(f"Recorder queue full, {self.dropped} samples dropped")
+
+    def close(self, sink, timeout_s=5):
+        """
+        Closes a sink once the samples queued before this call have been written.
+
+        Parameters:
+        sink: The sink to close.
+        timeout_s (float, optional): Maximum time to wait for the sink to be closed [s]. Default is 5.
+        """
+        closed = threading.Event()
+        self.queue.put((sink, None, closed))
+        if not closed.wait(timeout_s):
+            logging.warning(f"Timed out closing save file at {sink.name}")
+
+    def _write(self, batches):
+        with RECORDER_WRITE_SECONDS.time():
+            self._write_batches(batches)
+
+    def _write_batches(self, batches):
+        for sink, samples in batches.items():
+            if len(samples) == 0:
+                continue
+            try:
+                sink.write(samples)
+                sink.flush()
+            except Exception as e:
+                logging.error(f"Recorder: could not write to {sink.name}\n{'':<20}Error: {e}")
+            samples.clear()
+
+    def _run(self):
+        batches = {}            # Samples waiting to be written, keyed by sink
+        n_waiting = 0
+        last_flush = time.monotonic()
+
+        while True:
+            timeout = max(0, last_flush + self.flush_interval_s - time.monotonic())
+            try:
+                sink, timestamp, values = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                sink = None
+
+            if sink is not None and timestamp is None:
+                # Close marker: write what is left for the sink, then close it
+                samples = batches.pop(sink, [])
+                n_waiting -= len(samples)
+                self._write({sink: samples})
+                try:
+                    sink.close()
+                    logging.info(f"Closed save file at {sink.name}")
+                except Exception as e:
+                    # Like a failed write, the thread keeps writing the other save files
+                    logging.error(f"Recorder: could not close {sink.name}\n{'':<20}Error: {e}")
+                finally:
+                    values.set()
+                continue
+            if sink is not None:
+                batches.setdefault(sink, []).append((timestamp, values))
+                n_waiting += 1
+
+            if n_waiting >= self.flush_size or time.monotonic() - last_flush >= self.flush_interval_s:
+                self._write(batches)
+                n_waiting = 0
+                last_flush = time.monotonic()
@@ -0,0 +1,123 @@
+import threading
+import numbers
+import numpy as np
+
+
+# Define a class to store the sliding window of samples of a DAQ.
+# The samples are stored in preallocated NumPy columns: one float64 column for the
+# timestamps and one column per value key.  Every sample is written twice, at index
+# i and i + capacity, so the most recent `capacity` samples are always contiguous
+# in memory and can be returned as slices (views) without copying.
+class RingBuffer:
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.count = 0          # Total number of samples appended. Also the cursor of the next sample
+
+        self.timestamps = np.zeros(2*capacity, dtype=np.float64)
+        self.columns = {}       # Value columns, keyed by value key
+
+        # Appends happen in the hardware loop, reads in the Flask threads
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    @property
+    def first_cursor(self):
+        """
+        Cursor of the oldest sample still in the buffer.
+        """
+        return max(0, self.count - self.capacity)
+
+    def _add_column(self, key, value):
+        # Numbers are stored as float64, anything else (e.g. a sensor address string) as objects
+        if isinstance(value, numbers.Real) and not isinstance(value, bool):
+            column = np.full(2*self.capacity, np.nan, dtype=np.float64)
+        else:
+            column = np.full(2*self.capacity, None, dtype=object)
+        self.columns[key] = column
+        return column
+
+    def _set_value(self, key, i, value):
+        column = self.columns.get(key)
+        if column is None:
+            column = self._add_column(key, value)
+        try:
+            column[i] = column[i + self.capacity] = value
+        except (TypeError, ValueError):
+            # A non-numeric value in a numeric column, fall back to storing objects
+            self.columns[key] = column = column.astype(object)
+            column[i] = column[i + self.capacity] = value
+
+    def append(self, timestamp, values):
+        """
+        Appends a sample to the buffer, overwriting the oldest sample if it is full.
+
+        Parameters:
+        timestamp (float): Timestamp of the sample.
+        values (dict): Values of the sample, keyed by value key.
+
+        Returns:
+            int: The cursor of the appended sample.
+        """
+        with self.lock:
+            i = self.count % self.capacity
+            self.timestamps[i] = self.timestamps[i + self.capacity] = timestamp
+            for key, value in values.items():
+                self._set_value(key, i, value)
+
+            # Columns that are not part of this sample are left empty
+            if len(values) != len(self.columns):
+                for key, column in self.columns.items():
+                    if key not in values:
+                        column[i] = column[i + self.capacity] = np.nan if column.dtype == np.float64 else None
+
+            self.count += 1
+            return self.count - 1
+
+    def _slice(self, start, stop):
+        # Clamp the cursors to the samples still in the buffer, then map them onto
+        # the contiguous region of the doubled arrays
+        start = max(self.first_cursor, start)
+        stop = max(start, min(self.count, stop))
+        offset = start % self.capacity
+        return slice(offset, offset + stop - start), start, stop
+
+    def read(self, start=0, stop=None, copy=False):
+        """
+        Reads the samples between two cursors.
+
+        The arrays returned are views into the buffer unless copy is True.  Views are
+        only valid until the buffer wraps around onto them, so readers that keep the data
+        or run alongside the hardware loop for a long time should copy.
+
+        Parameters:
+        start (int, optional): Cursor of the first sample. Clamped to the oldest sample. Default is 0.
+        stop (int, optional): Cursor after the last sample. Default is None, meaning the newest sample.
+        copy (bool, optional): Return copies instead of views. Default is False.
+
+        Returns:
+            tuple: (timestamps, columns, start, stop), with the cursors after clamping.
+        """
+        with self.lock:
+            window, start, stop = self._slice(start, self.count if stop is None else stop)
+            timestamps = self.timestamps[window]
+            columns = {key: column[window] for key, column in self.columns.items()}
+            if copy:
+                timestamps = timestamps.copy()
+                columns = {key: column.copy() for key, column in columns.items()}
+        return timestamps, columns, start, stop
+
+    def cursor_at(self, timestamp):
+        """
+        Finds the cursor of the first sample taken after a timestamp.
+
+        Parameters:
+        timestamp (float): The timestamp to search for.
+
+        Returns:
+            int: The cursor of the first sample with a timestamp greater than the given one.
+        """
+        with self.lock:
+            window, start, _ = self._slice(0, self.count)
+            return start + int(np.searchsorted(self.timestamps[window], timestamp, side='right'))
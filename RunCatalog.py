@@ -0,0 +1,270 @@
+import json
+import logging
+import os
+import numpy as np
+from Clock import parse_datetimes
+from Recorder import BINARY_MAGIC, INDEX_DTYPE, INDEX_STRIDE, index_path, read_binary
+
+MANIFEST_NAME = 'run.json'     # Manifest of a recording, in its directory
+RECORDING_EXTENSIONS = {'.csv': 'csv', '.bin': 'binary'}
+
+
+def is_within(path, directory):
+    # True if path is the directory or inside it, once .. and symbolic links are resolved
+    directory = os.path.realpath(directory)
+    return os.path.commonpath([os.path.realpath(path), directory]) == directory
+
+
+def write_manifest(directory, manifest):
+    """
+    Writes the manifest of a recording to its directory.  The manifest is a JSON file with the
+    run, the chamber, the start and stop times, the anchor of the clock of the timestamps (see
+    Clock.py) and the save file of each component, e.g.
+    {'run': 'LAC_240805_1314', 'chamber': 'main', 'format': 'csv', 'started': 1722870840.0,
+     'stopped': None, 'clock': {...}, 'devices': {'MFC1': 'MFC1_240805_1314.csv', ...}}.
+
+    Parameters:
+    directory (str): Directory of the recording.
+    manifest (dict): The manifest.
+    """
+    path = os.path.join(directory, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)     # Readers never see a partially written manifest
+
+
+def update_manifest(directory, **fields):
+    # Updates some fields of the manifest of a recording, if it has one
+    path = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return
+    with open(path) as f:
+        manifest = json.load(f)
+    manifest.update(fields)
+    write_manifest(directory, manifest)
+
+
+def read_index(file_path):
+    """
+    Reads the time index of a save file, building it by scanning the file once if it is missing
+    (recordings made before the index existed).
+
+    Returns:
+        numpy.ndarray: The entries of the index, as INDEX_DTYPE.
+    """
+    path = index_path(file_path)
+    if os.path.isfile(path) and os.path.getsize(path) > 0:
+        with open(path, 'rb') as f:
+            data = f.read()
+        return np.frombuffer(data[:len(data) - len(data) % INDEX_DTYPE.itemsize], dtype=INDEX_DTYPE)
+
+    entries = _scan_binary(file_path) if _is_binary(file_path) else _scan_csv(file_path)
+    try:
+        with open(path, 'wb') as f:
+            f.write(entries.tobytes())
+    except OSError as e:
+        logging.warning(f"Could not write the time index of {file_path}\n{'':<20}Error: {e}")
+    return entries
+
+
+def _is_binary(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def _binary_layout(file_path):
+    # Offset of the first row and size of a row of a binary recording [bytes]
+    data = read_binary(file_path)
+    time_s = data['time']
+    if len(time_s) == 0 or not isinstance(time_s.base, np.memmap):
+        return None, None, data
+    return time_s.base.offset, time_s.strides[0], data
+
+
+def _scan_binary(file_path):
+    offset, row_size, data = _binary_layout(file_path)
+    if offset is None:
+        return np.empty(0, dtype=INDEX_DTYPE)
+    rows = np.arange(0, len(data['time']), INDEX_STRIDE)
+    entries = np.empty(len(rows), dtype=INDEX_DTYPE)
+    entries['time'] = data['time'][rows]
+    entries['offset'] = offset + rows*row_size
+    return entries
+
+
+def _scan_csv(file_path):
+    entries = []
+    with open(file_path, 'rb') as f:
+        f.readline()    # Header
+        offset = f.tell()
+        for i, line in enumerate(iter(f.readline, b'')):
+            if i % INDEX_STRIDE == 0 and line.endswith(b'\n'):
+                entries.append((parse_datetimes([line.split(b',', 1)[0].decode()])[0], offset))
+            offset += len(line)
+    return np.array(entries, dtype=INDEX_DTYPE)
+
+
+def _block_range(entries, since, until, end_offset):
+    """
+    Byte range of the blocks of a save file that may hold the rows between two times.
+
+    Returns:
+        tuple: (start, stop) byte offsets; start is None if the file has no rows.
+    """
+    if len(entries) == 0:
+        return None, end_offset
+    # Start at the last block starting at or before since, stop at the first block starting after until
+    first = 0 if since is None else max(0, int(np.searchsorted(entries['time'], since, side='right')) - 1)
+    last = len(entries) if until is None else int(np.searchsorted(entries['time'], until, side='right'))
+    stop = end_offset if last >= len(entries) else int(entries['offset'][last])
+    return int(entries['offset'][first]), stop
+
+
+# Define a class for the catalog of the recordings of a save directory.
+# Each recording is a directory with one save file per component and a manifest (run.json,
+# see write_manifest); directories of older recordings without a manifest are listed from their
+# file names (<daq_key>_<timestamp>.<csv|bin>).  Queries read one channel over a time range,
+# seeking with the time index of the save file to the blocks holding the range, so their cost
+# depends on the size of the range, not of the recording.
+class RunCatalog:
+    def __init__(self, save_dir):
+        self.save_dir = save_dir
+
+    def runs(self):
+        """
+        Lists the recordings of the save directory, newest first.
+
+        Returns:
+            list: The manifest of each recording.
+        """
+        if not os.path.isdir(self.save_dir):
+            return []
+        runs = [self.get_run(name) for name in os.listdir(self.save_dir)]
+        runs = [run for run in runs if run is not None and len(run['devices']) > 0]
+        return sorted(runs, key=lambda run: run.get('started') or 0, reverse=True)
+
+    def get_run(self, name):
+        """
+        Reads the manifest of a recording.
+
+        Parameters:
+        name (str): Name of the recording, its directory in the save directory.
+
+        Returns:
+            dict: The manifest, see write_manifest; None if there is no such recording.
+        """
+        if name in ['', '.', '..'] or os.sep in name or (os.altsep and os.altsep in name):
+            return None
+        directory = os.path.join(self.save_dir, name)
+        if not is_within(directory, self.save_dir) or not os.path.isdir(directory):
+            return None
+
+        path = os.path.join(directory, MANIFEST_NAME)
+        if os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    return json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Could not read the manifest of {name}\n{'':<20}Error: {e}")
+
+        # Older recording without a manifest: one save file per component
+        devices = {}
+        for file_name in sorted(os.listdir(directory)):
+            root, extension = os.path.splitext(file_name)
+            if extension in RECORDING_EXTENSIONS and '_' in root:
+                devices.setdefault(root.rsplit('_', 2)[0], file_name)
+        started = min([os.path.getmtime(os.path.join(directory, file_name)) for file_name in devices.values()], default=None)
+        file_format = RECORDING_EXTENSIONS[os.path.splitext(next(iter(devices.values())))[1]] if devices else None
+        return {'run': name, 'chamber': None, 'format': file_format, 'started': started, 'stopped': None, 'devices': devices}
+
+    def file_path(self, run, daq_key):
+        # Path of the save file of a component of a recording, None if it was not recorded
+        manifest = self.get_run(run)
+        if manifest is None or daq_key not in manifest['devices']:
+            return None
+        path = os.path.join(self.save_dir, run, manifest['devices'][daq_key])
+        return path if is_within(path, os.path.join(self.save_dir, run)) and os.path.isfile(path) else None
+
+    def channels(self, run, daq_key):
+        """
+        Returns:
+            list: The channels (value keys) recorded for a component, None if it was not recorded.
+        """
+        path = self.file_path(run, daq_key)
+        if path is None:
+            return None
+        if _is_binary(path):
+            return [column for column in read_binary(path).keys() if column != 'time']
+        with open(path) as f:
+            return f.readline().strip().split(',')[1:]
+
+    def query(self, run, daq_key, channel, since=None, until=None):
+        """
+        Reads one channel of a component of a recording over a time range.
+
+        Parameters:
+        run (str): Name of the recording.
+        daq_key (str): Key of the component.
+        channel (str): Value key.
+        since (float, optional): UNIX timestamp of the start of the range [s]. Default is None, the start of the recording.
+        until (float, optional): UNIX timestamp of the end of the range [s]. Default is None, the end of the recording.
+
+        Returns:
+            tuple: (time, values), NumPy arrays of the UNIX timestamps [s] and values of the rows in the range.
+                   Empty CSV values are NaN.
+
+        Raises:
+            KeyError: If the recording, component or channel does not exist.
+        """
+        path = self.file_path(run, daq_key)
+        if path is None:
+            raise KeyError(f"{daq_key} was not recorded in {run}")
+        entries = read_index(path)
+        if _is_binary(path):
+            time_s, values = self._query_binary(path, entries, channel, since, until)
+        else:
+            time_s, values = self._query_csv(path, entries, channel, since, until)
+
+        # Trim the blocks to the range
+        keep = np.ones(len(time_s), dtype=bool)
+        if since is not None:
+            keep &= time_s >= since
+        if until is not None:
+            keep &= time_s <= until
+        return time_s[keep], values[keep]
+
+    def _query_binary(self, path, entries, channel, since, until):
+        offset, row_size, data = _binary_layout(path)
+        if channel not in data or channel == 'time':
+            raise KeyError(f"No channel {channel} in {path}")
+        if offset is None:
+            return np.empty(0), np.empty(0)
+        start, stop = _block_range(entries, since, until, offset + len(data['time'])*row_size)
+        if start is None:
+            return np.empty(0), np.empty(0)
+        rows = slice((start - offset) // row_size, (stop - offset) // row_size)
+        return np.array(data['time'][rows]), np.array(data[channel][rows])
+
+    def _query_csv(self, path, entries, channel, since, until):
+        with open(path, 'rb') as f:
+            columns = f.readline().decode().strip().split(',')
+            if channel not in columns[1:]:
+                raise KeyError(f"No channel {channel} in {path}")
+            column = columns.index(channel)
+
+            start, stop = _block_range(entries, since, until, os.path.getsize(path))
+            if start is None:
+                return np.empty(0), np.empty(0)
+            f.seek(start)
+            block = f.read(stop - start).decode()
+
+        # A partially written last line is ignored
+        lines = block.split('\n')[:-1]
+        fields = [line.split(',') for line in lines]
+        time_s = parse_datetimes([row[0] for row in fields])
+        values = [row[column] if column < len(row) else '' for row in fields]
+        try:
+            values = np.array([float(value) if value != '' else np.nan for value in values])
+        except ValueError:
+            values = np.array(values, dtype=object)     # Non-numeric channel, e.g. a sensor address
+        return time_s, values
@@ -0,0 +1,145 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+from Metrics import REGISTRY
+
+# Metrics of the scheduler, exposed on /metrics
+JOB_SECONDS = REGISTRY.histogram('lac_job_duration_seconds', 'Duration of each run of a scheduler job.', ['job'])
+JOB_LATENESS_SECONDS = REGISTRY.histogram('lac_job_lateness_seconds', 'Delay between the deadline and the start of a scheduler job (jitter).', ['job'])
+JOB_OVERRUNS = REGISTRY.counter('lac_job_overruns_total', 'Runs shed because the previous run was still going at the deadline.', ['job'])
+JOB_SKIPPED = REGISTRY.counter('lac_job_skipped_total', 'Deadlines skipped because the scheduler was late by more than a period.', ['job'])
+JOB_ERRORS = REGISTRY.counter('lac_job_errors_total', 'Runs of a scheduler job that raised an exception.', ['job'])
+
+
+# Define a class for a periodic job of the DeadlineScheduler, e.g. the acquisition of one DAQ.
+class Job:
+    def __init__(self, name, func, rate_hz, priority=0):
+        self.name = name
+        self.func = func                # Coroutine function called on every run
+        self.period_s = 1/rate_hz
+        self.priority = priority        # Jobs due at the same time start in increasing order of priority
+        self.task = None                # Task of the current run
+
+        # Statistics
+        self.runs = 0
+        self.errors = 0
+        self.overruns = 0       # Runs shed because the previous run was still going at the deadline
+        self.skipped = 0        # Deadlines skipped because the scheduler was late by more than a period
+        self.last_lateness_s = 0
+        self.max_lateness_s = 0
+
+    @property
+    def rate_hz(self):
+        return 1/self.period_s
+
+    def stats(self):
+        return {'rate_hz': self.rate_hz, 'priority': self.priority, 'runs': self.runs, 'errors': self.errors,
+                'overruns': self.overruns, 'skipped': self.skipped,
+                'last_lateness_s': self.last_lateness_s, 'max_lateness_s': self.max_lateness_s}
+
+
+# Define a class to run periodic jobs, each on its own deadlines.
+# Every job has its own rate, so fast devices are not held back by slow ones.  A job starts at
+# each of its deadlines, k*period after the scheduler starts, instead of a period after its last
+# run, so it does not drift.  If the previous run of a job is still going at a deadline, the run
+# is shed; if the scheduler falls behind by more than a period, the missed deadlines are skipped
+# instead of being run late one after another.
+class DeadlineScheduler:
+    def __init__(self):
+        self.jobs = {}
+        self._queue = []                    # Heap of (deadline, priority, sequence, job)
+        self._sequence = itertools.count()  # Orders jobs with the same deadline and priority
+        self._loop = None
+        self._wakeup = None
+
+    def add_job(self, name, func, rate_hz, priority=0):
+        """
+        Adds a periodic job, replacing any job with the same name.
+
+        Parameters:
+        name (str): Name of the job.
+        func (coroutine function): Called without arguments on every run.
+        rate_hz (float): Rate of the job [Hz].
+        priority (int, optional): Jobs due at the same time start in increasing order of priority. Default is 0.
+
+        Returns:
+            Job: The job added.
+        """
+        job = Job(name, func, rate_hz, priority)
+        self.jobs[name] = job
+        if self._loop is not None:
+            self._push(job, self._loop.time())
+            self._wakeup.set()
+        return job
+
+    def remove_job(self, name):
+        # The job is dropped from the queue when its deadline comes
+        self.jobs.pop(name, None)
+
+    def stats(self):
+        return {name: job.stats() for name, job in self.jobs.items()}
+
+    def _push(self, job, deadline):
+        heapq.heappush(self._queue, (deadline, job.priority, next(self._sequence), job))
+
+    async def _run_job(self, job):
+        try:
+            with JOB_SECONDS.time(job.name):
+                await job.func()
+        except Exception as e:
+            job.errors += 1
+            JOB_ERRORS.inc(job.name)
+            logging.error(f"Scheduler: job {job.name} failed\n{'':<20}Error: {e}")
+        job.runs += 1
+
+    async def run(self):
+        """
+        Runs the jobs until cancelled.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        start = self._loop.time()
+        for job in self.jobs.values():
+            self._push(job, start)
+
+        while True:
+            if len(self._queue) == 0:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            # Sleep until the next deadline, or until a job is added
+            deadline, _, _, job = self._queue[0]
+            delay = deadline - self._loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            heapq.heappop(self._queue)
+            if self.jobs.get(job.name) is not job:
+                continue    # The job was removed or replaced
+
+            now = self._loop.time()
+            job.last_lateness_s = now - deadline
+            job.max_lateness_s = max(job.max_lateness_s, job.last_lateness_s)
+            JOB_LATENESS_SECONDS.observe(job.last_lateness_s, job.name)
+
+            # Shed the run if the previous one is still going
+            if job.task is not None and not job.task.done():
+                job.overruns += 1
+                JOB_OVERRUNS.inc(job.name)
+            else:
+                job.task = asyncio.create_task(self._run_job(job))
+
+            # Schedule the next deadline, skipping the ones already missed
+            missed = math.floor((now - deadline) / job.period_s)
+            if missed > 0:
+                job.skipped += missed
+                JOB_SKIPPED.inc(job.name, amount=missed)
+            self._push(job, deadline + (missed + 1)*job.period_s)
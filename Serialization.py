@@ -0,0 +1,100 @@
+import gzip
+import json
+import numpy as np
+from flask.json.provider import JSONProvider
+
+# orjson is optional: it encodes NumPy arrays natively and is much faster than the json module,
+# which is used without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+COMPRESS_MIN_BYTES = 16384      # JSON responses larger than this are gzipped, if the client accepts it [bytes]
+COMPRESS_LEVEL = 1              # gzip level of the responses, the fastest: the data is mostly digits
+
+
+def _array_to_list(array):
+    # Convert an array to a list, with None for the empty (NaN) values, which JSON can't encode
+    values = array.tolist()
+    if array.dtype.kind == 'f':
+        for i in np.flatnonzero(np.isnan(array)).tolist():
+            values[i] = None
+    return values
+
+
+def _default(obj):
+    # Encode the types the encoders don't know: NumPy arrays orjson can't encode directly
+    # (object or non-contiguous arrays), NumPy scalars and sets
+    if isinstance(obj, np.ndarray):
+        if orjson is not None and obj.dtype.kind in 'fiub':
+            return np.ascontiguousarray(obj)
+        return _array_to_list(obj)
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj):
+    """
+    Encodes an object to JSON.  NumPy arrays and scalars are encoded directly, without converting
+    them to lists first when orjson is available; NaN values of NumPy arrays are encoded as null.
+
+    Parameters:
+    obj: The object to encode.
+
+    Returns:
+        bytes: The JSON document, UTF-8 encoded.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=_default, separators=(',', ':')).encode('utf-8')
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# Define a class for the JSON provider of the Flask app, so jsonify and the JSON requests go through
+# dumps and loads.  Set it with app.json = FastJSONProvider(app)
+class FastJSONProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        # Same arguments as jsonify, the body is written as bytes without decoding it
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj), mimetype='application/json')
+
+
+def compress_response(response, accept_encoding, min_bytes=COMPRESS_MIN_BYTES):
+    """
+    Gzips a JSON response if it is large and the client accepts it.  Streamed responses, e.g. the
+    live data stream, are left as they are.
+
+    Parameters:
+    response (flask.Response): The response.
+    accept_encoding (str): The Accept-Encoding header of the request.
+    min_bytes (int, optional): Smallest body to compress [bytes]. Default is COMPRESS_MIN_BYTES.
+
+    Returns:
+        flask.Response: The response, compressed or not.
+    """
+    if (response.direct_passthrough or response.is_streamed or response.mimetype != 'application/json'
+            or 'Content-Encoding' in response.headers or 'gzip' not in (accept_encoding or '').lower()):
+        return response
+    body = response.get_data()
+    if len(body) < min_bytes:
+        return response
+
+    response.set_data(gzip.compress(body, compresslevel=COMPRESS_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
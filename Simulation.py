@@ -0,0 +1,369 @@
+import asyncio
+import math
+import queue
+import random
+import re
+import threading
+import time
+import serial
+
+SIM_PREFIX = 'sim://'     # Ports starting with this prefix are served by the simulator
+CC2_BATCH_READ = 0x50     # Batch read sysex command of LAC_firmata.ino
+
+
+def is_simulated(port):
+    return isinstance(port, str) and port.startswith(SIM_PREFIX)
+
+
+# Define a class for the response time of a simulated device.
+# Every request takes mean_s plus a random jitter drawn from the distribution, and is lost
+# (never answered) with probability drop_rate.
+class LatencyModel:
+    DISTRIBUTIONS = ['fixed', 'normal', 'uniform', 'lognormal']
+
+    def __init__(self, mean_s, jitter_s=0, distribution='normal', drop_rate=0, seed=None):
+        """
+        Parameters:
+        mean_s (float): Mean response time [s].
+        jitter_s (float, optional): Standard deviation (normal, lognormal) or half width (uniform) of the response time [s]. Default is 0.
+        distribution (str, optional): One of DISTRIBUTIONS. Default is 'normal'.
+        drop_rate (float, optional): Probability that a request is never answered. Default is 0.
+        seed (int, optional): Seed of the random generator, for reproducible runs. Default is None.
+        """
+        if distribution not in LatencyModel.DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution: {distribution}")
+        self.mean_s = mean_s
+        self.jitter_s = jitter_s
+        self.distribution = distribution
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+
+    def sample(self):
+        """
+        Returns:
+            float: The response time of one request [s], never negative.
+        """
+        if self.jitter_s == 0 or self.distribution == 'fixed':
+            return self.mean_s
+        if self.distribution == 'normal':
+            return max(0, self.random.gauss(self.mean_s, self.jitter_s))
+        if self.distribution == 'uniform':
+            return max(0, self.random.uniform(self.mean_s - self.jitter_s, self.mean_s + self.jitter_s))
+        # Lognormal with the given mean and standard deviation: a long tail of slow responses
+        sigma2 = math.log(1 + (self.jitter_s/self.mean_s)**2)
+        return self.random.lognormvariate(math.log(self.mean_s) - sigma2/2, math.sqrt(sigma2))
+
+    def dropped(self):
+        return self.drop_rate > 0 and self.random.random() < self.drop_rate
+
+
+# Define a class for the gas lines of the rig: a dry flow (MFC1) and a flow through the
+# humidifier (MFC2) are mixed into the chamber.
+# The flow of each MFC follows its setpoint with a first-order lag.  The humidifier output is
+# at humidifier_rh; the inlet of the chamber is the flow-weighted mix of the two lines and the
+# chamber is a well-mixed volume, so its humidity follows the inlet with a time constant of
+# volume/flow.  The state is integrated exactly between reads, assuming the setpoints are
+# constant in between, so the plant needs no thread of its own.
+class HumidityPlant:
+    def __init__(self, chamber_volume_ml=500, dry_rh=2, humidifier_rh=95, initial_rh=40, temperature_c=23,
+                 mfc_tau_s=0.3, pressure_psig_per_sccm=0.002, noise_rh=0.05, noise_c=0.02, noise_psi=0.002, seed=None):
+        self.chamber_volume_ml = chamber_volume_ml
+        self.dry_rh = dry_rh                    # Humidity of the dry line [%RH]
+        self.humidifier_rh = humidifier_rh      # Humidity at the humidifier output [%RH]
+        self.temperature_c = temperature_c
+        self.mfc_tau_s = mfc_tau_s              # Time constant of the MFCs reaching their setpoint [s]
+        self.pressure_psig_per_sccm = pressure_psig_per_sccm   # Back pressure of the chamber outlet [psig/sccm]
+
+        # Measurement noise (standard deviations)
+        self.noise_rh = noise_rh
+        self.noise_c = noise_c
+        self.noise_psi = noise_psi
+        self.random = random.Random(seed)
+
+        self.setpoints = {}         # Flow setpoints, keyed by line ('dry', 'humid', ...) [sccm]
+        self.flows = {}             # Actual flows, keyed by line [sccm]
+        self.chamber_rh = initial_rh
+        self.last_update = time.monotonic()
+        self.lock = threading.Lock()    # Devices answer from the event loop and from timer threads
+
+    def _update(self):
+        now = time.monotonic()
+        dt = now - self.last_update
+        self.last_update = now
+        if dt <= 0:
+            return
+
+        # Chamber humidity, using the mean flows over the step
+        decay = math.exp(-dt/self.mfc_tau_s)
+        mean_flows = {}
+        for line, setpoint in self.setpoints.items():
+            flow = self.flows[line]
+            mean_flows[line] = setpoint + (flow - setpoint) * self.mfc_tau_s/dt * (1 - decay)
+            self.flows[line] = setpoint + (flow - setpoint) * decay
+
+        dry, humid = mean_flows.get('dry', 0), mean_flows.get('humid', 0)
+        total = dry + humid
+        if total > 0:
+            inlet_rh = (dry*self.dry_rh + humid*self.humidifier_rh) / total
+            rate = total/60 / self.chamber_volume_ml    # Volume exchanges per second [1/s]
+            self.chamber_rh = inlet_rh + (self.chamber_rh - inlet_rh) * math.exp(-dt*rate)
+
+    def set_flow_setpoint(self, line, flow_sccm):
+        with self.lock:
+            self._update()
+            self.flows.setdefault(line, 0.0)
+            self.setpoints[line] = max(0.0, flow_sccm)
+
+    def flow(self, line):
+        with self.lock:
+            self._update()
+            return self.flows.get(line, 0.0), self.setpoints.get(line, 0.0)
+
+    def humidity(self, location='chamber'):
+        """
+        Parameters:
+        location (str): 'chamber' or 'humidifier'.
+
+        Returns:
+            float: The measured humidity at the location [%RH].
+        """
+        with self.lock:
+            self._update()
+            rh = self.chamber_rh if location == 'chamber' else self.humidifier_rh
+            return min(100.0, max(0.0, self.random.gauss(rh, self.noise_rh)))
+
+    def temperature(self):
+        with self.lock:
+            return self.random.gauss(self.temperature_c, self.noise_c)
+
+    def pressure(self):
+        """
+        Returns:
+            float: The gauge pressure of the chamber [psig].
+        """
+        with self.lock:
+            self._update()
+            total = sum(self.flows.values())
+            return self.random.gauss(total * self.pressure_psig_per_sccm, self.noise_psi)
+
+
+# Define a class for a simulated Alicat mass flow controller, a drop-in for alicat.FlowController.
+# It answers the Alicat ASCII commands used by the MFC class (poll, setpoint, control point
+# register) after the response time of its latency model, and drives one line of the plant.
+class SimFlowController:
+    CONTROL_POINTS = {'mass flow': 37, 'vol flow': 36, 'abs pressure': 34, 'gauge pressure': 38, 'diff pressure': 39}
+
+    def __init__(self, plant, line, latency, unit='A'):
+        self.plant = plant
+        self.line = line                # Line of the plant driven by this MFC, e.g. 'dry'
+        self.latency = latency
+        self.unit = unit
+        self.keys = ['pressure', 'temperature', 'volumetric_flow', 'mass_flow', 'setpoint', 'gas']
+        self.control_point = 'mass flow'
+        self.open = True
+        self.plant.set_flow_setpoint(line, 0)
+
+    def __repr__(self):
+        return f"<SimFlowController {self.line} {self.unit}>"
+
+    def _frame(self):
+        flow, setpoint = self.plant.flow(self.line)
+        pressure = 14.696 + self.plant.pressure()
+        return (f"{self.unit} {pressure:+08.3f} {self.plant.temperature():+08.3f} {flow:+08.3f} "
+                f"{flow:+08.3f} {setpoint:+08.3f} N2")
+
+    def _answer(self, command):
+        command = command[len(self.unit):]
+        if command == '':
+            return self._frame()
+        match = re.fullmatch(r'S(-?[0-9.]+)', command)
+        if match:
+            self.plant.set_flow_setpoint(self.line, float(match.group(1)))
+            return self._frame()
+        if command == 'R122':
+            return f"{self.unit}   122 = {SimFlowController.CONTROL_POINTS[self.control_point]}"
+        return '?'
+
+    async def _write_and_read(self, command):
+        if not self.open:
+            raise OSError(f"The FlowController with unit ID {self.unit} is closed.")
+        # Wait for the response, a lost request times out like the serial client
+        if self.latency.dropped():
+            await asyncio.sleep(self.latency.mean_s * 5)
+            return None
+        await asyncio.sleep(self.latency.sample())
+        return self._answer(command)
+
+    async def get(self):
+        line = await self._write_and_read(self.unit)
+        if not line:
+            raise OSError("Could not read values")
+        unit, values = line.split()[0], line.split()[1:]
+        state = {}
+        for key, value in zip(self.keys, values):
+            try:
+                state[key] = float(value)
+            except ValueError:
+                state[key] = value
+        state['control_point'] = self.control_point
+        return state
+
+    async def set_flow_rate(self, flowrate):
+        line = await self._write_and_read(f'{self.unit}S{flowrate:.2f}')
+        if not line:
+            raise OSError("Could not set setpoint.")
+
+    async def close(self):
+        self.open = False
+
+
+# Define a class for a simulated Firmata board running LAC_firmata, a drop-in for pyfirmata.Arduino
+# as used by HumiditySensorInterface.  A sysex request to a sensor address is answered, after the
+# response time of the latency model, by a sysex with the address and the 4 ChipCap2 data bytes,
+# sent as 7-bit pairs from a timer thread like the pyfirmata iterator thread.  Addresses without
+# a sensor answer 0xFF bytes, like a missing sensor on the I2C bus.  A CC2_BATCH_READ request
+# is answered, after one response time, by [n, (address, 4 data bytes) * n].  Like the firmware,
+# the board handles one request at a time.
+class SimFirmataBoard:
+    def __init__(self, plant, latency, sensors=None):
+        self.plant = plant
+        self.latency = latency
+        self.sensors = sensors if sensors is not None else {0x31: 'chamber', 0x32: 'humidifier'}
+        self.handlers = {}
+        self.busy_until = 0     # Time the board is done with the requests already sent [s]
+        self.lock = threading.Lock()
+
+    def add_cmd_handler(self, cmd, func):
+        self.handlers[cmd] = func
+
+    def _read_sensor(self, addr):
+        # Encode the reading like the ChipCap2: status bits 00, 14 bit humidity, 14 bit temperature
+        if addr not in self.sensors:
+            return [0xFF]*4
+        humidity = min(2**14 - 1, int(self.plant.humidity(self.sensors[addr]) / 100 * 2**14))
+        temperature = min(2**14 - 1, max(0, int((self.plant.temperature() + 40) / 165 * 2**14)))
+        return [humidity >> 8 & 0x3F, humidity & 0xFF, temperature >> 6, (temperature & 0x3F) << 2]
+
+    def _respond(self, cmd, request):
+        handler = self.handlers.get(cmd)
+        if handler is None:
+            return
+        if cmd == CC2_BATCH_READ:
+            response = [len(request)]
+            for addr in request:
+                response += [addr] + self._read_sensor(addr)
+        else:
+            response = [cmd] + self._read_sensor(cmd)
+        data = []
+        for byte in response:
+            data.extend([byte & 0x7F, byte >> 7])
+        handler(*data)
+
+    def send_sysex(self, sysex_cmd, data=[]):
+        if self.latency.dropped():
+            return
+        # The request waits for the ones sent before it
+        with self.lock:
+            now = time.monotonic()
+            self.busy_until = max(self.busy_until, now) + self.latency.sample()
+            delay = self.busy_until - now
+        timer = threading.Timer(delay, self._respond, (sysex_cmd, list(data)))
+        timer.daemon = True
+        timer.start()
+
+    def exit(self):
+        self.handlers = {}
+
+
+# Define a class for a simulated serial port with a PX409 behind it, a drop-in for serial.Serial
+# as used by PX409.  Each 'P' command queues a pressure line, due after the response time of the
+# latency model.  Responses come out in order, like on a real port.
+class SimSerial:
+    def __init__(self, plant, latency, port, baudrate=115200, timeout=None, **kwargs):
+        self.plant = plant
+        self.latency = latency
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.is_open = True
+        self.responses = queue.Queue()      # (due time, line)
+        self.last_due = 0
+        self.buffer = b''
+
+    def write(self, data):
+        if not self.is_open:
+            raise serial.SerialException(f"{self.port}: port closed")
+        self.buffer += data
+        while b'\r' in self.buffer:
+            command, self.buffer = self.buffer.split(b'\r', 1)
+            if command.strip() != b'P' or self.latency.dropped():
+                continue
+            self.last_due = max(self.last_due, time.monotonic() + self.latency.sample())
+            self.responses.put((self.last_due, f"{self.plant.pressure():.4f} PSIG\r\n".encode('ascii')))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def readline(self):
+        try:
+            due, line = self.responses.get(timeout=self.timeout)
+        except queue.Empty:
+            return b''
+        if line is None:
+            raise serial.SerialException(f"{self.port}: port closed")
+        time.sleep(max(0, due - time.monotonic()))
+        return line
+
+    def close(self):
+        self.is_open = False
+        self.responses.put((0, None))   # Wake up a reader blocked in readline
+
+
+# Define a class to create the simulated devices.  Devices on the same plant share it, so the
+# flows set on the simulated MFCs show up on the simulated humidity and pressure sensors.  Ports
+# are 'sim://mfc/<line>' (e.g. sim://mfc/dry, sim://mfc/humid), 'sim://firmata' and
+# 'sim://px409', optionally followed by '@<plant>' to simulate several chambers, e.g.
+# sim://mfc/dry@cell2.  Ports without a plant name use the default plant.
+class Simulator:
+    def __init__(self, plant=None, mfc_latency=None, firmata_latency=None, px409_latency=None):
+        self.plants = {'': plant if plant is not None else HumidityPlant()}    # Keyed by plant name
+        # Defaults measured on the rig: fc.get() ~200ms (SD 5ms), a ChipCap2 read ~55ms
+        # (50ms wake-up delay in the firmware), a PX409 read ~10ms at 115200 baud
+        self.mfc_latency = mfc_latency if mfc_latency is not None else LatencyModel(0.2, 0.005)
+        self.firmata_latency = firmata_latency if firmata_latency is not None else LatencyModel(0.055, 0.003)
+        self.px409_latency = px409_latency if px409_latency is not None else LatencyModel(0.01, 0.002)
+
+    @property
+    def plant(self):
+        return self.plants['']
+
+    def get_plant(self, name=''):
+        # Plants are created on first use, with the default parameters
+        if name not in self.plants:
+            self.plants[name] = HumidityPlant()
+        return self.plants[name]
+
+    def _device(self, port, kind):
+        device, _, plant_name = port[len(SIM_PREFIX):].partition('@')
+        if not device.startswith(kind):
+            raise serial.SerialException(f"{port} is not a simulated {kind}")
+        return device[len(kind):].strip('/'), self.get_plant(plant_name)
+
+    def flow_controller(self, port):
+        line, plant = self._device(port, 'mfc')
+        if line == '':
+            raise serial.SerialException(f"{port}: no plant line, e.g. {SIM_PREFIX}mfc/dry")
+        return SimFlowController(plant, line, self.mfc_latency)
+
+    def firmata_board(self, port):
+        _, plant = self._device(port, 'firmata')
+        return SimFirmataBoard(plant, self.firmata_latency)
+
+    def serial(self, port, baudrate=115200, timeout=None, **kwargs):
+        _, plant = self._device(port, 'px409')
+        return SimSerial(plant, self.px409_latency, port, baudrate, timeout)
+
+
+# Simulator used by the drivers for 'sim://' ports
+SIMULATOR = Simulator()
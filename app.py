@@ -1,17 +1,24 @@
-from flask import Flask, jsonify, render_template, request
-from HumiditySensorInterface import HumiditySensorInterface
+import time
+STARTUP_T0 = time.perf_counter()    # Start of the app, to report the startup time
+
+from flask import Flask, Response, abort, jsonify, make_response, render_template, request
+from Recorder import export_csv
+from RunCatalog import is_within, write_manifest, update_manifest
+from Downsampling import downsample
+from Clock import CLOCK
+import Serialization
+from Scheduler import DeadlineScheduler
+from Metrics import REGISTRY
+from Chamber import load_chambers
 import logging
 import Hardware
 import asyncio
 import datetime
 import math
-import time
 import threading
 import uuid
 import os
 import sys
-import json
-import simple_pid
 
 TEST_MODE = True   # Set to True to run in test mode, averts required hardware connections
 
@@ -29,78 +36,53 @@ logging.getLogger('werkzeug').setLevel(logging.WARNING)
 
 # GLOBAL VARIABLES ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-CONTROL_DATA = { 'mode': 'MAN', 'params': {'MFC1': 0, 'MFC2': 0} }
-HARDWARE_LOOP_FREQ_HZ = 1     # Hardware run loop frequency [Hz]
+CHAMBERS_CONFIG = os.getenv('LAC_CHAMBERS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chambers.json'))  # Chambers and their devices
+HARDWARE_LOOP_FREQ_HZ = 1     # Default control loop frequency and acquisition rate of the chambers [Hz]
+DEVICE_TIMEOUT_S = 0.8        # Maximum time a single device may take to fetch data [s]
+MFC_DEADBAND_SCCM = 0.05      # MFC flow rate changes smaller than this are not written by the control loop [sccm]
+DATA_WINDOW_SIZE = 10000      # Number of samples kept in memory per device
+RECORDER_FLUSH_INTERVAL_S = 1 # Maximum time samples wait before being written to the save files [s]
+RECORDER_FLUSH_SIZE = 1000    # Number of waiting samples that triggers a write to the save files
+RECORDING_FORMAT = 'csv'      # Default save file format, 'csv' or 'binary'
+STREAM_MIN_INTERVAL_S = 0.1   # Minimum time between two events of the live data stream [s]
+STREAM_KEEPALIVE_S = 1        # Maximum time without an event on the live data stream [s]
 PID_GAINS = [0.05, 0.002, 0]  # PID gains for the control loop [Kp, Ki, Kd]
-DEFAULT_SAVE_DIR = os.getcwd() + '/data'
-
-# Humidity Sensor Interface, handles Arduino communication
-ARDUINO_PORT = '/dev/cu.usbmodem143301'
-HSI = HumiditySensorInterface()
-
-# MFC Devices
-MFC1_PORT = '/dev/tty.usbserial-AU057C72'
-MFC2_PORT = '/dev/tty.usbserial-AU05IFFF'
-
-# Pressure Sensor Port
-PS_PORT = '/dev/cu.usbserial-555149'
-
-# Create instances of the hardware components (Data aquisition components)
-daq_instances = {
-    'test1': Hardware.DummyDAQ(0.05),
-    'test2': Hardware.DummyDAQ(0.5),
-    'test3': Hardware.DummyDAQ(0.03),
-    'MFC1': Hardware.MFC(),
-    'MFC2': Hardware.MFC(),
-    'SHT1': Hardware.HumiditySensor(HSI),
-    'SHT2': Hardware.HumiditySensor(HSI),
-    'PS1': Hardware.PressureSensor(),
-    'humidity_setpoint': Hardware.HumiditySetpoint(PID_GAINS, 1/HARDWARE_LOOP_FREQ_HZ),
+
+# Simulated hardware (Simulation.py), to run the full loop without the rig: LAC_SIMULATION=1
+# The ports of chambers.json are replaced by simulated ones, with one simulated plant per chamber
+SIMULATION_MODE = os.getenv('LAC_SIMULATION') == '1'
+
+# Create the chambers: the hardware components (data aquisition components), control loop
+# and recorder of each cell, see chambers.json.  Settings missing from the config use these defaults
+Hardware.DAQ.window_size = DATA_WINDOW_SIZE
+CHAMBER_DEFAULTS = {
+    'loop_freq_hz': HARDWARE_LOOP_FREQ_HZ,
+    'device_timeout_s': DEVICE_TIMEOUT_S,
+    'mfc_deadband_sccm': MFC_DEADBAND_SCCM,
+    'pid_gains': PID_GAINS,
+    'recorder_flush_interval_s': RECORDER_FLUSH_INTERVAL_S,
+    'recorder_flush_size': RECORDER_FLUSH_SIZE,
 }
-hg = Hardware.HardwareGroup(daq_instances, 10)
-
-# Try a connection to the Arduino
-try:
-    logging.info(f"Starting connection to ARDUINO on port {ARDUINO_PORT}")
-    HSI.connect_board(ARDUINO_PORT)
-    # Connect to the MFCs
-    logging.info(f"HSI connected on port {ARDUINO_PORT}")
-except:
-    logging.error("Could not connect to ARDUINO, CHANGE PORT")
-    if not TEST_MODE: sys.exit()  # Exit the program if the Arduino connection fails
-
-# Try a connection to the humidity sensors
-asyncio.run(daq_instances['SHT1'].connect(0x31))
-asyncio.run(daq_instances['SHT2'].connect(0x32))
-
-# Try a connection to the MFCs
-logging.info(f"Starting connection to MFC1 on port {MFC1_PORT}")
-asyncio.run(daq_instances['MFC1'].connect(MFC1_PORT))
-logging.info(f"Starting connection to MFC2 on port {MFC2_PORT}")
-asyncio.run(daq_instances['MFC2'].connect(MFC2_PORT))
-
-if  daq_instances['MFC1'].is_connected and daq_instances['MFC2'].is_connected:
-    # If connected, set MFCs to 0 flow
-    logging.info("MFCs connected")
-    CONTROL_DATA = {'mode': 'MAN', 'params': {'MFC1': 0, 'MFC2': 0} }
-    hg.add_flask_command( daq_instances['MFC1'].set_flow_rate, {'flow_rate': 0} )
-    hg.add_flask_command( daq_instances['MFC2'].set_flow_rate, {'flow_rate': 0} )
-else:
-    logging.error("Could not connect to MFCs, CHANGE PORT")
-    if not TEST_MODE: sys.exit()
-
-# Try a connection to the pressure sensor
-try:
-    daq_instances['PS1'].connect(PS_PORT)
-except:
-    logging.error("Could not connect to Pressure Sensor, CHANGE PORT")
-    if not TEST_MODE: sys.exit()
+chambers = load_chambers(CHAMBERS_CONFIG, CHAMBER_DEFAULTS, simulate=SIMULATION_MODE)
+DEFAULT_CHAMBER_ID = next(iter(chambers))     # Chamber of the routes without a /chamber/<chamber_id> prefix
+scheduler = DeadlineScheduler()     # Runs the jobs of all the chambers
+
+
+# Startup times [s]: 'import' until the app is loaded, 'connect' until the devices are connected.
+# The devices are connected by the hardware loop, so the server is up while they connect
+STARTUP_TIMES = {'import': None, 'connect': None}
+STARTUP_SECONDS = REGISTRY.gauge('lac_startup_seconds', 'Time taken by each startup phase.', ['phase'])
 
 # Flask application
 app = Flask(__name__, static_url_path='/static')
 app.config['SERVER_NAME'] = 'localhost:4000'  # Replace with your server name and port
+app.json = Serialization.FastJSONProvider(app)  # jsonify encodes NumPy arrays directly, see Serialization.py
 app_start_time = time.time()
 
+STARTUP_TIMES['import'] = time.perf_counter() - STARTUP_T0
+STARTUP_SECONDS.set(STARTUP_TIMES['import'], 'import')
+logging.info(f"App loaded in {STARTUP_TIMES['import']:.2f}s")
+
 
 
 
@@ -108,43 +90,154 @@ app_start_time = time.time()
 ### FLASK ROUTES
 ######################
 
-def print_non_serializable_parts(data):
+@app.after_request
+def compress(response):
+    # Large JSON responses (data, recordings, profiles) are gzipped
+    return Serialization.compress_response(response, request.headers.get('Accept-Encoding'))
+
+def chamber_route(rule, **options):
     """
-    Recursively checks the data to find and print non-JSON serializable parts.
+    Registers a route of a chamber.  The route is served for every chamber under
+    /chamber/<chamber_id>, and for the default chamber without the prefix.
     """
-    def is_serializable(obj):
-        try:
-            json.dumps(obj)
-            return True
-        except TypeError:
-            # print the object type
-            print(f'Non-serializable type found: {type(obj)}')
-            return False
-
-    def check_data(data, path=''):
-        if isinstance(data, list):
-            for i, item in enumerate(data):
-                check_data(item, f'{path}[{i}]')
-        elif isinstance(data, dict):
-            for key, value in data.items():
-                check_data(value, f'{path}["{key}"]')
-        elif not is_serializable(data):
-            print(f'Non-serializable data found at {path}: {data}')
-
-    check_data(data)
-    print('Done checking non-serializable parts.')
-
-@app.route('/<daq_id>/fetch_data', methods=['GET'])
-def fetch_data(daq_id):
-    daq = daq_instances.get(daq_id)
+    def decorator(view):
+        app.route(rule, defaults={'chamber_id': DEFAULT_CHAMBER_ID}, **options)(view)
+        app.route('/chamber/<chamber_id>' + rule, **options)(view)
+        return view
+    return decorator
+
+def get_chamber(chamber_id):
+    chamber = chambers.get(chamber_id)
+    if chamber is None:
+        abort(make_response(jsonify({'success': False, 'message': f'Unknown chamber {chamber_id}'}), 404))
+    return chamber
+
+# Route to list the chambers, their control mode and the connection status of their devices
+@app.route('/chambers', methods=['GET'])
+def list_chambers():
+    return jsonify({'default': DEFAULT_CHAMBER_ID,
+                    'chambers': {chamber_id: chamber.status() for chamber_id, chamber in chambers.items()}})
+
+@app.route('/startup_status', methods=['GET'])
+def startup_status():
+    # Progress of the startup: time of each phase [s] and connection state of each device
+    return jsonify({'done': STARTUP_TIMES['connect'] is not None,
+                    'times_s': STARTUP_TIMES,
+                    'uptime_s': time.perf_counter() - STARTUP_T0,
+                    'chambers': {chamber_id: chamber.connection_status for chamber_id, chamber in chambers.items()}})
+
+@chamber_route('/status', methods=['GET'])
+def live_status(chamber_id):
+    # Connection and latest sample of every device, from memory: no hardware I/O
+    return jsonify(get_chamber(chamber_id).live_status())
+
+@chamber_route('/<daq_id>/fetch_data', methods=['GET'])
+def fetch_data(chamber_id, daq_id):
+    daq = get_chamber(chamber_id).daq_instances.get(daq_id)
+    if daq is None:
+        return jsonify({'success': False, 'message': f'Unknown device {daq_id}'}), 404
+
+    # Non-destructive read, return the samples newer than the cursor or timestamp given,
+    # up to the until timestamp and downsampled to points samples if given
+    cursor = request.args.get('cursor', type=int)
+    since = request.args.get('since', type=float)
+    if cursor is not None or since is not None:
+        data, cursor = daq.read_data(cursor=cursor, since=since, until=request.args.get('until', type=float),
+                                     points=request.args.get('points', type=int))
+        return jsonify({'data': data, 'cursor': cursor})
+
+    # Legacy read, removes the returned samples for every other client
     data = daq.pop_data_queue()
 
     return jsonify(data)
 
+def parse_daq_selection(args, daq_instances):
+    """
+    Parses the components and cursors selected by the query parameters of a data route.
+    ids (optional) is a comma-separated list of components, all of them by default;
+    cursors (optional) is a comma-separated list of <daq_id>:<cursor>.
+
+    Returns:
+        dict: The cursor of each selected component, None if not given.
+    """
+    daq_ids = [daq_id for daq_id in args.get('ids', ','.join(daq_instances.keys())).split(',')
+               if daq_id in daq_instances]
+    cursors = {daq_id: None for daq_id in daq_ids}
+    for item in args.get('cursors', '').split(','):
+        daq_id, _, cursor = item.partition(':')
+        if daq_id in cursors and cursor.isdigit():
+            cursors[daq_id] = int(cursor)
+    return cursors
+
+# Route to fetch the new data of many components in one request, in columnar form:
+# {daq_id: {'time': [...], 'values': {key: [...]}, 'cursor': n}}.  Times are UNIX timestamps [s].
+# Query parameters: ids and cursors, see parse_daq_selection; since (optional) is a UNIX
+# timestamp [s] used for the components without a cursor; until (optional) is the UNIX timestamp [s]
+# of the last sample; points (optional) downsamples each component to at most that many samples,
+# keeping the shape of the curves, so a long time range costs about as much as a short one.
+@chamber_route('/fetch_data', methods=['GET'])
+def fetch_data_batch(chamber_id):
+    daq_instances = get_chamber(chamber_id).daq_instances
+    since = request.args.get('since', type=float)
+    until = request.args.get('until', type=float)
+    points = request.args.get('points', type=int)
+    cursors = parse_daq_selection(request.args, daq_instances)
+    return jsonify({daq_id: daq_instances[daq_id].read_columns(cursor=cursor, since=since, until=until, points=points)
+                    for daq_id, cursor in cursors.items()})
+
+# Route to stream the new data and the connection status of the components as Server-Sent Events.
+# 'data' events hold the new samples of the components that have some, in the columnar form of
+# /fetch_data.  'status' events hold the connection status of the components whose status
+# changed (all of them in the first event).
+# Query parameters: ids and cursors, see parse_daq_selection.
+@chamber_route('/stream', methods=['GET'])
+def stream(chamber_id):
+    daq_instances = get_chamber(chamber_id).daq_instances
+    cursors = {daq_id: cursor or 0 for daq_id, cursor in parse_daq_selection(request.args, daq_instances).items()}
+    daq_ids = list(cursors.keys())
+
+    def event(name, body):
+        return f"event: {name}\ndata: {Serialization.dumps(body).decode('utf-8')}\n\n"
+
+    def generate():
+        status = {}
+        version = -1
+        while True:
+            # Send the connection status of the components that changed
+            new_status = {daq_id: {'connected': daq_instances[daq_id].is_connected, 'port': daq_instances[daq_id].port}
+                          for daq_id in daq_ids}
+            changed = {daq_id: s for daq_id, s in new_status.items() if status.get(daq_id) != s}
+            if changed:
+                status = new_status
+                yield event('status', changed)
+
+            # Send the new data of the components
+            data = {}
+            for daq_id in daq_ids:
+                if cursors[daq_id] >= daq_instances[daq_id].data_buffer.count:
+                    continue
+                data[daq_id] = daq_instances[daq_id].read_columns(cursor=cursors[daq_id])
+                cursors[daq_id] = data[daq_id]['cursor']
+            if data:
+                yield event('data', data)
+            elif not changed and version != -1:
+                yield ": keep-alive\n\n"     # Comment line, detects closed connections
+
+            # Wait for new data, then let more samples accumulate to limit the event rate
+            t0 = time.time()
+            version = Hardware.DAQ.wait_for_data(version, STREAM_KEEPALIVE_S)
+            time.sleep(max(0, STREAM_MIN_INTERVAL_S - (time.time() - t0)))
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 # Route to connect to a component using a specific port
-@app.route('/<daq_id>/connect', methods=['POST', 'GET'])
-async def connect(daq_id):
+@chamber_route('/<daq_id>/connect', methods=['POST', 'GET'])
+async def connect(chamber_id, daq_id):
+    daq_instances = get_chamber(chamber_id).daq_instances
     daq = daq_instances.get(daq_id)
+    if daq is None:
+        return jsonify({'success': False, 'message': f'Unknown device {daq_id}'}), 404
     logging.debug(f"Attempting to connect to {daq_id} on port {daq.port}")
 
     if request.method == 'POST':
@@ -175,8 +268,9 @@ async def connect(daq_id):
             return jsonify({'success': False, 'message': f'No Connection on port {daq.port}', 'port': daq.port}), 200
 
 # Route to start data acquisition
-@app.route('/start_recording_data', methods=['POST'])
-def start_recording_data():
+@chamber_route('/start_recording_data', methods=['POST'])
+def start_recording_data(chamber_id):
+    chamber = get_chamber(chamber_id)
     current_timestamp = time.strftime("%y%m%d_%H%M")
 
     #Get the set directory to save the data to
@@ -185,33 +279,102 @@ def start_recording_data():
     if directory == '':
         directory = f"/LAC_{current_timestamp}"
 
-    # Set the directory to save the data to
-    directory = f"{DEFAULT_SAVE_DIR}{directory}"
+    # Get the save file format
+    file_format = requestData.get('format', RECORDING_FORMAT)
+    if file_format not in ['csv', 'binary']:
+        return jsonify({'success': False, 'message': f'Unknown recording format {file_format}'}), 400
+    extension = 'bin' if file_format == 'binary' else 'csv'
+
+    # Set the directory to save the data to, in the save directory of the chamber
+    directory = f"{chamber.save_dir}{directory}"
+    if not is_within(directory, chamber.save_dir):
+        return jsonify({'success': False, 'message': f"Invalid directory {requestData['directory']}"}), 400
 
     if not os.path.exists(directory):
         os.makedirs(directory)
 
     message = "Data recording started."
     # Start the setpoint functionality if not already started, if mode is ARB or SPT
-    if CONTROL_DATA['mode'] == 'ARB' or CONTROL_DATA['mode'] == 'SPT' and not daq_instances['humidity_setpoint'].is_enabled: 
-        _, message_2 = daq_instances['humidity_setpoint'].enable()
+    if chamber.control_data['mode'] == 'ARB' or chamber.control_data['mode'] == 'SPT' and not chamber.setpoint.is_enabled: 
+        _, message_2 = chamber.setpoint.enable()
         message += f"   {message_2}"
-        logging.info(f"Setpoint connected: {daq_instances['humidity_setpoint'].is_enabled}")
+        logging.info(f"Setpoint connected: {chamber.setpoint.is_enabled}")
 
     # Set the save file for each DAQ instance
-    for daq_key in daq_instances.keys():
-        filepath = f"{directory}/{daq_key}_{current_timestamp}.csv"
-        daq_instances[daq_key].set_save_file( filepath )
+    devices = {}
+    for daq_key in chamber.daq_instances.keys():
+        filepath = f"{directory}/{daq_key}_{current_timestamp}.{extension}"
+        chamber.daq_instances[daq_key].set_save_file( filepath, file_format=file_format )
+        if chamber.daq_instances[daq_key].save_file is not None:
+            devices[daq_key] = os.path.basename(filepath)
+
+    # Describe the recording for the run catalog, see RunCatalog.py
+    write_manifest(directory, {'run': os.path.basename(os.path.normpath(directory)), 'chamber': chamber.id,
+                               'format': file_format, 'started': CLOCK.now(), 'stopped': None, 'clock': CLOCK.anchor(),
+                               'control': chamber.control_data, 'devices': devices})
+    chamber.run_directory = directory
     return jsonify({'success': True, 'message': message}), 200
 
 # Route to stop data acquisition
-@app.route('/stop_recording_data', methods=['POST'])
-def stop_recording_data():
+@chamber_route('/stop_recording_data', methods=['POST'])
+def stop_recording_data(chamber_id):
+    chamber = get_chamber(chamber_id)
+    daq_instances = chamber.daq_instances
     for daq in daq_instances.keys():
         daq_instances[daq].close_save_file()
 
+    if chamber.run_directory is not None:
+        update_manifest(chamber.run_directory, stopped=CLOCK.now())
+        chamber.run_directory = None
+
     return jsonify({'success': True, 'message': 'Data recording stopped'}), 200
 
+# Route to export the binary save files of a recording to CSV files
+@chamber_route('/export_recording', methods=['POST'])
+def export_recording(chamber_id):
+    save_dir = get_chamber(chamber_id).save_dir
+    requestData = request.get_json()
+    directory = os.path.realpath(f"{save_dir}{requestData['directory']}")
+    if not is_within(directory, save_dir) or not os.path.isdir(directory):
+        return jsonify({'success': False, 'message': f"Recording {requestData['directory']} not found"}), 404
+
+    exported = []
+    for file_name in sorted(os.listdir(directory)):
+        if file_name.endswith('.bin'):
+            export_csv(f"{directory}/{file_name}", f"{directory}/{file_name[:-len('.bin')]}.csv")
+            exported.append(file_name)
+    return jsonify({'success': True, 'message': f'Exported {len(exported)} file(s) to CSV', 'files': exported}), 200
+
+# Route to list the recordings of the chamber, newest first, see RunCatalog.py
+@chamber_route('/runs', methods=['GET'])
+def list_runs(chamber_id):
+    return jsonify({'runs': get_chamber(chamber_id).runs.runs()})
+
+# Route to describe a recording: its manifest and the channels recorded for each component
+@chamber_route('/runs/<run>', methods=['GET'])
+def get_run(chamber_id, run):
+    runs = get_chamber(chamber_id).runs
+    manifest = runs.get_run(run)
+    if manifest is None:
+        return jsonify({'success': False, 'message': f'Recording {run} not found'}), 404
+    manifest['channels'] = {daq_key: runs.channels(run, daq_key) for daq_key in manifest['devices']}
+    return jsonify(manifest)
+
+# Route to read one channel of a component of a recording over a time range: {'time': [...], 'values': [...]}.
+# Times are UNIX timestamps [s].  Query parameters: since and until (optional) are the UNIX timestamps [s]
+# of the range, the whole recording by default; points (optional) downsamples to at most that many samples.
+@chamber_route('/runs/<run>/<daq_id>/<channel>', methods=['GET'])
+def query_run(chamber_id, run, daq_id, channel):
+    try:
+        time_s, values = get_chamber(chamber_id).runs.query(run, daq_id, channel,
+                                                            since=request.args.get('since', type=float),
+                                                            until=request.args.get('until', type=float))
+    except KeyError as e:
+        return jsonify({'success': False, 'message': str(e.args[0])}), 404
+
+    time_s, columns = downsample(time_s, {channel: values}, request.args.get('points', type=int))
+    return jsonify({'time': time_s, 'values': columns[channel]})
+
 @app.route('/plot_flow_arbitrary', methods=['POST', 'GET'])
 async def plot_flow_arbitrary():
     if request.method == 'POST':
@@ -228,144 +391,143 @@ async def plot_flow_arbitrary():
     # if request.method == 'GET':
     #     jsonify({'time': time_s.tolist(), 'values': values.tolist()})
 
-@app.route('/get_current_control', methods=['GET'])
-def get_current_control():
-    return jsonify({'control_mode': CONTROL_DATA['mode'], 'control_params': CONTROL_DATA['params']}), 200
+@chamber_route('/get_current_control', methods=['GET'])
+def get_current_control(chamber_id):
+    chamber = get_chamber(chamber_id)
+    return jsonify({'control_mode': chamber.control_data['mode'], 'control_params': chamber.control_params_with_preview()}), 200
 
-@app.route('/set_control', methods=['POST'])
-async def set_control():
+@chamber_route('/set_control', methods=['POST'])
+async def set_control(chamber_id):
+    chamber = get_chamber(chamber_id)
+    control_data = chamber.control_data
+    dry_mfc, humid_mfc = chamber.control['dry_mfc'], chamber.control['humid_mfc']
     requestData = request.get_json()
 
+    # An arbitrary profile is compiled and evaluated over its whole duration before anything is changed,
+    # so an invalid one (e.g. with an unknown symbol) is refused and the current control is kept
+    if requestData['controlMode'] == 'ARB':
+        try:
+            #Remove the empty sections, set the expression-duration pairs as the control parameters
+            segments = [(sect['segmentString'], float(sect['duration'])) for sect in requestData['params']['segments']
+                        if sect['segmentString'] != '' or sect['duration'] != '']
+            flow_rate = max(0, min(100, float(requestData['params']['flowRate'])))
+            profile = Hardware.SetpointProfile(segments)
+            profile(0)
+            profile.sample()
+        except Exception as e:
+            return jsonify({'success': False, 'message': f'Invalid setpoint profile: {e}'}), 400
+
     # Set the control scheme
-    CONTROL_DATA['mode'] = requestData['controlMode']
+    control_data['mode'] = requestData['controlMode']
     # Record the parameters
-    CONTROL_DATA['params'] = requestData['params']
-    logging.info(f"[SET]Control mode: {CONTROL_DATA['mode']} \n{'':20}[SET]Control params: {CONTROL_DATA['params']}")
+    control_data['params'] = requestData['params']
+    logging.info(f"[{chamber.id}][SET]Control mode: {control_data['mode']} \n{'':20}[SET]Control params: {control_data['params']}")
 
     message = ""
     # Set the MFCs control behavior, depending on the control scheme
-    if CONTROL_DATA['mode'] == 'MAN':
-        daq_instances['humidity_setpoint'].disable()    #Disable the setpoint control
+    if control_data['mode'] == 'MAN':
+        chamber.setpoint.disable()    #Disable the setpoint control
         # Check if each of the control parameters are not blank
-        if CONTROL_DATA['params']['MFC1'] == '' or CONTROL_DATA['params']['MFC2'] == '':
+        if control_data['params'].get(dry_mfc, '') == '' or control_data['params'].get(humid_mfc, '') == '':
             return jsonify({'success': False, 'message': 'MFC flow rate(s) blank'}), 400
 
         # Parse the control parameters as floats
-        CONTROL_DATA['params'] = {key: float(val) for key, val in CONTROL_DATA['params'].items()}
+        control_data['params'] = {key: float(val) for key, val in control_data['params'].items()}
         
         # Ensure the flow rates are within the limits.  If not, set them to the limits
-        CONTROL_DATA['params']['MFC1'] = max(0, min(100, CONTROL_DATA['params']['MFC1']))
-        CONTROL_DATA['params']['MFC2'] = max(0, min(100, CONTROL_DATA['params']['MFC2']))
-        logging.info(f"Setting MFCs to {CONTROL_DATA['params']['MFC1']} and {CONTROL_DATA['params']['MFC2']}")
+        control_data['params'][dry_mfc] = max(0, min(100, control_data['params'][dry_mfc]))
+        control_data['params'][humid_mfc] = max(0, min(100, control_data['params'][humid_mfc]))
+        logging.info(f"[{chamber.id}] Setting MFCs to {control_data['params'][dry_mfc]} and {control_data['params'][humid_mfc]}")
 
         # Set the MFCs flow rates by adding it to the command queue to be handled by the hardware loop
-        hg.add_flask_command( daq_instances['MFC1'].set_flow_rate, 
-                             {'flow_rate': CONTROL_DATA['params']['MFC1']} )
-        hg.add_flask_command( daq_instances['MFC2'].set_flow_rate, 
-                             {'flow_rate': CONTROL_DATA['params']['MFC2']} )
+        queued = chamber.hg.add_flask_command( chamber.daq_instances[dry_mfc].set_flow_rate, 
+                                              {'flow_rate': control_data['params'][dry_mfc], 'force': True} )
+        queued &= chamber.hg.add_flask_command( chamber.daq_instances[humid_mfc].set_flow_rate, 
+                                               {'flow_rate': control_data['params'][humid_mfc], 'force': True} )
+        if not queued:
+            return jsonify({'success': False, 'message': 'Hardware busy, command queue full'}), 503
 
         message = "MFCs set to manual control"
         return jsonify({'success': True, 'message': message, 
-                    'control_mode': CONTROL_DATA['mode'], 'control_params': CONTROL_DATA['params']}), 200
+                    'control_mode': control_data['mode'], 'control_params': control_data['params']}), 200
 
-    elif CONTROL_DATA['mode'] == 'SPT':
+    elif control_data['mode'] == 'SPT':
         # Check if each of the control parameters are not blank
-        if CONTROL_DATA['params']['flowRate'] == '' or CONTROL_DATA['params']['humidity'] == '':
+        if control_data['params']['flowRate'] == '' or control_data['params']['humidity'] == '':
             return jsonify({'success': False, 'message': 'Setpoint(s) blank'}), 400
         
         # Parse the control parameters as floats
-        CONTROL_DATA['params'] = {key: float(val) for key, val in CONTROL_DATA['params'].items()}
+        control_data['params'] = {key: float(val) for key, val in control_data['params'].items()}
         # Ensure the flow rates are within the limits.  If not, set them to the limits
-        CONTROL_DATA['params']['flowRate'] = max(0, min(100, CONTROL_DATA['params']['flowRate']))
-        CONTROL_DATA['params']['humidity'] = max(0, min(100, CONTROL_DATA['params']['humidity']))   
+        control_data['params']['flowRate'] = max(0, min(100, control_data['params']['flowRate']))
+        control_data['params']['humidity'] = max(0, min(100, control_data['params']['humidity']))   
 
         # Set the setpoints for the control loop
-        daq_instances['humidity_setpoint'].set_setpoint(CONTROL_DATA['params']['humidity'])
-        daq_instances['humidity_setpoint'].enable()
+        chamber.setpoint.set_setpoint(control_data['params']['humidity'])
+        chamber.setpoint.enable()
 
 
         message = "MFCs set to setpoint control"
         return jsonify({'success': True, 'message': message, 
-                    'control_mode': CONTROL_DATA['mode'], 'control_params': CONTROL_DATA['params']}), 200
-
-    elif CONTROL_DATA['mode'] == 'ARB':
-        #Remove the empty sections
-        CONTROL_DATA['params']['segments'] = [sect for sect in CONTROL_DATA['params']['segments'] if sect['segmentString'] != '' or sect['duration'] != ''] 
-        # Set the expression-duration pairs as the control parameters
-        CONTROL_DATA['params']['segments'] = [ (sect['segmentString'], float(sect['duration'])) for sect in CONTROL_DATA['params']['segments'] ]     
+                    'control_mode': control_data['mode'], 'control_params': control_data['params']}), 200
 
-        CONTROL_DATA['params']['flowRate'] = max(0, min(100, float(CONTROL_DATA['params']['flowRate'])))
+    elif control_data['mode'] == 'ARB':
+        control_data['params']['segments'] = segments
+        control_data['params']['flowRate'] = flow_rate
         message = "MFCs set to arbitrary control"
 
-        # Set the setpoint flow rates for the MFCs
-        time_s, values = Hardware.HumiditySetpoint.parse_timeseries(CONTROL_DATA['params']['segments'])
-        CONTROL_DATA['params']['time_s'] = time_s
-        CONTROL_DATA['params']['values'] = values
-
         # Set the setpoints for the control loop
-        daq_instances['humidity_setpoint'].set_setpoint(values, time_s)
-    
+        chamber.setpoint.set_setpoint(profile)
+
+        # The sampled profile is sent once, in control_params (time_s and values)
         return jsonify({'success': True, 'message': message, 
-                        'control_mode': CONTROL_DATA['mode'], 
-                        'control_params': CONTROL_DATA['params'], 
-                        'time': CONTROL_DATA['params']['time_s'], 
-                        'values': CONTROL_DATA['params']['values']}), 200
+                        'control_mode': control_data['mode'], 
+                        'control_params': chamber.control_params_with_preview()}), 200
 
-@app.route('/')
-def index():
-    return render_template('index.html')
+# Route to get the timing and error metrics of the hardware loop, in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@chamber_route('/')
+def index(chamber_id):
+    get_chamber(chamber_id)
+    # The page makes its requests to the routes of its chamber
+    return render_template('index.html', api_base=request.path.rstrip('/'))
 
 ######################
 ### Hardware run loop
 ######################
 
+async def connect_chambers():
+    # Connect the devices of all the chambers at once; the jobs skip the devices until they are connected
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*[chamber.connect() for chamber in chambers.values()])
+    STARTUP_TIMES['connect'] = time.perf_counter() - t0
+    STARTUP_SECONDS.set(STARTUP_TIMES['connect'], 'connect')
+    logging.info(f"Devices connected in {STARTUP_TIMES['connect']:.2f}s, "
+                 f"{time.perf_counter() - STARTUP_T0:.2f}s after start")
+
+    for chamber, failed in zip(chambers.values(), results):
+        if failed:
+            logging.error(f"[{chamber.id}] Could not connect to {', '.join(failed)}, CHANGE PORT")
+            if not TEST_MODE: os._exit(1)  # Exit the program if a connection fails
+
 async def run_loop():
     # Setup
+    # The Flask commands of each chamber run as soon as they are queued
+    command_tasks = [asyncio.create_task(chamber.hg.command_worker()) for chamber in chambers.values()]
 
-    # Looping
-    while True:
-        t0 = time.time()
-        # Check for commands from the Flask app and handle them
-        if not hg.flask_command_queue.empty():
-            await hg.run_flask_commands()
-        
-        # Query data from all components (DAQs)
-        # Exclude SHT1 and humidity_setpoint, if using control loop.  These
-        # are fetched in the control loop
-        exclude = []
-        if daq_instances['humidity_setpoint'].is_enabled:
-            exclude = ['SHT1', 'humidity_setpoint']
-        await hg.fetch_data(exclude=exclude)
-
-        # Control loop
-        if daq_instances['humidity_setpoint'].is_enabled:
-            # Get the setpoint of the control scheme
-            setpoint = (await daq_instances['humidity_setpoint'].fetch_data())['values']['humidity_setpoint']
-            daq_instances['humidity_setpoint'].pid.setpoint = setpoint
-
-            # Compute new output from the PID according to the system's current value
-            current_humidity = await daq_instances['SHT1'].fetch_data()
-            if current_humidity == False:
-                logging.error("SHT1 DISCONNECTED, CANNOT RUN CONTROL LOOP")
-                continue
-            else:
-                current_humidity = current_humidity['values']['humidity']
-            
-            # Get the controller output to send to the plant (MFCs)
-            # This value defines the ratio of the MFC flow rates
-            # control = daq_instances['humidity_setpoint'].pid(current_humidity)
-            control = daq_instances['humidity_setpoint'].pid.setpoint / 100
-
-            logging.info(f"Set: {daq_instances['humidity_setpoint'].pid.setpoint:.3f}, Current: {current_humidity:.3f}, Control: {control:.3f}")
+    # Every component is fetched by its own job, at its own rate, and every chamber has its own
+    # control loop job, see Chamber.add_jobs.  All of them share the scheduler
+    for chamber in chambers.values():
+        chamber.add_jobs(scheduler)
 
-            # Set the MFCs
-            total_flow = CONTROL_DATA['params']['flowRate']
-            await daq_instances['MFC1'].set_flow_rate( total_flow*(1-control) )
-            await daq_instances['MFC2'].set_flow_rate( total_flow*control     )
+    # Try a connection to the devices of each chamber, while the loop and the server run
+    connect_task = asyncio.create_task(connect_chambers())
 
-        # Calculate how much to delay, limit the delay to 0s, can't have negative delay
-        delay = (1/HARDWARE_LOOP_FREQ_HZ) - (time.time()-t0)
-        await asyncio.sleep(max(0, delay))
+    # Looping
+    await scheduler.run()
 
 # Start the Flask app and hardware loop
 if __name__ == '__main__':
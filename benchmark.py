@@ -0,0 +1,397 @@
+"""
+Benchmarks of the acquisition, recording, setpoint and serving paths.
+
+Runs on simulated hardware (Simulation.py), so it needs no rig.  Results are written as JSON
+and can be compared with a previous run to catch regressions before deploying:
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --compare baseline.json
+
+Each result is the time of one operation [s] over several repeats (min, median, mean, p95, max).
+--compare exits with status 1 if the median of any benchmark is slower than the baseline by
+more than the threshold.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+# Benchmarks, keyed by name.  Each one returns a dict of results keyed by variant
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def summarize(times_s):
+    """
+    Parameters:
+    times_s (list): Time of one operation, for each repeat [s].
+
+    Returns:
+        dict: The statistics of the times [s].
+    """
+    times_s = np.asarray(times_s, dtype=np.float64)
+    return {'min_s': float(times_s.min()), 'median_s': float(np.median(times_s)), 'mean_s': float(times_s.mean()),
+            'p95_s': float(np.percentile(times_s, 95)), 'max_s': float(times_s.max()), 'repeats': len(times_s)}
+
+
+def measure(func, repeat, number=1, setup=None):
+    """
+    Times a function.
+
+    Parameters:
+    func (function): Called without arguments.
+    repeat (int): Number of repeats.
+    number (int, optional): Number of calls per repeat; the time of one call is the mean. Default is 1.
+    setup (function, optional): Called before each repeat, not timed. Default is None.
+
+    Returns:
+        dict: The statistics of the time of one call [s], see summarize.
+    """
+    # One untimed call first, to warm up the caches
+    if setup is not None:
+        setup()
+    func()
+
+    times_s = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        for _ in range(number):
+            func()
+        times_s.append((time.perf_counter() - t0) / number)
+    return summarize(times_s)
+
+
+def sample_values(i):
+    # Values of an MFC sample
+    return {'pressure': 14.7 + i*1e-4, 'temperature': 23.0, 'volumetric_flow': 50.0, 'mass_flow': 50.0, 'setpoint': 50.0}
+
+
+def fill(daq, n):
+    for i in range(n):
+        daq._track_data({'values': sample_values(i)})
+
+
+@benchmark('track_data')
+def bench_track_data(args):
+    import Hardware
+
+    results = {}
+    number = 10000
+    daq = Hardware.DAQ(window_size=Hardware.DAQ.window_size)
+    daq.is_connected = True     # Save files are only opened for connected DAQs
+    data = {'values': sample_values(0)}
+    results['no_save_file'] = measure(lambda: daq._track_data(data), args.repeat, number)
+
+    with tempfile.TemporaryDirectory() as save_dir:
+        for file_format in ['csv', 'binary']:
+            daq.set_save_file(os.path.join(save_dir, f'track_data.{file_format}'), file_format)
+            assert daq.save_file is not None, "The save file was not opened, the recorder hand-off would not be measured"
+            results[f'save_file_{file_format}'] = measure(lambda: daq._track_data(data), args.repeat, number)
+            daq.close_save_file()
+    return results
+
+
+@benchmark('pop_data_queue')
+def bench_pop_data_queue(args):
+    import Hardware
+
+    # Drain a full window
+    daq = Hardware.DAQ(window_size=10000)
+    fill(daq, 10000)
+    def rewind():
+        daq.pop_cursor = 0
+    return {'window_10000': measure(daq.pop_data_queue, args.repeat, setup=rewind)}
+
+
+@benchmark('parse_timeseries')
+def bench_parse_timeseries(args):
+    import Hardware
+
+    # 48 segments of 30 min, 86400 points
+    expressions = ['40 + 20*sin(t/5)', '60 - t/3', '25', '30 + 10*exp(-t/10)', '50 + 5*cos(t)*sin(t/7)', 't**2/100 + 20']
+    pairs = [(expressions[i % len(expressions)], 30) for i in range(48)]
+
+    results = {}
+    results['48_segments_cold'] = measure(lambda: Hardware.HumiditySetpoint.parse_timeseries(pairs), args.repeat,
+                                          setup=Hardware.compile_expression.cache_clear)
+    results['48_segments_warm'] = measure(lambda: Hardware.HumiditySetpoint.parse_timeseries(pairs), args.repeat)
+    return results
+
+
+@benchmark('serialize_window')
+def bench_serialize_window(args):
+    import gzip
+    import Hardware
+    import Serialization
+
+    # A full window of an MFC, in the columnar form of /fetch_data
+    daq = Hardware.DAQ(window_size=10000)
+    fill(daq, 10000)
+    columns = daq.read_columns(cursor=0)
+    as_lists = {'time': columns['time'].tolist(), 'values': {key: column.tolist() for key, column in columns['values'].items()},
+                'cursor': columns['cursor']}
+
+    def with_bytes(stats, body):
+        return {**stats, 'bytes': len(body)}
+
+    results = {}
+    results['json_lists'] = with_bytes(measure(lambda: json.dumps(as_lists), args.repeat), json.dumps(as_lists).encode())
+    body = Serialization.dumps(columns)
+    results['serialization'] = with_bytes(measure(lambda: Serialization.dumps(columns), args.repeat), body)
+    results['serialization_gzip'] = with_bytes(
+        measure(lambda: gzip.compress(Serialization.dumps(columns), compresslevel=Serialization.COMPRESS_LEVEL), args.repeat),
+        gzip.compress(body, compresslevel=Serialization.COMPRESS_LEVEL))
+    return results
+
+
+@benchmark('fetch_data_route')
+def bench_fetch_data_route(args):
+    # Import the app on simulated hardware
+    os.environ['LAC_SIMULATION'] = '1'
+    import app
+    logging.getLogger().setLevel(logging.WARNING)
+
+    # The devices are connected by the hardware loop, which is not running here
+    chamber = app.chambers[app.DEFAULT_CHAMBER_ID]
+    asyncio.run(chamber.connect())
+
+    client = app.app.test_client()
+    daq = chamber.daq_instances['MFC1']
+    fill(daq, app.DATA_WINDOW_SIZE)
+
+    def get(url):
+        response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError(f"{url}: HTTP {response.status_code}")
+
+    # Downsampled reads never return more samples than asked for, whatever the number of columns
+    for points in [5, 100, 1000]:
+        n_samples = len(client.get(f'/fetch_data?ids=MFC1&points={points}').get_json()['MFC1']['time'])
+        assert n_samples <= points, f"{n_samples} samples returned for points={points}"
+
+    results = {}
+    results[f'window_{app.DATA_WINDOW_SIZE}'] = measure(lambda: get('/MFC1/fetch_data?cursor=0'), args.repeat)
+    results[f'window_{app.DATA_WINDOW_SIZE}_points_1000'] = measure(lambda: get('/fetch_data?ids=MFC1&points=1000'), args.repeat)
+    results['batched_all_devices'] = measure(lambda: get('/fetch_data'), args.repeat)
+    return results
+
+
+async def read_sensors(n_sensors, n_reads, batched):
+    import Simulation
+    from HumiditySensorInterface import HumiditySensorInterface
+
+    # Simulated board with the response time of the firmware, which handles one request at a time.
+    # Reading 12 sensors one at a time takes longer than the default timeout
+    hsi = HumiditySensorInterface(timeout_s=2)
+    hsi.connect_board(Simulation.SIM_PREFIX + 'firmata')
+    hsi.board.sensors = {0x10 + i: 'chamber' for i in range(n_sensors)}
+    sensor_addrs = list(hsi.board.sensors)
+    hsi.add_sensor_addr(sensor_addrs)
+
+    read = hsi.get_data_batched if batched else hsi.get_data_async
+    times_s = []
+    for _ in range(n_reads):
+        t0 = time.perf_counter()
+        await asyncio.gather(*[read(sensor_addr) for sensor_addr in sensor_addrs])
+        times_s.append(time.perf_counter() - t0)
+    return times_s
+
+
+@benchmark('read_humidity_sensors')
+def bench_read_humidity_sensors(args):
+    results = {}
+    for n_sensors in [1, 4, 12]:
+        for batched in [False, True]:
+            variant = f"{n_sensors}_sensors_{'batched' if batched else 'per_address'}"
+            results[variant] = summarize(asyncio.run(read_sensors(n_sensors, args.repeat, batched)))
+    return results
+
+
+TIME_SCALE = 10     # The scheduled benchmarks run the rig 10x faster: rates x10, response times /10
+
+
+async def run_chamber_ticks(n_ticks, profile=None):
+    """
+    Runs the jobs of a simulated chamber (the devices of chambers.json) on a DeadlineScheduler,
+    like the hardware loop, for a number of control loop periods.  Time is scaled by TIME_SCALE.
+
+    Parameters:
+    n_ticks (int): Number of control loop periods to run.
+    profile (str, optional): ARB setpoint expression of t [min] to run the control loop with. Default is None, control loop off.
+
+    Returns:
+        tuple: (lateness, chamber, scheduler): the lateness of each tick, the latest start of a
+               job after its deadline in the tick [s], the chamber and the scheduler.
+    """
+    import Hardware
+    import Simulation
+    from Chamber import Chamber
+    from Scheduler import DeadlineScheduler
+
+    # Response times of the rig (see Simulation.Simulator), scaled
+    Simulation.SIMULATOR = Simulation.Simulator(mfc_latency=Simulation.LatencyModel(0.2/TIME_SCALE, 0.005/TIME_SCALE),
+                                                firmata_latency=Simulation.LatencyModel(0.055/TIME_SCALE, 0.003/TIME_SCALE),
+                                                px409_latency=Simulation.LatencyModel(0.01/TIME_SCALE, 0.002/TIME_SCALE))
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chambers.json')) as f:
+        config = next(iter(json.load(f)['chambers'].values()))
+    # The dummy devices are not part of the rig
+    devices = {key: dict(device) for key, device in config['devices'].items() if device['type'] != 'DummyDAQ'}
+    for device in devices.values():
+        if 'rate_hz' in device:
+            device['rate_hz'] *= TIME_SCALE
+    chamber = Chamber('bench', {**config, 'devices': devices, 'loop_freq_hz': config.get('loop_freq_hz', 1)*TIME_SCALE,
+                                'save_dir': tempfile.gettempdir()}, simulate=True)
+
+    command_worker = asyncio.create_task(chamber.hg.command_worker())
+    failed = await chamber.connect()
+    if failed:
+        raise RuntimeError(f"Could not connect to {failed}")
+    if profile is not None:
+        chamber.control_data = {'mode': 'ARB', 'params': {'flowRate': 100}}
+        chamber.setpoint.set_setpoint(Hardware.SetpointProfile([(profile, 60)]))
+        chamber.setpoint.enable()
+
+    scheduler = DeadlineScheduler()
+    chamber.add_jobs(scheduler)
+
+    # Record the lateness of every run, grouped by control loop period
+    loop = asyncio.get_running_loop()
+    period_s = 1/chamber.loop_freq_hz
+    lateness = {}
+    def record_lateness(job):
+        func = job.func
+        async def run():
+            tick = int((loop.time() - job.last_lateness_s - start) / period_s + 1e-3)
+            lateness[tick] = max(lateness.get(tick, 0), job.last_lateness_s)
+            await func()
+        return run
+    for job in scheduler.jobs.values():
+        job.func = record_lateness(job)
+
+    start = loop.time()
+    run = asyncio.create_task(scheduler.run())
+    await asyncio.sleep(n_ticks*period_s)
+    run.cancel()
+    command_worker.cancel()
+    await asyncio.gather(run, command_worker, *[job.task for job in scheduler.jobs.values() if job.task is not None],
+                         return_exceptions=True)
+
+    for daq in chamber.daq_instances.values():
+        if isinstance(daq, Hardware.PressureSensor):
+            daq.px.close()
+    return [lateness[tick] for tick in sorted(lateness) if tick < n_ticks], chamber, scheduler
+
+
+@benchmark('run_loop_tick')
+def bench_run_loop_tick(args):
+    # End-to-end ticks of the hardware loop: the device jobs, the control loop and the command worker
+    # of a chamber on the scheduler.  The result is the lateness of each tick, with the runs shed
+    # (overruns) and the deadlines skipped
+    import Hardware
+    logging.getLogger().setLevel(logging.WARNING)
+    results = {}
+    for variant, profile in [('control_off', None), ('control_arb', '40+100*t')]:
+        lateness, chamber, scheduler = asyncio.run(run_chamber_ticks(args.repeat, profile))
+        stats = scheduler.stats().values()
+        results[variant] = {**summarize(lateness), 'overruns': sum(job['overruns'] for job in stats),
+                            'skipped': sum(job['skipped'] for job in stats)}
+
+        # While the control loop sets the MFCs, the state they return replaces the gets of their jobs
+        mfcs = [daq for daq in chamber.daq_instances.values() if isinstance(daq, Hardware.MFC)]
+        results[variant]['mfc_gets'] = sum(mfc.reads['get'] for mfc in mfcs)
+        results[variant]['mfc_merged_reads'] = sum(mfc.reads['merged'] for mfc in mfcs)
+        if profile is not None:
+            assert results[variant]['mfc_merged_reads'] > 0 and results[variant]['mfc_merged_reads'] >= results[variant]['mfc_gets'], \
+                f"MFC reads not merged with the sets: {results[variant]['mfc_gets']} gets, {results[variant]['mfc_merged_reads']} merged"
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares the medians of two runs.
+
+    Returns:
+        list: The (benchmark, variant, ratio) of the benchmarks slower than the baseline by more than the threshold.
+    """
+    regressions = []
+    print(f"\n{'benchmark':<45}{'baseline':>14}{'current':>14}{'ratio':>8}")
+    for name, variants in results.items():
+        for variant, stats in variants.items():
+            base = baseline.get('results', {}).get(name, {}).get(variant)
+            if base is None:
+                continue
+            ratio = stats['median_s'] / base['median_s'] if base['median_s'] > 0 else float('inf')
+            flag = '  SLOWER' if ratio > 1 + threshold else ''
+            print(f"{name + '/' + variant:<45}{base['median_s']:>14.3e}{stats['median_s']:>14.3e}{ratio:>8.2f}{flag}")
+            if ratio > 1 + threshold:
+                regressions.append((name, variant, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the acquisition, recording, setpoint and serving paths.")
+    parser.add_argument('--benchmarks', nargs='+', choices=list(BENCHMARKS.keys()), default=list(BENCHMARKS.keys()),
+                        help="Benchmarks to run. Default is all.")
+    parser.add_argument('--repeat', type=int, default=20, help="Number of repeats of each benchmark. Default is 20.")
+    parser.add_argument('--output', help="Write the results to this JSON file.")
+    parser.add_argument('--compare', help="Compare with the results of a previous run (JSON file).")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="Slowdown of the median reported as a regression. Default is 0.2 (20%%).")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the random generators. Default is 0.")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+
+    results = {}
+    for name in args.benchmarks:
+        t0 = time.perf_counter()
+        results[name] = BENCHMARKS[name](args)
+        print(f"{name}: done in {time.perf_counter() - t0:.1f}s", file=sys.stderr)
+        for variant, stats in results[name].items():
+            counts = ''.join(f"  {stats[key]} {key}" for key in ['bytes', 'overruns', 'skipped', 'mfc_gets', 'mfc_merged_reads'] if key in stats)
+            print(f"  {variant:<30} median {stats['median_s']:.3e}s  p95 {stats['p95_s']:.3e}s{counts}", file=sys.stderr)
+
+    report = {'meta': {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                       'numpy': np.__version__, 'platform': platform.platform(), 'repeat': args.repeat, 'seed': args.seed},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) above {args.threshold:.0%}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,49 +1,91 @@
+// Offset of the local time zone from UTC [ms]
+const TIMEZONE_OFFSET_ms = new Date().getTimezoneOffset() * 60000;
+
+// Convert a UNIX timestamp from the server [s] to a time for the plots: milliseconds shifted to the
+// local time zone, since Plotly shows numeric dates in UTC.  Numbers are cheaper than Date objects.
+function toPlotTime(timestamp) {
+    return timestamp * 1000 - TIMEZONE_OFFSET_ms;
+}
+
 class DAQ {
     constructor(label, accessPoint) {
         this.label = label;
         this.port = [];
         this.accessPoint = accessPoint;     // access point on the Flask server
+        this.cursor = 0;                    // cursor of the next sample to fetch from the server
 
         this.isConnected = false; // Connection status tracker
     }
 
     async fetchData() {
         try {
-            // Fetch data from the server
-            const response = await fetch(this.accessPoint + '/fetch_data');
-            const data = await response.json();
-
-            // Check if data is empty, return an empty array if so
-            if (data.length === 0) {
-                return [];
-            }
-            // Process the data
-            let processedData = data.reduce((acc, d) => {
-                // For each key in the 'values' object of the current data point 'd'
-                Object.keys(d.values).forEach(key => {
-                    // If the accumulator object does not already have this key, initialize it
-                    if (!acc[key]) {
-                        acc[key] = {
-                            datetime: [],  // Array to store datetime values for this key
-                            values: []     // Array to store the actual data values for this key
-                        };
-                    }
-                    // Convert the 'datetime' string to a Date object and push it to the 'datetime' array
-                    acc[key].datetime.push(new Date(d.datetime));
-                    // Push the actual data value for this key to the 'values' array
-                    acc[key].values.push(d.values[key]);
-                });
-                // Return the updated accumulator object after processing the current data point 'd'
-                return acc;
-            }, {});
-
-            return processedData;
+            // Fetch the data newer than the cursor from the server, without removing it for other clients
+            const response = await fetch(`${this.accessPoint}/fetch_data?cursor=${this.cursor}`);
+            const body = await response.json();
+            return this.processData(body.data, body.cursor);
         } catch (error) {
             console.error(`${this.plotTitle} Could not FETCH:`, error);
             throw error; // Re-throw the error to be caught by the caller
         }
     }
 
+    // Process a list of samples from the server into arrays of times and values for each key,
+    // and move the cursor past them
+    processData(data, cursor) {
+        this.cursor = cursor;
+
+        // Check if data is empty, return an empty array if so
+        if (data.length === 0) {
+            return [];
+        }
+        // Process the data
+        let processedData = data.reduce((acc, d) => {
+            // For each key in the 'values' object of the current data point 'd'
+            Object.keys(d.values).forEach(key => {
+                // If the accumulator object does not already have this key, initialize it
+                if (!acc[key]) {
+                    acc[key] = {
+                        time: [],      // Array to store the times of this key, see toPlotTime
+                        values: []     // Array to store the actual data values for this key
+                    };
+                }
+                // Convert the timestamp to a plot time and push it to the 'time' array
+                acc[key].time.push(toPlotTime(d.time));
+                // Push the actual data value for this key to the 'values' array
+                acc[key].values.push(d.values[key]);
+            });
+            // Return the updated accumulator object after processing the current data point 'd'
+            return acc;
+        }, {});
+
+        return processedData;
+    }
+
+    // Process columnar data from the server ({time, values, cursor}) into arrays of times and
+    // values for each key, and move the cursor past them
+    processColumns(body) {
+        this.cursor = body.cursor;
+
+        // Check if data is empty, return an empty array if so
+        if (body.time.length === 0) {
+            return [];
+        }
+        // The times are UNIX timestamps in seconds, shared by all the keys
+        const time = body.time.map(toPlotTime);
+        let processedData = {};
+        for (const key in body.values) {
+            processedData[key] = {time: time, values: body.values[key]};
+        }
+        return processedData;
+    }
+
+    // Update the connection status from a status pushed by the server
+    updateStatus(status) {
+        this.isConnected = status.connected;
+        this.port = status.port;
+        this.updateDiagram();
+    }
+
 
     connect(port) { 
         this.port = port;
@@ -178,7 +220,7 @@ class MFC extends DAQ {
 
     updateDiagramText(lastValues) {
         // console.log(this.label, lastValues, this.isConnected);
-        if (this.isConnected) {
+        if (this.isConnected && Object.keys(lastValues).length > 0) {
             this.diagram.updateText([ 
                         `${this.truncateNumber(lastValues['mass_flow'])} sccm`, 
                         `${this.truncateNumber(lastValues['pressure'])} psi`, 
@@ -247,6 +289,11 @@ class Sensor extends DAQ {
         return this.isConnected;
     }
 
+    updateStatus(status) {
+        super.updateStatus(status);
+        this.updateModal();
+    }
+
     updateModal() {
         const statusIndicatorBadge = $('#sensorStatus');
 
@@ -11,7 +11,7 @@ class ScrollingPlot {
 
         this.layout = {
             title: { text: this.plotTitle, x: 0, font: { family: 'Arial, sans-serif', weight: 'bold' } },
-            xaxis: { title: 'X Axis' },
+            xaxis: { title: 'X Axis', type: 'date' },   // Times are numbers, see toPlotTime
             yaxis: { title: 'Y Axis', range: yRange },
             showlegend: true,
             margin: {
@@ -32,7 +32,7 @@ class ScrollingPlot {
         Object.keys(data).forEach(key => {
             //There may be errors if the data is not in the expected format
             try {
-                const x = data[key]['data'].datetime;   //Get the x and y values from the data
+                const x = data[key]['data'].time;       //Get the x and y values from the data
                 const y = data[key]['data'].values;
                 const marker = data[key]['marker'];     //Get the marker from the data
 
@@ -2,18 +2,23 @@
 let IS_RECORDING = false;
 const DEFAULT_SAVE_DIRECTORY = ''
 let CONTROL_MODE = 'MAN'
+// Prefix of the routes of the chamber shown on the page, e.g. /chamber/cell2 ('' for the default chamber)
+const API_BASE = document.body.dataset.apiBase || '';
+// Maximum number of samples per component of the initial fetch, the history is downsampled by the server
+const PLOT_POINTS = 1000;
+const STATUS_INTERVAL_ms = 1000;    // Period of the status refresh of the diagram [ms]
 
 // Define the components of the system
 const components = {
-    'MFC1': new MFC('MFC1', '/MFC1'),
-    'MFC2': new MFC('MFC2', '/MFC2'),
-    'SHT1': new Sensor('SHT1', '/SHT1'),
-    'SHT2': new Sensor('SHT2', '/SHT2'),
-    'PS1': new DAQ('PS1', '/PS1'),
-    'humidity_setpoint': new HumiditySetpoint('Humidity Setpoint', '/humidity_setpoint'),
-    'test1': new DAQ('Test1', '/test1'),
-    'test2': new DAQ('Test2', '/test2'),
-    'test3': new DAQ('Test3', '/test3'),
+    'MFC1': new MFC('MFC1', `${API_BASE}/MFC1`),
+    'MFC2': new MFC('MFC2', `${API_BASE}/MFC2`),
+    'SHT1': new Sensor('SHT1', `${API_BASE}/SHT1`),
+    'SHT2': new Sensor('SHT2', `${API_BASE}/SHT2`),
+    'PS1': new DAQ('PS1', `${API_BASE}/PS1`),
+    'humidity_setpoint': new HumiditySetpoint('Humidity Setpoint', `${API_BASE}/humidity_setpoint`),
+    'test1': new DAQ('Test1', `${API_BASE}/test1`),
+    'test2': new DAQ('Test2', `${API_BASE}/test2`),
+    'test3': new DAQ('Test3', `${API_BASE}/test3`),
 };
 
 // Initialize the plots
@@ -80,13 +85,8 @@ $(document).ready(function() {
     console.log('Document Ready');
 });
 
-// Loop function to refresh the site
-setInterval(async () => {
-    const frameData = await getData();
-    updatePlots(frameData);
-    updateDiagramText(frameData);
-    updateConnectionStatus();
-}, 1500); 
+// Live data stream from the server, refreshes the site whenever new data is pushed
+let dataStream = null;
 
 
 // --------------------------------
@@ -96,11 +96,9 @@ async function setupSite() {
     // Draw the Flow Diagram for the system
     drawFlowDiagram();
 
-    // Update the status of the system
-    //Check the connection status of the components, the function will also update the HTML status
-    for (let key in components) {
-        components[key].checkConnection();
-    }
+    // Update the status of the system: the connection and latest values of all the components, in one request
+    await updateStatus();
+    setInterval(updateStatus, STATUS_INTERVAL_ms);
 
     // Fetch data from all the components, initialize the plots
     const frameData = await getData();
@@ -108,10 +106,43 @@ async function setupSite() {
 
     // Update the recording status
     // TODO: Check if the system is recording data
-    updateDiagramText(frameData);
     updateRecordingStatusHTML();
     updateControlMode();
-    
+
+    // Follow the new data from where the initial fetch stopped
+    startDataStream();
+}
+
+// Open the live data stream, resuming from the cursors of the components
+function startDataStream() {
+    const cursors = Object.keys(components).map(key => `${key}:${components[key].cursor}`).join(',');
+    dataStream = new EventSource(`${API_BASE}/stream?cursors=${cursors}`);
+
+    // New data of the components that have some
+    dataStream.addEventListener('data', (event) => {
+        const body = JSON.parse(event.data);
+        const frameData = {};
+        for (let key in components) {
+            frameData[key] = (key in body) ? components[key].processColumns(body[key]) : {};
+        }
+        updatePlots(frameData);
+    });
+
+    // Connection status of the components that changed
+    dataStream.addEventListener('status', (event) => {
+        const body = JSON.parse(event.data);
+        for (let key in body) {
+            if (key in components) {
+                components[key].updateStatus(body[key]);
+            }
+        }
+    });
+
+    // Reconnect with the current cursors, so no data is sent twice
+    dataStream.onerror = () => {
+        dataStream.close();
+        setTimeout(startDataStream, 1500);
+    };
 }
 
 async function initPlots(frameData) {
@@ -139,16 +170,29 @@ async function updatePlots(frameData){
     } catch (error) {    }
 }
 
-// Update the connection status of the components
-function updateConnectionStatus() {
-    for (let key in components) {
-        components[key].checkConnection();
+// Update the connection status and the diagram text of the components from their latest values,
+// cached by the server, so the diagram does not depend on the data stream
+async function updateStatus() {
+    try {
+        const response = await fetch(`${API_BASE}/status`);
+        const status = await response.json();
+        for (let key in components) {
+            const device = status.devices[key];
+            if (device === undefined) {
+                continue;
+            }
+            components[key].updateStatus(device);
+            // Stale values are not shown
+            components[key].updateDiagramText(device.valid ? device.values : {});
+        }
+    } catch (error) {
+        console.error('Error updating the status:', error);
     }
 }
 
 function updateControlMode() {
     // Get the control mode from the server
-    fetch('/get_current_control')
+    fetch(`${API_BASE}/get_current_control`)
     .then(response => response.json())
     .then(data => {
         // Update the control mode alert
@@ -157,25 +201,15 @@ function updateControlMode() {
     });
 }
 
-// Update the text of the diagram
-function updateDiagramText(frameData) {
-    //FrameData has the polled data of all components, get the last set of values from each component
-    for (let key in components) {
-        const data = frameData[key];
-        const lastValues = Object.fromEntries(
-            Object.entries(data).map(([property, value]) => [property, value.values[value.values.length - 1]])
-        );
-
-        // Submit the last set of values to the update function of the component
-        components[key].updateDiagramText(lastValues);
-    }
-}
-
 async function getData(){
-    // Fetch data from all the components
+    // Fetch the new data of all the components in one request, downsampled so a long history stays light
+    const cursors = Object.keys(components).map(key => `${key}:${components[key].cursor}`).join(',');
+    const response = await fetch(`${API_BASE}/fetch_data?ids=${Object.keys(components).join(',')}&cursors=${cursors}&points=${PLOT_POINTS}`);
+    const body = await response.json();
+
     data = {};
     for (let key in components) {
-        data[key] = await components[key].fetchData();
+        data[key] = components[key].processColumns(body[key]);
     }
     return data;
 }
@@ -217,7 +251,7 @@ function processMainplot(frameData) {
     // Calculate the error between the setpoint and the humidity, only 
     // if the setpoint is available.  Add to the data object
     if (frameData['humidity_setpoint']['humidity_setpoint'] != undefined) {
-        const datetime = frameData['humidity_setpoint']['humidity_setpoint']['datetime'];
+        const time = frameData['humidity_setpoint']['humidity_setpoint']['time'];
         const setpoint = frameData['humidity_setpoint']['humidity_setpoint']['values'];
         const humidity = frameData['SHT1']['humidity']['values'];
         
@@ -227,7 +261,7 @@ function processMainplot(frameData) {
         for (let i = 0; i < min_length; i++) {
             vals[i] = humidity[i] - setpoint[i] + 50;
         }
-        const err_data = {'datetime': datetime.slice(0, min_length), 'values': vals};
+        const err_data = {'time': time.slice(0, min_length), 'values': vals};
         data['setpoint_error'] = {data: err_data, 
                         marker: {color: 'green',
                                 size: 8,
@@ -425,7 +459,7 @@ function handleControlSubmitButton() {
     // Send the control values to the server
     console.log('Control Mode:', CONTROL_MODE);
     console.log('Control Params:', params);
-    fetch('/set_control', {
+    fetch(`${API_BASE}/set_control`, {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json'
@@ -488,13 +522,15 @@ function handleStartRecordingButton() {
 
     //Get the file path to save the data, then send the data to the server
     const saveDirectory = $('#dataRecordingFile').val();
-    fetch('/start_recording_data', {
+    const saveFormat = $('#dataRecordingFormat').val();
+    fetch(`${API_BASE}/start_recording_data`, {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json'
         },
         body: JSON.stringify({
-            'directory': saveDirectory
+            'directory': saveDirectory,
+            'format': saveFormat
         })
     })
     .then(response => response.json())
@@ -510,7 +546,7 @@ function handleStartRecordingButton() {
 //Stop Recording button handler
 function handleStopRecordingButton() {
     console.log('Stop Recording');
-    fetch('/stop_recording_data', {
+    fetch(`${API_BASE}/stop_recording_data`, {
         method: 'POST'
     })
     .then(response => response.json())